@@ -0,0 +1,81 @@
+"""Compares the nodes settled by A* with those settled by plain Dijkstra for
+random point-to-point queries on a synthetic station graph.
+
+    python benchmarks/bench_astar.py
+"""
+import random
+import time
+
+from transporter.graph import TransitGraph
+from transporter.routing import astar, shortest_paths
+from transporter.spatial import StationIndex
+
+
+def make_graph(n: int, seed: int=0):
+    """Connects each station to its nearest neighbors with edge times
+    corresponding to bus speeds between 4 and 11 m/s. Times are rounded to
+    whole minutes like those derived from timetables, so short edges appear
+    to take no time at all."""
+    rng = random.Random(seed)
+    stations = [(i, None, None, 37.55 + rng.uniform(-0.1, 0.1),
+                 126.99 + rng.uniform(-0.12, 0.12)) for i in range(n)]
+    index = StationIndex(stations)
+
+    arcs = []
+    for i, (_, _, _, lat, lon) in enumerate(stations):
+        for d, j in index.nearest(lat, lon, k=5)[1:]:
+            arcs.append((i, j, round(d / rng.uniform(4, 11) / 60) * 60,
+                         None))
+
+    return TransitGraph.from_rows(
+        range(n), arcs, ((lat, lon) for _, _, _, lat, lon in stations))
+
+
+def counting(neighbors):
+    """Wraps `neighbors` to count the nodes it is called for, which is the
+    number of nodes settled."""
+    settled = [0]
+
+    def wrapper(node):
+        settled[0] += 1
+        return neighbors(node)
+
+    return wrapper, settled
+
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>10} {:>12} {:>12}'.format(
+        'stations', 'dijkstra', 'a*', 'ratio', 'dijkstra', 'a*'))
+
+    for n in (1000, 10000, 40000):
+        graph = make_graph(n)
+        rng = random.Random(1)
+        pairs = [(rng.randrange(n), rng.randrange(n)) for _ in range(50)]
+
+        settled_dijkstra = settled_astar = 0
+        t_dijkstra = t_astar = 0.0
+        for s, t in pairs:
+            neighbors, settled = counting(graph.neighbors)
+            started_at = time.perf_counter()
+            cost, _ = shortest_paths(s, neighbors, target=t)
+            t_dijkstra += time.perf_counter() - started_at
+            settled_dijkstra += settled[0]
+
+            neighbors, settled = counting(graph.neighbors)
+            started_at = time.perf_counter()
+            cost_astar, _ = astar(s, t, neighbors, graph.heuristic(t))
+            t_astar += time.perf_counter() - started_at
+            settled_astar += settled[0]
+
+            assert abs(cost.get(t, 0) - cost_astar.get(t, 0)) < 1e-3
+
+        print('{:>8} {:>14.0f} {:>14.0f} {:>9.1f}x {:>10.2f}ms {:>10.2f}ms'
+              .format(n, settled_dijkstra / len(pairs),
+                      settled_astar / len(pairs),
+                      settled_dijkstra / settled_astar,
+                      t_dijkstra / len(pairs) * 1000,
+                      t_astar / len(pairs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
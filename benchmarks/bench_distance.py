@@ -0,0 +1,57 @@
+"""Compares `transporter.spatial.distances()` with calling `vincenty` for
+each station, as `Map.phase1` used to do.
+
+    python benchmarks/bench_distance.py
+"""
+import random
+import time
+
+from geopy.distance import vincenty
+
+from transporter.spatial import distances
+
+
+def make_stations(n: int, seed: int=0):
+    rng = random.Random(seed)
+    latitudes = [37.55 + rng.uniform(-0.2, 0.2) for _ in range(n)]
+    longitudes = [126.99 + rng.uniform(-0.25, 0.25) for _ in range(n)]
+    return latitudes, longitudes
+
+
+def measure(func, repeat: int=3):
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main():
+    origin = (37.5547, 126.9707)
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'stations', 'vincenty', 'haversine', 'equirect.', 'speedup'))
+
+    for n in (1000, 10000, 100000):
+        latitudes, longitudes = make_stations(n)
+
+        def loop():
+            return [vincenty(origin, p).m
+                    for p in zip(latitudes, longitudes)]
+
+        # The loop is slow enough that a single run is representative
+        t_loop = measure(loop, repeat=1)
+        t_haversine = measure(lambda: distances(
+            origin[0], origin[1], latitudes, longitudes))
+        t_equirect = measure(lambda: distances(
+            origin[0], origin[1], latitudes, longitudes,
+            method='equirectangular'))
+
+        print('{:>8} {:>11.2f}ms {:>11.2f}ms {:>11.2f}ms {:>11.0f}x'.format(
+            n, t_loop * 1000, t_haversine * 1000, t_equirect * 1000,
+            t_loop / t_haversine))
+
+
+if __name__ == '__main__':
+    main()
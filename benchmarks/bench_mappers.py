@@ -0,0 +1,82 @@
+"""Compares the mappers with the dictionary-based transform they replaced,
+on the fixtures used by the tests.
+
+    python benchmarks/bench_mappers.py
+"""
+import json
+import os
+import sys
+import time
+
+from transporter.utils import RouteMapper, RoutesForStationMapper
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), '..', 'tests')
+
+
+def legacy_transform(source_dict: dict, mapper: tuple):
+    """`DictMapper.transform()` as it used to be"""
+    target_dict = {}
+    for source_key, target_key, func in mapper:
+        target_dict[target_key] = func(source_dict[source_key])
+    return target_dict
+
+
+def legacy_route_entry(source_dict: dict):
+    """`RouteMapper.transform_entry()` as it used to be, which built its
+    mapper on every call"""
+    mapper = (
+        ('arsId', 'ars_id', RouteMapper.map_ars_id),
+        ('gpsY', 'latitude', float),
+        ('gpsX', 'longitude', float),
+    )
+    return legacy_transform(source_dict, mapper)
+
+
+def measure(func, entries: list, repeat: int=200):
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func(entries)
+        best = min(best, time.perf_counter() - started_at)
+    return best / len(entries)
+
+
+def entry_size(func, entries: list):
+    """Average size of an entry itself, not counting the values"""
+    return sum(sys.getsizeof(e) for e in func(entries)) / len(entries)
+
+
+def main():
+    cases = [
+        ('get_station_by_uid.json', RoutesForStationMapper(),
+         lambda e: legacy_transform(e, RoutesForStationMapper.mapper)),
+        ('get_route_and_pos.json', RouteMapper(), legacy_route_entry),
+    ]
+
+    print('{:<26} {:>8} {:>12} {:>12} {:>10} {:>10}'.format(
+        'fixture', 'entries', 'dict', 'record', 'dict', 'record'))
+
+    for filename, mapper, legacy in cases:
+        with open(os.path.join(FIXTURE_PATH, filename), 'rb') as fin:
+            entries = json.loads(fin.read().decode('utf-8'))['resultList']
+        # Long routes have a few hundred stations
+        entries = entries * 10
+
+        def old(entries):
+            return [legacy(e) for e in entries]
+
+        def new(entries):
+            return list(mapper.transform_entries(entries))
+
+        assert [r.as_dict() for r in new(entries)] == old(entries)
+
+        print('{:<26} {:>8} {:>10.2f}us {:>10.2f}us {:>9.0f}B {:>9.0f}B'
+              .format(filename, len(entries),
+                      measure(old, entries) * 1e6,
+                      measure(new, entries) * 1e6,
+                      entry_size(old, entries), entry_size(new, entries)))
+
+
+if __name__ == '__main__':
+    main()
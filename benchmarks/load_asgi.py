@@ -0,0 +1,149 @@
+"""A load test of the ASGI application against a local stub of the upstream
+service that answers after a fixed delay.
+
+    python benchmarks/load_asgi.py --requests 2000 --concurrency 500
+
+Every request asks for a different route, so that each one makes an upstream
+call. Uses the Redis server at `REDIS_URL` if set, or an in-memory one.
+Requires httpx and uvicorn.
+"""
+import argparse
+import asyncio
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+import httpx
+import uvicorn
+
+from transporter.asgi import create_asgi_app
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), '..', 'tests',
+                            'get_route_and_pos.json')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.latency)
+        with server.lock:
+            server.in_flight -= 1
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(latency: float):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.in_flight = server.max_in_flight = 0
+    with open(FIXTURE_PATH, 'rb') as fin:
+        server.body = fin.read()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_app(upstream_base_url: str, port: int):
+    redis = None
+    redis_url = os.environ.get('REDIS_URL')
+    if not redis_url:
+        import fakeredis
+        from redis.asyncio import BlockingConnectionPool
+        redis = fakeredis.FakeAsyncRedis(
+            connection_pool_class=BlockingConnectionPool, max_connections=64)
+        # Only the endpoints passed on to Flask would connect to it
+        redis_url = 'redis://localhost'
+
+    app = create_asgi_app(config={
+        'UPSTREAM_BASE_URL': upstream_base_url,
+        'REDIS_URL': redis_url,
+        'DEBUG': False,
+    }, redis=redis)
+    server = uvicorn.Server(uvicorn.Config(
+        app, host='127.0.0.1', port=port, log_level='warning',
+        backlog=2048))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def load(base_url: str, n: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def request(client, route_id):
+        async with semaphore:
+            started_at = time.perf_counter()
+            try:
+                resp = await client.get('/api/route/{}'.format(route_id))
+            except httpx.HTTPError as e:
+                errors.append(type(e).__name__)
+                return
+            latencies.append(time.perf_counter() - started_at)
+            if resp.status_code != 200:
+                errors.append(resp.status_code)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=60) as client:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(request(client, 1000000 + i)
+                               for i in range(n)))
+        elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    return elapsed, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='Delay of the upstream stub in seconds')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    stub = start_stub(args.latency)
+    start_app('http://127.0.0.1:{}/mBus/bus/'.format(
+        stub.server_address[1]), args.port)
+
+    elapsed, latencies, errors = asyncio.run(load(
+        'http://127.0.0.1:{}'.format(args.port), args.requests,
+        args.concurrency))
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    print('requests:              {}'.format(args.requests))
+    print('errors:                {}'.format(
+        ', '.join('{} x{}'.format(k, v) for k, v in Counter(errors).items())
+        or 0))
+    print('throughput:            {:.0f} req/s'.format(
+        args.requests / elapsed))
+    print('latency p50 / p99:     {:.0f}ms / {:.0f}ms'.format(
+        percentile(0.5) * 1000, percentile(0.99) * 1000))
+    print('upstream in flight:    {} at most'.format(stub.max_in_flight))
+
+
+if __name__ == '__main__':
+    main()
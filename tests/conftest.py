@@ -1,14 +1,24 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+from urllib.parse import parse_qs
+
 import pytest
 
 from transporter import create_app, redis_store
 
+TEST_FILE_BASE_PATH = 'tests'
+#: A PostgreSQL database whose tables may be dropped, e.g.
+#: postgresql://localhost/transporter_test
+TEST_DATABASE_URI = os.environ.get('TEST_DB_URI')
+
 
 @pytest.fixture(scope='function')
 def app(request):
     """Session-wide test `Flask` application."""
     settings_override = {
         'TESTING': True,
-        # 'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URI,
+        'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URI,
     }
     app = create_app(__name__, config=settings_override,
                      template_folder='../templates')
@@ -26,18 +36,107 @@ def app(request):
     return app
 
 
-# @pytest.fixture(scope='session')
-# def db(app, request):
-#     """Session-wide test database."""
-#     if os.path.exists(TESTDB_PATH):
-#         os.unlink(TESTDB_PATH)
-#
-#     def teardown():
-#         _db.drop_all()
-#         os.unlink(TESTDB_PATH)
-#
-#     _db.app = app
-#     _db.create_all()
-#
-#     request.addfinalizer(teardown)
-#     return _db
+@pytest.fixture(scope='function')
+def db(app, request):
+    """Empty tables in the database at `TEST_DB_URI`. Tests using them are
+    skipped if it is not set."""
+    if not TEST_DATABASE_URI:
+        pytest.skip('TEST_DB_URI is not set')
+
+    from transporter.models import db as _db
+    _db.create_all()
+
+    def teardown():
+        _db.session.remove()
+        _db.drop_all()
+
+    request.addfinalizer(teardown)
+    return _db
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    """Serves fixture files in place of m.bus.go.kr. Tests can override the
+    behavior of each endpoint through `server.responders`."""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in parse_qs(
+            self.rfile.read(length).decode('utf-8')).items()}
+
+        endpoint = self.path.rsplit('/', 1)[-1]
+        self.server.requests.append((endpoint, form))
+
+        responder = self.server.responders.get(endpoint)
+        if responder is None:
+            status, body = 404, b''
+        else:
+            status, body = responder(form)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def fixture_responder(filename):
+    with open(os.path.join(TEST_FILE_BASE_PATH, filename), 'rb') as fin:
+        body = fin.read()
+    return lambda form: (200, body)
+
+
+@pytest.fixture(scope='function')
+def upstream_server(request):
+    """A local HTTP server standing in for the upstream service. The shared
+    upstream client points to it for the duration of a test."""
+    from transporter.upstream import STATION_BY_UID, ROUTE_AND_POS, \
+        CircuitBreaker, upstream
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubUpstreamHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.responders = {
+        STATION_BY_UID: fixture_responder('get_station_by_uid.json'),
+        ROUTE_AND_POS: fixture_responder('get_route_and_pos.json'),
+    }
+    server.base_url = 'http://127.0.0.1:{}/mBus/bus/'.format(
+        server.server_address[1])
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    prev_base_url = upstream.base_url
+    prev_circuit_breaker = upstream.circuit_breaker
+    upstream.base_url = server.base_url
+    upstream.circuit_breaker = CircuitBreaker()
+
+    def teardown():
+        upstream.base_url = prev_base_url
+        upstream.circuit_breaker = prev_circuit_breaker
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(teardown)
+    return server
+
+
+@pytest.fixture(scope='function')
+def fake_redis(request):
+    """Replaces the Redis client behind `redis_store` with an in-memory
+    one."""
+    import fakeredis
+    from transporter.cache import clear_local_caches
+
+    prev_client = redis_store._redis_client
+    redis_store._redis_client = fakeredis.FakeStrictRedis()
+    clear_local_caches()
+
+    def teardown():
+        redis_store._redis_client = prev_client
+        clear_local_caches()
+
+    request.addfinalizer(teardown)
+    return redis_store._redis_client
@@ -0,0 +1,202 @@
+import json
+
+from transporter.graph import TransitGraph, dump_graph, load_graph
+from transporter.journey import RouteNetwork
+from transporter.spatial import StationIndex
+from transporter.upstream import ROUTE_AND_POS, STATION_BY_POS, \
+    STATION_BY_UID
+
+
+def test_nearest_stations(app, upstream_server, fake_redis):
+    # No stations in the database, so the upstream service is asked
+    app.extensions['station_index'] = StationIndex([])
+
+    stations = {'resultList': [
+        {'arsId': '47105', 'dist': '100', 'gpsX': '127.1', 'gpsY': '37.3',
+         'stationNm': 'A'},
+        {'arsId': '47106', 'dist': '200', 'gpsX': '127.2', 'gpsY': '37.4',
+         'stationNm': 'B'},
+    ]}
+    upstream_server.responders[STATION_BY_POS] = \
+        lambda form: (200, json.dumps(stations).encode('utf-8'))
+
+    resp = app.test_client().get(
+        '/api/nearest_stations?latitude=37.3&longitude=127.1')
+    assert resp.status_code == 200
+
+    data = json.loads(resp.data.decode('utf-8'))
+    assert [s['ars_id'] for s in data['stations']] == [47105, 47106]
+
+    # Both stations share the same routes, which are fetched only once
+    endpoints = [e for e, _ in upstream_server.requests]
+    assert endpoints.count(STATION_BY_UID) == 2
+    route_ids = [f['busRouteId'] for e, f in upstream_server.requests
+                 if e == ROUTE_AND_POS]
+    assert len(route_ids) == len(set(route_ids)) == len(data['routes'])
+
+
+def test_nearest_stations_from_index(app, upstream_server, fake_redis):
+    app.extensions['station_index'] = StationIndex([
+        (1, 47105, 'A', 37.3, 127.1),
+        (2, 47106, 'B', 37.301, 127.1),
+    ])
+
+    resp = app.test_client().get(
+        '/api/nearest_stations?latitude=37.3&longitude=127.1')
+    assert resp.status_code == 200
+
+    data = json.loads(resp.data.decode('utf-8'))
+    assert [s['ars_id'] for s in data['stations']] == [47105, 47106]
+    assert STATION_BY_POS not in [e for e, _ in upstream_server.requests]
+
+    client = app.test_client()
+    for query in ('latitude=37.3', 'latitude=37.3&longitude=east'):
+        resp = client.get('/api/nearest_stations?' + query)
+        assert resp.status_code == 400
+
+
+def test_nearest_station_without_routes(app, upstream_server, fake_redis):
+    from transporter.utils import get_routes_for_station
+
+    app.extensions['station_index'] = StationIndex([
+        (1, 47105, 'A', 37.3, 127.1),
+        (2, 0, 'No routes', 37.301, 127.1),
+    ])
+    with_routes = upstream_server.responders[STATION_BY_UID]
+    upstream_server.responders[STATION_BY_UID] = lambda form: \
+        (200, b'{"resultList": null}') if form['arsId'] == '0' \
+        else with_routes(form)
+
+    resp = app.test_client().get(
+        '/api/nearest_stations?latitude=37.3&longitude=127.1')
+    assert resp.status_code == 200
+
+    data = json.loads(resp.data.decode('utf-8'))
+    assert [s['ars_id'] for s in data['stations']] == [47105]
+    assert data['routes']
+    # The failure is not cached
+    assert not fake_redis.exists(get_routes_for_station.key(0))
+
+
+def test_journey(app):
+    app.extensions['route_network'] = RouteNetwork(
+        [(1, 37.50, 127.00), (2, 37.51, 127.00), (3, 37.52, 127.00)],
+        [(10, [(1, 0), (2, 100), (3, 100)])])
+    client = app.test_client()
+
+    resp = client.get(
+        '/api/journey?origin_latitude=37.5001&origin_longitude=127.0'
+        '&destination_latitude=37.52&destination_longitude=127.0')
+    assert resp.status_code == 200
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['origins'] == [1]
+    assert [leg['route_id'] for leg in data['journeys'][0]['legs']] == [10]
+
+    assert client.get('/api/journey?origin_latitude=37.5').status_code == 400
+
+    resp = client.post('/api/journey', data=json.dumps({'pairs': [
+        [37.50, 127.00, 37.52, 127.00],
+        [37.50, 127.00, 37.51, 127.00],
+        [37.52, 127.00, 37.50, 127.00],
+        [37.00, 127.00, 37.50, 127.00],
+    ]}), content_type='application/json')
+    assert resp.status_code == 200
+    journeys = json.loads(resp.data.decode('utf-8'))['journeys']
+    assert [len(j) for j in journeys] == [1, 1, 0, 0]
+    assert journeys[0][0]['transfers'] == 0
+    assert 'legs' not in journeys[0][0]
+
+    resp = client.post('/api/journey', data=json.dumps({'pairs': [[1, 2]]}),
+                       content_type='application/json')
+    assert resp.status_code == 400
+
+
+def test_isochrone_and_matrix(app):
+    app.extensions['transit_graph'] = TransitGraph.from_rows(
+        [10, 20, 30], [(10, 20, 60.4, 1), (20, 30, 60, 1)])
+    client = app.test_client()
+
+    resp = client.get('/api/isochrone/10?budget=100')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['stations'] == [10, 20]
+    assert data['times'] == [0, 60]
+    assert client.get('/api/isochrone/99').status_code == 404
+
+    resp = client.post('/api/matrix', data=json.dumps({
+        'origins': [10, 30], 'targets': [20, 30]}),
+        content_type='application/json')
+    assert resp.status_code == 200
+    lines = [json.loads(line) for line in
+             resp.data.decode('utf-8').splitlines()]
+    assert lines == [
+        {'targets': [20, 30]},
+        {'origin': 10, 'times': [60, 120]},
+        {'origin': 30, 'times': [None, 0]},
+    ]
+
+    resp = client.post('/api/matrix', data=json.dumps({'origins': [99]}),
+                       content_type='application/json')
+    assert resp.status_code == 404
+
+
+def test_matrix_pool(app, tmpdir):
+    path = str(tmpdir.join('graph.bin'))
+    dump_graph(TransitGraph.from_rows(
+        [10, 20, 30], [(10, 20, 60, 1), (20, 30, 60, 1)]), path)
+    app.extensions['transit_graph'] = load_graph(path)
+    app.config['MATRIX_WORKERS'] = 1
+    client = app.test_client()
+
+    pools = []
+    try:
+        for _ in range(2):
+            resp = client.post('/api/matrix', data=json.dumps({
+                'origins': [10, 30]}), content_type='application/json')
+            lines = [json.loads(line) for line in
+                     resp.data.decode('utf-8').splitlines()]
+            assert sorted(lines[1:], key=lambda line: line['origin']) == [
+                {'origin': 10, 'times': [0, 120]},
+                {'origin': 30, 'times': [None, 0]},
+            ]
+            pools.append(app.extensions['matrix_pool'])
+    finally:
+        app.extensions['matrix_pool'].shutdown()
+
+    # A single pool serves every request
+    assert pools[0] is pools[1]
+
+
+def test_route_etag(app, upstream_server, fake_redis):
+    from transporter.api import route
+
+    client = app.test_client()
+
+    resp = client.get('/api/route/4940100')
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    assert 'max-age=60' in resp.headers['Cache-Control']
+    assert json.loads(resp.data.decode('utf-8'))['route_number'] == '9401'
+
+    resp = client.get('/api/route/4940100',
+                      headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+    # Served from the in-process copy even without Redis
+    fake_redis.flushall()
+    resp = client.get('/api/route/4940100')
+    assert resp.headers['ETag'] == etag
+    assert len(upstream_server.requests) == 1
+
+    # The response is built again, but has not changed
+    with app.app_context():
+        route.invalidate(route_id=4940100)
+    assert not fake_redis.exists(route.key({'route_id': 4940100}))
+    resp = client.get('/api/route/4940100', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert fake_redis.exists(route.key({'route_id': 4940100}))
+
+    resp = client.get('/api/station/47105/routes',
+                      headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
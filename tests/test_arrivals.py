@@ -0,0 +1,70 @@
+import json
+
+from transporter.arrivals import ArrivalPoller, decay_hits, hits_key, \
+    hot_stations, record_hit
+from transporter.upstream import STATION_BY_UID
+
+
+def station_requests(upstream_server):
+    return [f['arsId'] for e, f in upstream_server.requests
+            if e == STATION_BY_UID]
+
+
+def test_arrivals(app, upstream_server, fake_redis):
+    client = app.test_client()
+
+    for _ in range(3):
+        resp = client.get('/api/station/47105/arrivals')
+        assert resp.status_code == 200
+
+    arrivals = json.loads(resp.data.decode('utf-8'))['arrivals']
+    assert arrivals[0]['route_id'] == 4940100
+    assert arrivals[0]['first_arrival'] == 181
+    assert arrivals[0]['second_vehicle_id'] == 46168
+
+    # Fetched once, then served from the cache
+    assert station_requests(upstream_server) == ['47105']
+    assert fake_redis.zscore(hits_key, 47105) == 3
+
+
+def test_hot_stations(fake_redis):
+    for ars_id, hits in [(1, 5), (2, 1), (3, 3)]:
+        for _ in range(hits):
+            record_hit(ars_id)
+
+    assert hot_stations(10) == [1, 3, 2]
+    assert hot_stations(2) == [1, 3]
+    assert hot_stations(10, min_hits=2) == [1, 3]
+
+    decay_hits(0.5)
+    assert fake_redis.zscore(hits_key, 1) == 2.5
+    assert hot_stations(10, min_hits=2) == [1]
+
+    decay_hits(0.001)
+    assert fake_redis.zcard(hits_key) == 0
+
+
+def test_poller(app, upstream_server, fake_redis):
+    for _ in range(2):
+        record_hit(47105)
+    record_hit(47106)
+
+    poller = ArrivalPoller(interval=10, half_life=10, min_hits=2)
+    refreshed, failed = poller.poll()
+    assert (refreshed, failed) == ([47105], [])
+    assert station_requests(upstream_server) == ['47105']
+    assert fake_redis.zscore(hits_key, 47105) == 1
+
+    # Readers are served from the snapshot
+    resp = app.test_client().get('/api/station/47105/arrivals')
+    assert resp.status_code == 200
+    assert station_requests(upstream_server) == ['47105']
+
+    # Failures do not hold back other stations
+    record_hit(47106)
+    upstream_server.responders[STATION_BY_UID] = lambda form: (
+        (500, b'') if form['arsId'] == '47105' else
+        (200, b'{"resultList": []}'))
+    poller.min_hits = 1
+    refreshed, failed = poller.poll()
+    assert (refreshed, failed) == ([47106], [47105])
@@ -0,0 +1,141 @@
+import asyncio
+import json
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+
+@pytest.fixture
+def asgi_app(app, upstream_server, fake_redis):
+    import fakeredis
+    from transporter.asgi import create_asgi_app
+    from transporter.spatial import StationIndex
+    from transporter.upstream import async_upstream
+
+    # Both serving modes share the same cache
+    server = fake_redis.connection_pool.connection_kwargs['server']
+    asgi_app = create_asgi_app(
+        config={'TESTING': True,
+                'UPSTREAM_BASE_URL': upstream_server.base_url},
+        redis=fakeredis.FakeAsyncRedis(server=server))
+    asgi_app.app.extensions['station_index'] = StationIndex([])
+
+    yield asgi_app
+
+    async_upstream.base_url = upstream_server.base_url
+    asgi_app.executor.shutdown()
+
+
+def run(asgi_app, *requests):
+    """Sends requests concurrently and returns the responses in order. Each
+    request is a `(method, url)` or `(method, url, kwargs)` tuple."""
+    async def send_all():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://test') as client:
+            try:
+                return await asyncio.gather(
+                    *(client.request(*r[:2], **dict(*r[2:]))
+                      for r in requests))
+            finally:
+                await asgi_app.aclose()
+    return asyncio.run(send_all())
+
+
+def test_route(app, asgi_app, upstream_server):
+    resp, = run(asgi_app, ('GET', '/api/route/4940100'))
+    assert resp.status_code == 200
+    assert resp.json()['route_number'] == '9401'
+    assert 'max-age=60' in resp.headers['cache-control']
+
+    # Same body and ETag as the Flask endpoint, from the same cache entry
+    flask_resp = app.test_client().get('/api/route/4940100')
+    assert flask_resp.data == resp.content
+    assert flask_resp.headers['ETag'] == resp.headers['etag']
+    assert len(upstream_server.requests) == 1
+
+    resp, = run(asgi_app, ('GET', '/api/route/4940100', {
+        'headers': {'If-None-Match': resp.headers['etag']}}))
+    assert resp.status_code == 304
+
+
+def test_nearest_stations(asgi_app, upstream_server):
+    from transporter.upstream import ROUTE_AND_POS, STATION_BY_POS
+
+    stations = {'resultList': [
+        {'arsId': '47105', 'dist': '100', 'gpsX': '127.1', 'gpsY': '37.3',
+         'stationNm': 'A'},
+        {'arsId': '47106', 'dist': '200', 'gpsX': '127.2', 'gpsY': '37.4',
+         'stationNm': 'B'},
+    ]}
+    upstream_server.responders[STATION_BY_POS] = \
+        lambda form: (200, json.dumps(stations).encode('utf-8'))
+
+    responses = run(
+        asgi_app,
+        *[('GET', '/api/nearest_stations?latitude=37.3&longitude=127.1')] * 5)
+    assert all(r.status_code == 200 for r in responses)
+    data = responses[0].json()
+    assert [s['ars_id'] for s in data['stations']] == [47105, 47106]
+    assert all(r.json() == data for r in responses)
+
+    # Concurrent requests wait for each other instead of fetching a route
+    # again
+    route_ids = [f['busRouteId'] for e, f in upstream_server.requests
+                 if e == ROUTE_AND_POS]
+    assert len(route_ids) == len(set(route_ids)) == len(data['routes'])
+
+    resp, = run(asgi_app, ('GET', '/api/nearest_stations?latitude=37.3'))
+    assert resp.status_code == 400
+
+
+def test_nearest_station_without_routes(asgi_app, upstream_server):
+    from transporter.spatial import StationIndex
+    from transporter.upstream import STATION_BY_UID
+
+    asgi_app.app.extensions['station_index'] = StationIndex([
+        (1, 47105, 'A', 37.3, 127.1),
+        (2, 0, 'No routes', 37.301, 127.1),
+    ])
+    with_routes = upstream_server.responders[STATION_BY_UID]
+    upstream_server.responders[STATION_BY_UID] = lambda form: \
+        (200, b'{"resultList": []}') if form['arsId'] == '0' \
+        else with_routes(form)
+
+    resp, = run(asgi_app,
+                ('GET', '/api/nearest_stations?latitude=37.3&longitude=127.1'))
+    assert resp.status_code == 200
+    assert [s['ars_id'] for s in resp.json()['stations']] == [47105]
+    assert resp.json()['routes']
+
+
+def test_upstream_error(asgi_app, upstream_server):
+    from transporter.upstream import ROUTE_AND_POS
+
+    upstream_server.responders[ROUTE_AND_POS] = lambda form: (404, b'')
+    resp, = run(asgi_app, ('GET', '/api/route/1'))
+    assert resp.status_code == 502
+    assert 'error' in resp.json()
+
+
+def test_passed_to_flask(asgi_app):
+    resp, = run(asgi_app, ('POST', '/api/journey', {
+        'json': {'pairs': [[1, 2]]}}))
+    assert resp.status_code == 400
+    assert 'error' in resp.json()
+
+
+def test_streamed_concurrently(asgi_app):
+    from transporter.graph import TransitGraph
+
+    asgi_app.app.extensions['transit_graph'] = TransitGraph.from_rows(
+        [10, 20, 30], [(10, 20, 60, 1), (20, 30, 60, 1)])
+
+    # Each response is generated within its own request context
+    responses = run(asgi_app, *[('POST', '/api/matrix', {
+        'json': {'origins': [10, 20, 30]}})] * 20)
+    assert all(r.status_code == 200 for r in responses)
+    assert all(r.text == responses[0].text for r in responses)
+    lines = [json.loads(line) for line in responses[0].text.splitlines()]
+    assert lines[1] == {'origin': 10, 'times': [0, 60, 120]}
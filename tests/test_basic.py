@@ -1,6 +1,10 @@
 import json
 import os
 
+import pytest
+
+from transporter.upstream import UpstreamError
+
 TEST_FILE_BASE_PATH = 'tests'
 
 
@@ -68,3 +72,27 @@ def test_route_mapper():
         target_dict = mapper.transform(source_dict)
 
         assert 'route_type' in target_dict
+
+
+def test_mappers_accept_generators():
+    from transporter.utils import RouteMapper, RoutesForStationMapper, \
+        compile_mapper
+
+    for filename, mapper in (('get_route_and_pos.json', RouteMapper()),
+                             ('get_station_by_uid.json',
+                              RoutesForStationMapper())):
+        path = os.path.join(TEST_FILE_BASE_PATH, filename)
+        with open(path) as fin:
+            source_dict = json.loads(fin.read())
+
+        expected = mapper.transform(source_dict)
+        assert mapper.transform_results(
+            e for e in source_dict['resultList']) == expected
+        assert len(expected['entries']) == len(source_dict['resultList'])
+        with pytest.raises(UpstreamError):
+            mapper.transform_results(iter([]))
+
+        entry = expected['entries'][0]
+        assert isinstance(entry, mapper.entry_record)
+        assert entry.as_dict() == compile_mapper(mapper.mapper)(
+            source_dict['resultList'][0])
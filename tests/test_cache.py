@@ -0,0 +1,149 @@
+import threading
+import time
+
+from transporter.cache import cached, make_key
+
+
+def make_counted(namespace, ttl=60, delay=0):
+    calls = []
+
+    @cached(namespace, ttl=ttl)
+    def square(x):
+        calls.append(x)
+        time.sleep(delay)
+        return {'value': x * x}
+
+    return square, calls
+
+
+def test_make_key():
+    assert make_key('ns', (1, 'a')) == make_key('ns', (1, 'a'), {})
+    assert make_key('ns', (1,)) != make_key('ns', ('1',))
+    assert make_key('ns', (), {'a': 1, 'b': 2}) == \
+        make_key('ns', (), {'b': 2, 'a': 1})
+
+
+def test_cached(fake_redis):
+    square, calls = make_counted('square', ttl=60)
+
+    assert square(3) == {'value': 9}
+    assert square(3) == {'value': 9}
+    assert calls == [3]
+    assert 0 < fake_redis.ttl(square.key(3)) <= 60
+
+    square.invalidate(3)
+    assert square(3) == {'value': 9}
+    assert calls == [3, 3]
+
+
+def test_get_many(fake_redis):
+    square, calls = make_counted('square')
+
+    square(2)
+    assert square.get_many([(1,), (2,), (3,)]) == \
+        [{'value': 1}, {'value': 4}, {'value': 9}]
+    assert sorted(calls) == [1, 2, 3]
+
+    assert square.get_many([(3,), (1,)]) == [{'value': 9}, {'value': 1}]
+    assert len(calls) == 3
+
+
+def test_single_flight(fake_redis):
+    square, calls = make_counted('square', delay=0.2)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(square(5)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [5]
+    assert results == [{'value': 25}] * 5
+
+
+def test_get_many_waits_once(fake_redis):
+    square = cached('square', ttl=60, wait_timeout=0.3)(lambda x: x * x)
+
+    # Others are fetching these values but never store them
+    for x in (1, 2, 3):
+        fake_redis.set(square._lock_key(square.key(x)), b'other')
+
+    started = time.monotonic()
+    assert square.get_many([(1,), (2,), (3,)]) == [1, 4, 9]
+    # A single timeout for all values being waited for
+    assert time.monotonic() - started < 0.6
+
+
+def test_lru_cache():
+    from transporter.cache import LRUCache
+
+    cache = LRUCache(max_entries=2, max_bytes=10, ttl=60)
+    cache.set('a', 1, 4)
+    cache.set('b', 2, 4)
+    assert cache.get('a') == 1
+
+    # 'b' is the least recently used
+    cache.set('c', 3, 4)
+    assert cache.get('b') is None
+    assert len(cache) == 2
+
+    # Exceeds the size limit
+    cache.set('d', 4, 8)
+    assert cache.get('a') is None
+    assert cache.get('d') == 4
+    assert cache.stats() == {'entries': 1, 'bytes': 8, 'hits': 2,
+                             'misses': 2}
+
+    cache.ttl = -1
+    cache.set('e', 5, 1)
+    assert cache.get('e') is None
+
+
+def test_cached_with_local_cache(fake_redis):
+    from transporter.cache import LRUCache
+
+    local = LRUCache()
+    calls = []
+
+    @cached('square', ttl=60, local=local)
+    def square(x):
+        calls.append(x)
+        return {'value': x * x}
+
+    assert square(2) == {'value': 4}
+    fake_redis.flushall()
+
+    # Served without Redis
+    assert square(2) == {'value': 4}
+    assert square.get_many([(2,)]) == [{'value': 4}]
+    assert calls == [2]
+    assert local.hits == 2
+
+    square.invalidate(2)
+    assert square(2) == {'value': 4}
+    assert calls == [2, 2]
+
+
+def test_raw(fake_redis):
+    from transporter.cache import LRUCache
+    from transporter.serialization import RawJSON, loads
+
+    square, calls = make_counted('square')
+
+    # Fetched, then read from Redis without being decoded
+    for _ in range(2):
+        value = square.raw(3)
+        assert isinstance(value, RawJSON)
+        assert loads(value.data) == {'value': 9}
+    assert calls == [3]
+
+    values = square.get_many([(3,), (4,)], raw=True)
+    assert [loads(v.data) for v in values] == [{'value': 9}, {'value': 16}]
+    assert calls == [3, 4]
+
+    square.local = LRUCache()
+    assert square(5) == {'value': 25}
+    fake_redis.flushall()
+    assert square.raw(5) == RawJSON(b'{"value":25}')
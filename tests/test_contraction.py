@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from transporter.contraction import ContractionHierarchy, dump_hierarchy, \
+    load_hierarchy
+from transporter.graph import TransitGraph
+from transporter.routing import inf
+
+
+def make_graph(n=300, seed=0):
+    """A grid-like graph with a few long-distance arcs."""
+    rng = random.Random(seed)
+    width = 20
+    arcs = []
+    for u in range(n):
+        for v in (u + 1, u - 1, u + width, u - width):
+            if 0 <= v < n and rng.random() < 0.9:
+                arcs.append((u, v, rng.randint(30, 300), None))
+        if rng.random() < 0.05:
+            arcs.append((u, rng.randrange(n), rng.randint(300, 900), None))
+    arcs.sort(key=lambda x: x[0])
+    return TransitGraph.from_rows(range(n), arcs)
+
+
+def assert_valid_path(graph, path, cost):
+    total = 0
+    for u, v in zip(path, path[1:]):
+        total += min(c for w, c in graph.neighbors(graph.index[u])
+                     if w == graph.index[v])
+    assert total == pytest.approx(cost)
+
+
+def test_query():
+    graph = make_graph()
+    hierarchy = ContractionHierarchy.build(graph)
+
+    rng = random.Random(1)
+    for _ in range(50):
+        s, t = rng.randrange(len(graph)), rng.randrange(len(graph))
+        expected, _ = graph.shortest_path(s, t)
+        cost, path, settled = hierarchy.query(s, t)
+
+        assert cost == pytest.approx(expected)
+        if expected < inf:
+            assert path[0] == s and path[-1] == t
+            assert_valid_path(graph, path, cost)
+        else:
+            assert path == []
+
+
+def test_rebuild_with_previous_order(tmpdir):
+    hierarchy = ContractionHierarchy.build(make_graph(n=200))
+    path = str(tmpdir.join('hierarchy.bin'))
+    dump_hierarchy(hierarchy, path, signature=1)
+    previous = load_hierarchy(path, signature=1)
+
+    graph = make_graph(n=260)
+    rebuilt = ContractionHierarchy.build(graph, previous)
+
+    rng = random.Random(2)
+    for _ in range(30):
+        s, t = rng.randrange(len(graph)), rng.randrange(len(graph))
+        expected, _ = graph.shortest_path(s, t)
+        assert rebuilt.query(s, t)[0] == pytest.approx(expected)
@@ -0,0 +1,208 @@
+import zlib
+
+import pytest
+
+from transporter.graph import GraphFileError, StaleGraphError, \
+    TransitGraph, default_average_time, dump_graph, graph_signature, \
+    in_service, load_graph, make_service_windows, min_average_time
+
+
+def make_graph(service_windows=None):
+    station_ids = [10, 20, 30, 40]
+    arcs = [
+        (10, 20, 60, 1),
+        (10, 30, 300, 2),
+        (20, 30, 60, 1),
+        (30, 40, None, None),
+        (30, 99, 60, 2),  # Unknown station
+    ]
+    coordinates = [
+        (37.5600, 126.9700),
+        (37.5610, 126.9750),
+        (37.5620, 126.9800),
+        (None, None),
+    ]
+    return TransitGraph.from_rows(station_ids, arcs, coordinates,
+                                  service_windows)
+
+
+def test_from_rows():
+    graph = make_graph()
+
+    assert len(graph) == 4
+    assert graph.arc_count == 4
+    assert list(graph.offsets) == [0, 2, 3, 4, 4]
+    assert sorted(graph.neighbors(graph.index[10])) == [(1, 60), (2, 300)]
+    assert list(graph.neighbors(graph.index[40])) == []
+    assert list(graph.route_ids) == [1, 2]
+    assert graph.routes[graph.offsets[2]] == -1
+    assert graph.weights[graph.offsets[2]] == default_average_time
+
+
+def test_find_arc():
+    graph = make_graph()
+
+    assert graph.find_arc(10, 20) == 0
+    assert graph.find_arc(10, 30, route_id=2) == 1
+    assert graph.find_arc(20, 30, route_id=2) == 2
+    assert graph.find_arc(20, 10) is None
+    assert graph.find_arc(10, 99) is None
+
+
+def test_shortest_path():
+    graph = make_graph()
+
+    cost, path = graph.shortest_path(10, 40)
+    assert cost == 120 + default_average_time
+    assert path == [10, 20, 30, 40]
+
+    cost, path = graph.shortest_path(40, 10)
+    assert cost == float('inf')
+    assert path == []
+
+
+def test_shortest_path_with_heuristic():
+    graph = make_graph()
+
+    assert graph.has_coordinates
+    assert graph.max_speed > 0
+    # No arc is faster than the maximum speed, so the heuristic is admissible
+    h = graph.heuristic(graph.index[30])
+    assert h(graph.index[10]) <= 120
+    assert h(graph.index[20]) <= 60
+    assert h(graph.index[40]) == 0
+
+    for source in (10, 20, 30, 40):
+        for target in (10, 20, 30, 40):
+            assert graph.shortest_path(source, target) == \
+                graph.shortest_path(source, target, heuristic=False)
+
+    graph = TransitGraph.from_rows([10, 20], [(10, 20, 60, 1)])
+    assert not graph.has_coordinates
+    assert graph.max_speed == 0
+    assert graph.shortest_path(10, 20) == (60, [10, 20])
+
+
+def test_in_service():
+    # Route 1 runs from 05:00 to 23:00, route 2 from 04:30 to 00:50 the next
+    # day and the hours of route 3 are unknown
+    windows = make_service_windows([1, 2, 3], {
+        1: (18000, 82800), 2: (16200, 89400), 3: (None, None)})
+    assert list(windows) == [18000, 82800, 16200, 89400, -1, -1]
+
+    assert in_service(windows, 0, 18000)
+    assert not in_service(windows, 0, 3600)
+    assert not in_service(windows, 0, 83000)
+    assert in_service(windows, 1, 2400)
+    assert in_service(windows, 1, 86400 + 2400)
+    assert not in_service(windows, 1, 3600)
+    assert in_service(windows, 2, 3600)
+    # Arcs without a route and graphs without service hours
+    assert in_service(windows, -1, 3600)
+    assert in_service(make_service_windows([], {}), 0, 3600)
+
+
+def test_shortest_path_with_departure():
+    # Route 1 does not run at night
+    graph = make_graph({1: (18000, 82800), 2: (0, 86400)})
+
+    assert graph.shortest_path(10, 40, departure=28800) == \
+        (120 + default_average_time, [10, 20, 30, 40])
+    assert graph.shortest_path(10, 40, departure=3600) == \
+        (300 + default_average_time, [10, 30, 40])
+    # Route 1 stops running on the way
+    assert graph.shortest_path(10, 30, departure=82780) == \
+        (300, [10, 30])
+
+    cost, path = graph.shortest_path(20, 30, departure=3600)
+    assert cost == float('inf')
+    assert path == []
+
+
+def test_shortest_path_with_zero_weights():
+    # 3 -> 2 appears to take no time, and is given `min_average_time`
+    graph = TransitGraph.from_rows(
+        [1, 2, 3], [(1, 2, 140, 1), (1, 3, 100, 1), (3, 2, 0, 1)],
+        [(37.5, 127.0), (37.5, 127.0113), (37.5, 127.0226)])
+
+    assert list(graph.weights) == [140, 100, min_average_time]
+    assert 30 < graph.max_speed < 40
+    assert graph.shortest_path(1, 2) == (130, [1, 3, 2])
+    assert graph.shortest_path(1, 2) == \
+        graph.shortest_path(1, 2, heuristic=False)
+
+
+def test_dump_and_load_graph(tmpdir):
+    graph = make_graph({1: (18000, 82800)})
+    path = str(tmpdir.join('graph.bin'))
+    dump_graph(graph, path, signature=42)
+
+    loaded = load_graph(path, signature=42)
+    for name in ('station_ids', 'offsets', 'targets', 'weights', 'routes',
+                 'route_ids', 'service_windows'):
+        assert list(getattr(loaded, name)) == list(getattr(graph, name))
+    assert list(loaded.longitudes)[:3] == list(graph.longitudes)[:3]
+    assert loaded.max_speed == graph.max_speed
+    assert loaded.shortest_path(10, 40) == graph.shortest_path(10, 40)
+
+    with pytest.raises(StaleGraphError):
+        load_graph(path, signature=43)
+
+    with open(path, 'r+b') as f:
+        f.seek(-1, 2)
+        last = f.read(1)[0]
+        f.seek(-1, 2)
+        f.write(bytes([last ^ 0xff]))
+    with pytest.raises(GraphFileError):
+        load_graph(path)
+
+    # e.g. an export that was interrupted
+    open(path, 'wb').close()
+    with pytest.raises(GraphFileError):
+        load_graph(path)
+
+
+def test_graph_signature(db):
+    from transporter.models import Edge, Route, Station
+
+    db.session.execute(Station.__table__.insert(), [
+        {'id': i, 'name': str(i)} for i in range(1, 7)])
+    db.session.execute(Route.__table__.insert(), [
+        {'id': i} for i in (100, 200, 300)])
+    db.session.execute(Edge.__table__.insert(), [
+        {'id': i, 'start': i, 'end': i + 1} for i in range(1, 6)])
+    db.session.commit()
+
+    # Each table is counted on its own
+    signature = graph_signature()
+    assert signature == zlib.crc32(
+        repr((3, 300, 5, 5, 0, None, None, None)).encode('ascii'))
+
+    # Service hours are stored in graph files as well
+    db.session.execute(Route.__table__.update().where(Route.id == 100)
+                       .values(first_time=18000, last_time=82800))
+    db.session.commit()
+    assert graph_signature() != signature
+
+
+def test_from_db(db):
+    from transporter.models import Edge, Route, Station, route_edge_assoc
+
+    db.session.execute(Station.__table__.insert(), [
+        {'id': i, 'name': str(i)} for i in (1, 2, 3)])
+    db.session.execute(Route.__table__.insert(), [
+        {'id': i} for i in (100, 200, 300)])
+    db.session.execute(Edge.__table__.insert(), [
+        {'id': 5, 'start': 1, 'end': 3, 'average_time': 60},
+        {'id': 2, 'start': 1, 'end': 2, 'average_time': 60}])
+    db.session.execute(route_edge_assoc.insert(), [
+        {'route_id': 200, 'edge_id': 5}, {'route_id': 300, 'edge_id': 2},
+        {'route_id': 100, 'edge_id': 5}])
+    db.session.commit()
+
+    # Arcs are ordered by edge and route, whatever the order of the rows
+    graph = TransitGraph.from_db()
+    assert [(graph.station_ids[graph.targets[a]],
+             graph.route_ids[graph.routes[a]])
+            for a in graph.arcs(graph.index[1])] == \
+        [(2, 300), (3, 100), (3, 200)]
@@ -0,0 +1,105 @@
+import json
+import os
+
+from transporter.ingest import RouteDiff, route_rows, update_batch, \
+    write_batch
+
+TEST_FILE_BASE_PATH = 'tests'
+
+
+def load_raw():
+    path = os.path.join(TEST_FILE_BASE_PATH, 'get_route_and_pos.json')
+    with open(path) as fin:
+        return json.loads(fin.read())
+
+
+def test_route_rows():
+    raw = load_raw()
+    rows = route_rows(raw)
+
+    assert rows.route['id'] == 4940100
+    assert rows.route['number'] == '9401'
+    # From 04:31 to 00:49 the next day
+    assert (rows.route['first_time'], rows.route['last_time']) == \
+        (16260, 89340)
+    assert len(rows.stations) == len(raw['resultList'])
+    assert len(rows.edges) == len(rows.stations) - 1
+
+    for (start, end, average_time), s1, s2 in zip(
+            rows.edges, rows.stations, rows.stations[1:]):
+        assert (start, end) == (s1['id'], s2['id'])
+        assert average_time >= 0
+
+
+def test_topology_hash():
+    raw = load_raw()
+    topology_hash = route_rows(raw).route['topology_hash']
+    assert len(topology_hash) == 40
+
+    # Vehicle positions and speeds do not count
+    for entry in raw['resultList']:
+        entry['existYn'] = 'N'
+        entry['sectSpd'] = '0'
+    assert route_rows(raw).route['topology_hash'] == topology_hash
+
+    raw['resultList'][3]['stationNm'] += ' (renamed)'
+    assert route_rows(raw).route['topology_hash'] != topology_hash
+
+
+def test_route_diff():
+    raw = load_raw()
+    rows = route_rows(raw)
+    stations = [s['id'] for s in rows.stations]
+    edges = {(s, e) for s, e, _ in rows.edges}
+
+    diff = RouteDiff(stations, edges, rows)
+    assert not diff
+
+    # A station is dropped from the middle of the route
+    del raw['resultList'][3]
+    diff = RouteDiff(stations, edges, route_rows(raw))
+    assert diff
+
+    dropped = stations[3]
+    assert diff.removed_stations == [(dropped, 3)]
+    assert diff.added_stations == []
+    # Stations after it move up by one
+    assert diff.shifted_stations == [(4, len(stations) - 1, -1)]
+    assert diff.added_edges == {(stations[2], stations[4])}
+    assert diff.removed_edges == {(stations[2], dropped),
+                                  (dropped, stations[4])}
+
+
+def test_update_batch(db, fake_redis):
+    from transporter.models import Edge, Route, Station, route_station_assoc
+
+    raw = load_raw()
+    rows = route_rows(raw)
+    assert write_batch([rows]) == (1, len(rows.stations), len(rows.edges))
+    stations = [s['id'] for s in rows.stations]
+
+    # A station is renamed, another is dropped and the route runs longer
+    raw['resultList'][1]['stationNm'] = 'Renamed'
+    del raw['resultList'][3]
+    raw['resultList'][-1]['lastTm'] = '01:30'
+    changed = route_rows(raw)
+    assert changed.route['topology_hash'] != rows.route['topology_hash']
+    assert update_batch([changed]) == (0, 1)
+
+    route = Route.query.get(rows.route['id'])
+    assert route.topology_hash == changed.route['topology_hash']
+    assert route.last_time == 91800
+    assert Station.query.get(stations[1]).name == 'Renamed'
+
+    assoc = db.session.query(
+        route_station_assoc.c.station_id, route_station_assoc.c.sequence) \
+        .filter(route_station_assoc.c.route_id == route.id) \
+        .order_by(route_station_assoc.c.sequence).all()
+    assert assoc == [(s, i) for i, s in
+                     enumerate(stations[:3] + stations[4:])]
+    assert {(e.start, e.end) for e in route.edges} == \
+        {(s, e) for s, e, _ in changed.edges}
+
+    # The dropped station and its edges are kept for other routes
+    assert Station.query.get(stations[3]) is not None
+    assert Edge.query.filter_by(start=stations[2], end=stations[3]).count()
@@ -0,0 +1,183 @@
+from heapq import heappop, heappush
+import random
+
+import pytest
+
+from transporter.graph import make_service_windows
+from transporter.journey import JourneyPlanner, RouteNetwork
+
+
+@pytest.fixture
+def network():
+    # Stations are about 1 km apart from each other, except for 5 which is
+    # within walking distance of 4
+    stations = [
+        (1, 37.50, 127.00),
+        (2, 37.51, 127.00),
+        (3, 37.52, 127.00),
+        (4, 37.52, 127.01),
+        (5, 37.5205, 127.0105),
+        (6, 37.60, 127.10),
+    ]
+    routes = [
+        (10, [(1, 0), (2, 100), (3, 100)]),
+        (20, [(3, 0), (4, 100)]),
+        (30, [(1, 0), (6, 500), (4, 500)]),
+    ]
+    return RouteNetwork(stations, routes, transfer_radius=200,
+                        walking_speed=1.0)
+
+
+def test_route_network(network):
+    assert len(network) == 6
+    assert list(network.route_ids) == [10, 20, 30]
+    assert list(network.times) == [0, 100, 200, 0, 100, 0, 500, 1000]
+
+    p3 = network.index[3]
+    assert sorted(network.routes_at(p3)) == [(0, 2), (1, 0)]
+
+    p4, p5 = network.index[4], network.index[5]
+    assert [q for q, _ in network.transfers(p4)] == [p5]
+    assert [q for q, _ in network.transfers(p5)] == [p4]
+
+
+def test_plan(network):
+    planner = JourneyPlanner(network, boarding_time=300)
+    journeys = planner.plan(1, 4)
+
+    assert [(j.arrival, j.transfers) for j in journeys] == \
+        [(1300, 0), (900, 1)]
+
+    legs = journeys[1].legs
+    assert [(leg.route_id, leg.start, leg.end) for leg in legs] == \
+        [(10, 1, 3), (20, 3, 4)]
+    assert [(leg.departure, leg.arrival) for leg in legs] == \
+        [(300, 500), (800, 900)]
+
+
+def test_plan_with_service_windows(network):
+    # Route 20 does not run at night
+    network.service_windows = make_service_windows(
+        network.route_ids, {20: (18000, 82800)})
+    planner = JourneyPlanner(network, boarding_time=300)
+
+    journeys = planner.plan(1, 4, departure=28800)
+    assert [(j.arrival - 28800, j.transfers) for j in journeys] == \
+        [(1300, 0), (900, 1)]
+
+    journeys = planner.plan(1, 4, departure=3600)
+    assert [(j.arrival - 3600, j.transfers) for j in journeys] == [(1300, 0)]
+
+    # Without a departure time, service hours are ignored
+    assert len(planner.plan(1, 4)) == 2
+
+
+def test_plan_with_walking(network):
+    planner = JourneyPlanner(network, boarding_time=300)
+    journeys = planner.plan(1, 5, departure=1000)
+
+    assert len(journeys) == 2
+    legs = journeys[-1].legs
+    assert [(leg.mode, leg.start, leg.end) for leg in legs] == \
+        [('bus', 1, 3), ('bus', 3, 4), ('walk', 4, 5)]
+    assert 1900 < journeys[-1].arrival < 2000
+
+
+def test_search_reused_for_many_destinations(network):
+    planner = JourneyPlanner(network, boarding_time=300, max_rounds=1)
+    state = planner.search({1: 0})
+
+    assert [j.arrival for j in planner.journeys(state, {3: 0})] == [500]
+    assert [j.arrival for j in planner.journeys(state, {4: 0})] == [1300]
+    assert planner.journeys(state, {2: 60, 3: 0})[0].arrival == 460
+    assert planner.journeys(state, {6: 0})[0].legs[0].route_id == 30
+
+
+def test_plan_many(network):
+    planner = JourneyPlanner(network, boarding_time=300)
+    queries = [
+        ({1: 0}, {4: 0}),
+        ({1: 0}, {3: 0}),
+        ({2: 0}, {3: 0}),
+        ({1: 0}, {}),
+    ]
+    results = planner.plan_many(queries)
+
+    assert [[j.arrival for j in r] for r in results] == \
+        [[1300, 900], [500], [400], []]
+    for (origins, targets), journeys in zip(queries[:3], results):
+        expected = planner.journeys(planner.search(origins), targets)
+        assert [j.arrival for j in journeys] == [j.arrival for j in expected]
+
+
+def test_access(network):
+    access = network.access(37.5205, 127.0105, 100)
+    assert list(access) == [5, 4]
+    assert access[5] == 0
+    assert 60 < access[4] < 80
+
+
+def brute_force(network, origin, destination, boarding_time, max_rounds):
+    """Earliest arrival at `destination` with up to `k` rides for each `k`,
+    by searching all `(station, rides, walked)` states. At most one walk
+    follows the origin or each ride."""
+    offsets, stops, times = \
+        network.route_offsets, network.stops, network.times
+    earliest = {}
+    queue = [(0, network.index[origin], 0, False)]
+    while queue:
+        t, p, k, walked = heappop(queue)
+        if (p, k, walked) in earliest:
+            continue
+        earliest[p, k, walked] = t
+        if not walked:
+            for q, walking_time in network.transfers(p):
+                heappush(queue, (t + walking_time, q, k, True))
+        if k == max_rounds:
+            continue
+        for r, i in network.routes_at(p):
+            for j in range(offsets[r] + i + 1, offsets[r + 1]):
+                heappush(queue, (t + boarding_time + times[j] -
+                                 times[offsets[r] + i], stops[j], k + 1,
+                                 False))
+
+    p = network.index[destination]
+    return [min((t for (q, rides, _), t in earliest.items()
+                 if q == p and rides <= k), default=float('inf'))
+            for k in range(max_rounds + 1)]
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_plan_against_brute_force(seed):
+    rand = random.Random(seed)
+    # Stations within a few hundred meters, so that many can be walked to
+    stations = [(i, 37.5 + rand.random() * 0.005,
+                 127.0 + rand.random() * 0.005) for i in range(1, 9)]
+    routes = [(r, [(s, rand.randint(30, 300))
+                   for s in rand.sample(range(1, 9), rand.randint(2, 5))])
+              for r in range(10, 15)]
+    network = RouteNetwork(stations, routes, transfer_radius=300,
+                           walking_speed=1.0)
+    planner = JourneyPlanner(network, boarding_time=60, max_rounds=3)
+
+    for origin, destination in [(1, 2), (3, 4), (5, 6), (7, 8)]:
+        journeys = planner.plan(origin, destination)
+
+        expected = []
+        for arrival in brute_force(network, origin, destination, 60, 3):
+            if arrival < min(expected, default=float('inf')):
+                expected.append(arrival)
+        assert [j.arrival for j in journeys] == pytest.approx(expected)
+
+        for journey in journeys:
+            legs = journey.legs
+            assert [leg.end for leg in legs[:-1]] == \
+                [leg.start for leg in legs[1:]]
+            assert not any(a.mode == b.mode == 'walk'
+                           for a, b in zip(legs, legs[1:]))
+            assert all(a.arrival <= b.departure + 1e-3
+                       for a, b in zip(legs, legs[1:]))
+            if legs:
+                assert legs[0].start == origin
+                assert legs[-1].end == destination
+                assert legs[-1].arrival == pytest.approx(journey.arrival)
@@ -0,0 +1,101 @@
+import pytest
+
+from transporter.graph import GraphFileError, TransitGraph
+from transporter.profiles import RouteTracker, TravelTimeProfiles, \
+    dump_profiles, load_profiles, time_of_day
+
+
+def make_graph():
+    return TransitGraph.from_rows([1, 2, 3], [
+        (1, 2, 100, 10),
+        (1, 3, 300, 20),
+        (2, 3, 100, 10),
+    ])
+
+
+def test_time_of_day():
+    # The epoch was at 9 am in Seoul
+    assert time_of_day(0) == 9 * 3600
+    assert time_of_day(15 * 3600 + 61) == 61
+
+
+def test_weight():
+    graph = make_graph()
+    profiles = TravelTimeProfiles(graph, bucket_size=3600, min_count=2)
+
+    # Too few observations
+    assert profiles.observe(0, 8 * 3600 + 10, 400)
+    assert profiles.weight(0, 8 * 3600) == 100
+
+    assert profiles.observe(0, 8 * 3600 + 20, 200)
+    assert profiles.weight(0, 8 * 3600 + 1800) == 300
+    # Other hours are not affected
+    assert profiles.weight(0, 9 * 3600) == 100
+    assert profiles.weight(0, 32 * 3600) == 300
+
+    assert not profiles.observe(0, 8 * 3600, 0)
+    assert not profiles.observe(0, 8 * 3600, 24 * 3600)
+    assert profiles.counts[profiles._slot(0, 8 * 3600)] == 2
+
+
+def test_moving_average():
+    profiles = TravelTimeProfiles(make_graph(), min_count=1, max_count=4)
+    for _ in range(4):
+        profiles.observe(0, 0, 100)
+    profiles.observe(0, 0, 500)
+
+    assert profiles.weight(0, 0) == 200
+    assert profiles.counts[0] == 4
+
+
+def test_shortest_path():
+    profiles = TravelTimeProfiles(make_graph(), bucket_size=3600,
+                                  min_count=1)
+    # Congestion between 1 and 2 in the morning
+    profiles.observe(0, 8 * 3600, 500)
+
+    assert profiles.shortest_path(1, 3, 7 * 3600) == (200, [1, 2, 3])
+    assert profiles.shortest_path(1, 3, 8 * 3600) == (300, [1, 3])
+    assert profiles.shortest_path(3, 1, 8 * 3600)[1] == []
+
+
+def test_route_tracker():
+    profiles = TravelTimeProfiles(make_graph(), bucket_size=3600,
+                                  min_count=1)
+    tracker = RouteTracker(profiles, 10)
+
+    assert tracker.update([{'seq': 1, 'station_id': 1}], 1000) == 0
+    assert tracker.update([{'seq': 1, 'station_id': 1}], 1030) == 0
+    # The bus moved on to the next station
+    assert tracker.update([{'seq': 2, 'station_id': 2}], 1120) == 1
+    assert profiles.weight(0, 1000) == 120
+
+    # Another bus showing up at the first station is not a move
+    assert tracker.update([{'seq': 1, 'station_id': 1},
+                           {'seq': 2, 'station_id': 2}], 1150) == 0
+    assert tracker.update([{'seq': 2, 'station_id': 2},
+                           {'seq': 3, 'station_id': 3}], 1300) == 0
+
+
+def test_dump_and_load_profiles(tmpdir):
+    graph = make_graph()
+    profiles = TravelTimeProfiles(graph, bucket_size=3600, min_count=1)
+    profiles.observe(2, 3600, 80)
+
+    path = str(tmpdir.join('profiles.bin'))
+    dump_profiles(profiles, path, signature=7)
+
+    loaded = load_profiles(path, graph, signature=7)
+    assert loaded.bucket_size == 3600
+    assert loaded.weight(2, 3600) == 80
+    with pytest.raises(TypeError):
+        loaded.observe(2, 3600, 80)
+
+    loaded = load_profiles(path, graph, writable=True)
+    loaded.observe(2, 3600, 120)
+    assert loaded.weight(2, 3600) == 100
+
+    with pytest.raises(GraphFileError):
+        load_profiles(path, graph, signature=8)
+    with pytest.raises(GraphFileError):
+        load_profiles(path, TransitGraph.from_rows([1, 2], [(1, 2, 1, 1)]))
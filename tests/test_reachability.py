@@ -0,0 +1,61 @@
+from transporter.graph import TransitGraph, dump_graph, load_graph
+from transporter.reachability import MatrixPool, isochrone, \
+    travel_time_rows
+from transporter.routing import inf
+
+
+def make_graph():
+    station_ids = [10, 20, 30, 40, 50]
+    arcs = [
+        (10, 20, 60, 1),
+        (20, 30, 60, 1),
+        (20, 40, 600, 2),
+        (30, 40, 60, 1),
+    ]
+    return TransitGraph.from_rows(station_ids, arcs)
+
+
+def test_isochrone():
+    graph = make_graph()
+
+    station_ids, times = isochrone(graph, 10, 120)
+    assert list(station_ids) == [10, 20, 30]
+    assert list(times) == [0, 60, 120]
+
+    station_ids, _ = isochrone(graph, 40, 1800)
+    assert list(station_ids) == [40]
+
+
+def test_travel_time_rows():
+    graph = make_graph()
+    targets = [10, 40, 50]
+
+    rows = dict(travel_time_rows(graph, [10, 20, 40], targets))
+    assert list(rows[10]) == [0, 180, inf]
+    assert list(rows[20]) == [inf, 120, inf]
+    assert list(rows[40]) == [inf, 0, inf]
+
+    rows = dict(travel_time_rows(graph, [10], targets, cutoff=100))
+    assert list(rows[10]) == [0, inf, inf]
+
+
+def test_travel_time_rows_with_pool(tmpdir):
+    path = str(tmpdir.join('graph.bin'))
+    dump_graph(make_graph(), path)
+    graph = load_graph(path)
+    origins = [10, 20, 30, 40, 50]
+
+    expected = dict(travel_time_rows(graph, origins, origins))
+
+    with MatrixPool(2) as pool:
+        # The same pool serves many matrices
+        for targets in (origins, origins[:2]):
+            rows = dict(travel_time_rows(graph, origins, targets, pool=pool))
+            assert sorted(rows) == origins
+            assert {o: list(r) for o, r in rows.items()} == \
+                {o: list(expected[o])[:len(targets)] for o in origins}
+
+        # Rows that are not consumed are cancelled
+        rows = travel_time_rows(graph, origins * 10, origins, pool=pool)
+        next(rows)
+        rows.close()
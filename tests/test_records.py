@@ -0,0 +1,51 @@
+import json
+import pickle
+
+from flask import jsonify
+import pytest
+
+from transporter.records import Record, json_default, make_record
+
+
+def test_make_record():
+    Entry = make_record('Entry', ('route_id', 'route_number'))
+    entry = Entry(100, '9401')
+
+    assert isinstance(entry, Record)
+    assert not hasattr(entry, '__dict__')
+    assert entry['route_id'] == entry.route_id == 100
+    assert 'route_number' in entry
+    assert 'as_dict' not in entry
+    assert list(entry) == ['route_id', 'route_number']
+    assert len(entry) == 2
+    assert entry == {'route_id': 100, 'route_number': '9401'}
+    assert entry.get('missing') is None
+
+    with pytest.raises(KeyError):
+        entry['as_dict']
+
+    with pytest.raises(ValueError):
+        make_record('Invalid', ('class',))
+
+
+def test_pickle_mapper_records():
+    from transporter.utils import RoutesForStationMapper
+
+    entry = RoutesForStationMapper().transform_entry(
+        {'busRouteId': '100', 'rtNm': '9401'})
+    loaded = pickle.loads(pickle.dumps(entry))
+    assert type(loaded) is RoutesForStationMapper.entry_record
+    assert loaded == entry
+
+
+def test_serialize_records(app):
+    Entry = make_record('Entry', ('ars_id', 'latitude'))
+    value = {'entries': [Entry(47105, 37.5), Entry(None, 37.6)]}
+    expected = {'entries': [{'ars_id': 47105, 'latitude': 37.5},
+                            {'ars_id': None, 'latitude': 37.6}]}
+
+    assert json.loads(json.dumps(value, default=json_default)) == expected
+
+    with app.test_request_context():
+        resp = jsonify(value)
+    assert json.loads(resp.data.decode('utf-8')) == expected
@@ -0,0 +1,97 @@
+from transporter.routing import astar, earliest_arrivals, inf, \
+    reconstruct_path, shortest_paths
+
+
+def make_neighbors(edges):
+    adjacency = {}
+    for start, end, cost in edges:
+        adjacency.setdefault(start, []).append((end, cost))
+    return lambda node: adjacency.get(node, [])
+
+
+def test_shortest_paths():
+    neighbors = make_neighbors([
+        (1, 2, 7), (1, 3, 9), (1, 6, 14), (2, 3, 10), (2, 4, 15),
+        (3, 4, 11), (3, 6, 2), (4, 5, 6), (6, 5, 9),
+    ])
+    cost, prev = shortest_paths(1, neighbors)
+
+    assert cost == {1: 0, 2: 7, 3: 9, 4: 20, 5: 20, 6: 11}
+    assert reconstruct_path(prev, 5) == [1, 3, 6, 5]
+    assert reconstruct_path(prev, 7) == []
+
+
+def test_shortest_paths_with_target_and_cutoff():
+    neighbors = make_neighbors([(1, 2, 1), (2, 3, 1), (3, 4, 1)])
+
+    cost, prev = shortest_paths(1, neighbors, target=2)
+    assert 4 not in cost
+    assert reconstruct_path(prev, 2) == [1, 2]
+
+    cost, _ = shortest_paths(1, neighbors, cutoff=2)
+    assert cost.get(4, inf) == inf
+    assert cost[3] == 2
+
+
+def test_astar():
+    neighbors = make_neighbors([
+        (1, 2, 7), (1, 3, 9), (1, 6, 14), (2, 3, 10), (2, 4, 15),
+        (3, 4, 11), (3, 6, 2), (4, 5, 6), (6, 5, 9),
+    ])
+    # Remaining cost along the shortest paths to 5, which is admissible
+    remaining = {1: 20, 2: 21, 3: 11, 4: 6, 5: 0, 6: 9}
+    expanded = []
+
+    def tracking_neighbors(node):
+        expanded.append(node)
+        return neighbors(node)
+
+    cost, prev = astar(1, 5, tracking_neighbors, remaining.get)
+
+    assert cost[5] == 20
+    assert reconstruct_path(prev, 5) == [1, 3, 6, 5]
+    # Nodes off the shortest path are never expanded
+    assert expanded == [1, 3, 6]
+
+    cost, prev = astar(1, 5, neighbors, lambda node: 0)
+    assert cost[5] == 20
+
+    cost, prev = astar(5, 1, neighbors, lambda node: 0)
+    assert cost.get(1, inf) == inf
+    assert reconstruct_path(prev, 1) == []
+
+
+def test_earliest_arrivals():
+    # The direct edge is fast before 8 o'clock and congested afterwards
+    def neighbors(node, time):
+        if node == 1:
+            yield 3, 100 if time < 8 * 3600 else 1000
+            yield 2, 300
+        elif node == 2:
+            yield 3, 300
+
+    arrival, prev = earliest_arrivals(1, 7 * 3600, neighbors)
+    assert arrival[3] == 7 * 3600 + 100
+    assert reconstruct_path(prev, 3) == [1, 3]
+
+    arrival, prev = earliest_arrivals(1, 9 * 3600, neighbors)
+    assert arrival[3] == 9 * 3600 + 600
+    assert reconstruct_path(prev, 3) == [1, 2, 3]
+
+    arrival, _ = earliest_arrivals(1, 9 * 3600, neighbors, cutoff=500)
+    assert 3 not in arrival
+
+
+def test_calculate_distance_for_all_nodes():
+    from transporter.models import GraphNode_, Map
+
+    graph = {
+        1: {'node': GraphNode_(1, inf), 'edges': {(2, 5), (3, 20)}},
+        2: {'node': GraphNode_(2, inf), 'edges': {(3, 5), (99, 1)}},
+        3: {'node': GraphNode_(3, inf), 'edges': set()},
+        4: {'node': GraphNode_(4, inf), 'edges': {(1, 1)}},
+    }
+    costs = Map.calculate_distance_for_all_nodes(graph, 1)
+
+    assert costs == {1: 0, 2: 5, 3: 10, 4: inf}
+    assert graph[3]['node'].cost == 10
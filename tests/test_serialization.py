@@ -0,0 +1,37 @@
+import json
+
+from transporter.records import make_record
+from transporter.serialization import RawJSON, dumps, encode, \
+    json_response, loads
+
+
+def test_dumps_and_loads():
+    Entry = make_record('Entry', ('route_id', 'route_number'))
+    value = {'entries': [Entry(1, '9401')], 'name': '서울역'}
+
+    data = dumps(value)
+    assert isinstance(data, bytes)
+    assert b' ' not in data
+    assert '서울역'.encode('utf-8') in data
+    assert loads(data) == {'entries': [{'route_id': 1,
+                                        'route_number': '9401'}],
+                           'name': '서울역'}
+
+
+def test_encode_raw_json():
+    raw = RawJSON(b'{"route_number":"9401"}')
+
+    assert encode(raw) == raw.data
+    assert json.loads(encode({'route': raw, 'stations': [1, 2]}).decode()) \
+        == {'route': {'route_number': '9401'}, 'stations': [1, 2]}
+    assert json.loads(encode({'routes': [raw, raw], 'count': 2}).decode()) \
+        == {'routes': [{'route_number': '9401'}] * 2, 'count': 2}
+    assert json.loads(encode([raw, {'a': 1}]).decode()) == \
+        [{'route_number': '9401'}, {'a': 1}]
+
+
+def test_json_response(app):
+    with app.test_request_context():
+        resp = json_response(routes=[RawJSON(b'[]')])
+    assert resp.mimetype == 'application/json'
+    assert resp.data == b'{"routes":[[]]}'
@@ -0,0 +1,109 @@
+import random
+
+from geopy.distance import great_circle, vincenty
+import pytest
+
+from transporter.spatial import StationIndex, get_station_index, haversine
+
+
+def make_index(n=2000, seed=0):
+    rng = random.Random(seed)
+    stations = [
+        (i, 10000 + i, 'Station {}'.format(i),
+         37.5 + rng.uniform(-0.05, 0.05), 127.0 + rng.uniform(-0.05, 0.05))
+        for i in range(n)]
+    return stations, StationIndex(stations, cell_size=200)
+
+
+def brute_force(stations, latitude, longitude):
+    return sorted((haversine(latitude, longitude, s[3], s[4]), s[0])
+                  for s in stations)
+
+
+def test_haversine():
+    p1, p2 = (37.5547, 126.9707), (37.4979, 127.0276)
+    assert abs(haversine(*(p1 + p2)) - great_circle(p1, p2).m) < 1
+    assert haversine(37.5, 127.0, 37.5, 127.0) == 0
+
+
+def test_within():
+    stations, index = make_index()
+    for latitude, longitude in [(37.5, 127.0), (37.54, 126.96)]:
+        expected = [(d, i) for d, i in brute_force(
+            stations, latitude, longitude) if d <= 500]
+        assert index.within(latitude, longitude, 500) == expected
+
+
+def test_nearest():
+    stations, index = make_index()
+    for latitude, longitude in [(37.5, 127.0), (37.449, 127.049)]:
+        expected = brute_force(stations, latitude, longitude)[:7]
+        assert index.nearest(latitude, longitude, k=7) == expected
+
+
+def test_nearest_stations():
+    stations = [
+        (1, 47105, 'A', 37.5, 127.0),
+        (2, None, 'B', 37.5, 127.001),
+        (3, 47106, 'C', 37.5, 127.002),
+        (4, 47107, 'D', 37.6, 127.0),
+    ]
+    result = StationIndex(stations).nearest_stations(37.5, 127.0, 300)
+
+    assert [s['ars_id'] for s in result] == [47105, 47106]
+    assert result[1]['distance_from_current_location'] == 176
+    assert result[1]['station_name'] == 'C'
+
+
+def test_station_index_without_stations(app):
+    # There are no tables to load stations from
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    assert len(get_station_index()) == 0
+    assert 'station_index' not in app.extensions
+
+
+def test_station_index_rebuilt(db):
+    from transporter.models import Station
+
+    assert len(get_station_index()) == 0
+    assert 'station_index' not in db.get_app().extensions
+
+    db.session.add(Station(1, 47105, 'A', 37.5, 127.0))
+    db.session.commit()
+    # Not before `index_retry_interval` has passed
+    assert len(get_station_index()) == 0
+
+    # As if it had passed
+    db.get_app().extensions['station_index_retry_at'] = 0
+    index = get_station_index()
+    assert index.ars_ids == [47105]
+    assert get_station_index() is index
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_distances(monkeypatch, use_numpy):
+    from transporter import spatial
+
+    if not use_numpy:
+        monkeypatch.setattr(spatial, 'np', None)
+    elif spatial.np is None:
+        pytest.skip('NumPy is not installed')
+
+    stations, _ = make_index(n=200)
+    latitudes = [s[3] for s in stations]
+    longitudes = [s[4] for s in stations]
+
+    expected = [haversine(37.5, 127.0, lat, lon)
+                for lat, lon in zip(latitudes, longitudes)]
+    result = spatial.distances(37.5, 127.0, latitudes, longitudes)
+    assert list(result) == pytest.approx(expected, abs=1e-6)
+
+    result = spatial.distances(37.5, 127.0, latitudes, longitudes,
+                               method='equirectangular')
+    assert list(result) == pytest.approx(expected, abs=1)
+
+    result = spatial.distances(37.5, 127.0, latitudes, longitudes,
+                               refine=3000)
+    for d, lat, lon in zip(result, latitudes, longitudes):
+        if d <= 3000:
+            assert d == vincenty((37.5, 127.0), (lat, lon)).m
@@ -0,0 +1,124 @@
+import json
+import os
+import time
+
+import pytest
+
+from transporter.upstream import ROUTE_AND_POS, STATION_BY_UID, \
+    CircuitBreaker, UpstreamClient, UpstreamError, UpstreamUnavailable, \
+    iter_json_items
+
+
+def make_client(server, **kwargs):
+    kwargs.setdefault('backoff_factor', 0)
+    return UpstreamClient(base_url=server.base_url, **kwargs)
+
+
+def test_post_json(upstream_server):
+    client = make_client(upstream_server)
+    data = client.post_json(STATION_BY_UID, {'arsId': 47105})
+
+    assert len(data['resultList']) > 0
+    assert upstream_server.requests == [(STATION_BY_UID, {'arsId': '47105'})]
+
+
+def test_retries(upstream_server):
+    statuses = [503, 503]
+
+    def flaky(form):
+        if statuses:
+            return statuses.pop(), b''
+        return 200, b'{"resultList": []}'
+
+    upstream_server.responders[STATION_BY_UID] = flaky
+    client = make_client(upstream_server, retries=2)
+
+    assert client.post_json(STATION_BY_UID, {'arsId': 1}) == \
+        {'resultList': []}
+    assert len(upstream_server.requests) == 3
+
+
+def test_timeout(upstream_server):
+    def slow(form):
+        time.sleep(0.5)
+        return 200, b'{}'
+
+    upstream_server.responders[STATION_BY_UID] = slow
+    client = make_client(
+        upstream_server, retries=0, timeouts={STATION_BY_UID: (1, 0.1)})
+
+    with pytest.raises(UpstreamError):
+        client.post(STATION_BY_UID, {'arsId': 1})
+
+
+def test_circuit_breaker(upstream_server):
+    upstream_server.responders[STATION_BY_UID] = lambda form: (500, b'')
+    client = make_client(
+        upstream_server, retries=0,
+        circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            client.post(STATION_BY_UID, {'arsId': 1})
+
+    with pytest.raises(UpstreamUnavailable):
+        client.post(STATION_BY_UID, {'arsId': 1})
+    assert len(upstream_server.requests) == 2
+
+    # Half-open after the reset timeout
+    client.circuit_breaker.opened_at -= 60
+    client.post(ROUTE_AND_POS, {'busRouteId': 1})
+    assert not client.circuit_breaker.is_open
+
+
+def test_get_route_with_stub(upstream_server, fake_redis):
+    from transporter.utils import get_route
+
+    route_info = get_route(4940100)
+    assert route_info['route_number'] == '9401'
+    assert upstream_server.requests == \
+        [(ROUTE_AND_POS, {'busRouteId': '4940100'})]
+
+
+def chunked(data: bytes, size: int):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('filename', [
+    'get_route_and_pos.json', 'get_station_by_uid.json'])
+def test_iter_json_items(filename):
+    with open(os.path.join('tests', filename), 'rb') as fin:
+        body = fin.read()
+    expected = json.loads(body.decode('utf-8'))['resultList']
+
+    # Chunk boundaries fall inside strings, numbers and multibyte characters
+    for size in (1, 7, 4096):
+        assert list(iter_json_items(chunked(body, size))) == expected
+
+
+def test_iter_json_items_edge_cases():
+    def items(text, size=1):
+        return list(iter_json_items(chunked(text.encode('utf-8'), size)))
+
+    assert items('{}') == []
+    assert items('{"resultList": null}') == []
+    assert items('{"error": {"a": [1, 2]}, "resultList": [ ]}') == []
+    assert items('{"resultList": [12345, -1.5e3, "\\u00e9", {}]}') == \
+        [12345, -1500.0, '\u00e9', {}]
+    assert items('{"error": 1}') == []
+
+    for malformed in ('', '[]', '{"resultList": [1, 2', '{"resultList" 1}'):
+        with pytest.raises(ValueError):
+            items(malformed)
+
+
+def test_iter_results(upstream_server):
+    client = make_client(upstream_server)
+    entries = list(client.iter_results(STATION_BY_UID, {'arsId': 47105}))
+    assert entries == client.post_json(
+        STATION_BY_UID, {'arsId': 47105})['resultList']
+
+    upstream_server.responders[STATION_BY_UID] = \
+        lambda form: (200, b'{"resultList": [{}')
+    with pytest.raises(UpstreamError):
+        list(client.iter_results(STATION_BY_UID, {'arsId': 47105}))
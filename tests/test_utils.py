@@ -1,3 +1,7 @@
+import pytest
+
+from transporter.upstream import ROUTE_AND_POS, STATION_BY_UID, \
+    UpstreamError
 from transporter.utils import get_route, get_routes_for_station
 
 
@@ -20,3 +24,45 @@ def test_get_routes_for_station(app):
     for entry in stations['entries']:
         assert entry['route_id']
         assert entry['route_number']
+
+
+def test_empty_results_not_cached(app, upstream_server, fake_redis):
+    # The upstream service responds to errors with no results
+    upstream_server.responders[ROUTE_AND_POS] = \
+        lambda form: (200, b'{"error": {}, "resultList": null}')
+    upstream_server.responders[STATION_BY_UID] = \
+        lambda form: (200, b'{"resultList": []}')
+
+    for func, args in ((get_route, (1,)), (get_routes_for_station, (2,))):
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                func(*args)
+    assert len(upstream_server.requests) == 4
+    assert fake_redis.keys('route:*') == []
+
+
+def test_fan_out(app):
+    from threading import Lock
+    import time
+
+    from flask import current_app
+
+    from transporter.utils import fan_out
+
+    lock = Lock()
+    in_flight = []
+    max_in_flight = []
+
+    def square(x):
+        assert current_app
+        with lock:
+            in_flight.append(x)
+            max_in_flight.append(len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(x)
+        return x * x
+
+    assert fan_out(square, list(range(10)), max_workers=4) == \
+        [x * x for x in range(10)]
+    assert max(max_in_flight) == 4
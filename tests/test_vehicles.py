@@ -0,0 +1,107 @@
+import json
+import threading
+
+from transporter.upstream import ROUTE_AND_POS, UpstreamError
+from transporter.vehicles import VehicleHub, diff_positions, format_event
+
+
+def position(seq, station_id=None):
+    return {'seq': seq, 'station_id': station_id or seq * 10}
+
+
+def test_diff_positions():
+    previous = {1: position(1), 2: position(2), 3: position(3)}
+    current = {1: position(1), 2: position(2, 21), 4: position(4)}
+
+    changed, removed = diff_positions(previous, current)
+    assert changed == [position(2, 21), position(4)]
+    assert removed == [3]
+
+
+def test_format_event():
+    assert format_event(('delta', {'removed': [3]})) == \
+        b'event: delta\ndata: {"removed":[3]}\n\n'
+    assert format_event(None) == b': keep-alive\n\n'
+
+
+def test_hub(app):
+    polls = [
+        [position(1), position(2)],
+        [position(1), position(3)],
+        UpstreamError('Timed out'),
+        [position(1), position(3)],
+    ]
+    calls = []
+    polled = threading.Event()
+
+    def fetch(route_id):
+        calls.append(route_id)
+        if len(calls) >= len(polls):
+            polled.wait()
+            return polls[-1]
+        result = polls[len(calls) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    hub = VehicleHub(interval=0.01, keep_alive=5, fetch=fetch)
+    first = hub.subscribe(100)
+    events = iter(first)
+    assert next(events) == ('snapshot',
+                            {'positions': [position(1), position(2)]})
+
+    # A single poller serves all subscribers of a route
+    second = hub.subscribe(100)
+    assert list(hub.feeds) == [100]
+
+    assert next(events) == ('delta',
+                            {'changed': [position(3)], 'removed': [2]})
+    assert next(events) == ('error', {'error': 'Timed out'})
+
+    first.close()
+    assert 100 in hub.feeds
+    second.close()
+    assert hub.feeds == {}
+
+    polled.set()
+    threads = [t for t in threading.enumerate()
+               if t.name == 'route-feed-100']
+    for thread in threads:
+        thread.join(1)
+        assert not thread.is_alive()
+    assert set(calls) == {100}
+
+
+def test_hub_survives_errors(app):
+    polls = [ConnectionError('Redis is down'), [position(1)]]
+
+    def fetch(route_id):
+        result = polls.pop(0) if len(polls) > 1 else polls[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    hub = VehicleHub(interval=0.01, keep_alive=5, fetch=fetch)
+    subscription = hub.subscribe(100)
+    events = iter(subscription)
+    assert next(events) == ('error', {'error': 'Internal error'})
+    assert next(events) == ('snapshot', {'positions': [position(1)]})
+    subscription.close()
+
+
+def test_route_vehicles(app, upstream_server, fake_redis):
+    resp = app.test_client().get('/api/route/4940100/vehicles',
+                                 buffered=False)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+
+    chunk = next(iter(resp.response))
+    name, data = chunk.decode('utf-8').strip().split('\n')
+    assert name == 'event: snapshot'
+    positions = json.loads(data[len('data: '):])['positions']
+    assert positions[0]['seq'] == 3
+    assert positions[0]['station_id'] == 5378
+
+    resp.close()
+    assert app.extensions['vehicle_hub'].feeds == {}
+    assert [e for e, _ in upstream_server.requests] == [ROUTE_AND_POS]
@@ -25,12 +25,38 @@ def create_app(name=__name__, config=None,
     app.secret_key = 'secret'
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_URI')
     app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+    app.config['GRAPH_PATH'] = os.environ.get('GRAPH_PATH')
+    app.config['HIERARCHY_PATH'] = os.environ.get('HIERARCHY_PATH')
+    app.config['PROFILES_PATH'] = os.environ.get('PROFILES_PATH')
+    app.config['UPSTREAM_BASE_URL'] = os.environ.get('UPSTREAM_BASE_URL')
+    #: Maximum number of concurrent upstream calls per request
+    app.config['UPSTREAM_FAN_OUT'] = 8
+    #: Stations within this many meters are connected by walking
+    app.config['TRANSFER_RADIUS'] = 200
+    #: In meters per second
+    app.config['WALKING_SPEED'] = 1.2
+    #: Maximum number of origin/destination pairs in a batch journey request
+    app.config['MAX_JOURNEY_PAIRS'] = 10000
+    #: Worker processes for travel-time matrices (one per CPU if `None`)
+    app.config['MATRIX_WORKERS'] = None
+    #: Threads running requests passed on by the ASGI application
+    app.config['WSGI_THREADS'] = 16
+    #: Seconds between polls of the vehicle positions of a route
+    app.config['VEHICLE_POLL_INTERVAL'] = 10
+    #: Size of the Redis connection pool of the ASGI application
+    app.config['REDIS_MAX_CONNECTIONS'] = 64
     app.config['DEBUG'] = True
 
     app.config.update(config)
 
+    from transporter.records import RecordJSONEncoder
+    app.json_encoder = RecordJSONEncoder
+
     redis_store.init_app(app)
 
+    from transporter.upstream import upstream
+    upstream.init_app(app)
+
     from transporter.models import db
     db.init_app(app)
 
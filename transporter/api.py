@@ -1,11 +1,25 @@
-from collections import deque
+from itertools import chain
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, current_app, request, \
+    stream_with_context
 from logbook import Logger
 
+from transporter.arrivals import record_hit
+from transporter.cache import LRUCache, cached_response, ttl_static
+from transporter.contraction import get_contraction_hierarchy
+from transporter.graph import get_transit_graph
+from transporter.journey import JourneyPlanner, get_route_network
 from transporter.models import GraphNode
-from transporter.utils import get_nearest_stations, get_routes_for_station, \
-    get_route
+from transporter.profiles import get_travel_time_profiles
+from transporter.reachability import get_matrix_pool, isochrone, \
+    travel_time_rows
+from transporter.routing import shortest_paths
+from transporter.serialization import dumps, json_response
+from transporter.spatial import get_station_index
+from transporter.upstream import UpstreamError, UpstreamUnavailable
+from transporter.utils import get_arrivals, get_nearest_stations, \
+    get_routes_for_station, get_route
+from transporter.vehicles import format_event, get_vehicle_hub
 
 
 api_module = Blueprint(
@@ -14,6 +28,9 @@ api_module = Blueprint(
 log = Logger(__name__)
 inf = float('inf')
 
+#: Origins and destinations are snapped to stations within this many meters
+default_access_radius = 500
+
 
 def build_nodes_for_route(route):
     """Build graph nodes for a route"""
@@ -29,70 +46,265 @@ def build_nodes_for_route(route):
             log.warn('Node for station {} does not exist (end)'
                      .format(edge.start))
         else:
-            nodes[edge.start].add_neighbor(nodes[edge.end])
+            nodes[edge.start].add_neighbor(
+                nodes[edge.end], edge.average_time)
 
     return nodes
 
 
-def calculate_costs(nodes):
-    cost = {}
-    prev = {}
-    queue = deque()
+def compact_times(times):
+    """Rounds travel times to seconds. Unreachable stations become `None`."""
+    return [None if t == inf else int(round(t)) for t in times]
+
+
+def calculate_costs(nodes: dict, source: int):
+    """Calculates the cost of reaching each node from `source`.
 
-    source = route.stations[0].id
-    cost[source] = 0
-    prev[source] = None
+    :param nodes: A dictionary of graph nodes, as built by
+        `build_nodes_for_route()`
+    :param source: Station ID of the starting node
+    :return: A `(cost, prev)` tuple of dictionaries keyed by station ID
+    """
+    def neighbors(node_id):
+        for v, c in nodes[node_id].neighbor_cost_pairs:
+            yield v.data.id, c
 
-    for node in nodes.values():
-        if node.data.id != source:
-            cost[node.data.id] = inf
-            prev[node.data.id] = None
-        queue.append(node)
+    cost = dict.fromkeys(nodes, inf)
+    prev = dict.fromkeys(nodes)
 
-    while len(queue) > 0:
-        # u := vertex in Q with min cost[u]
-        min_cost_node_id = queue[0].data.id
-        min_cost = cost[min_cost_node_id]
-        for node in queue:
-            if cost[node.data.id] < min_cost:
-                min_cost = cost[node.data.id]
-                min_cost_node_id = node.data.id
+    reached_cost, reached_prev = shortest_paths(source, neighbors)
+    cost.update(reached_cost)
+    prev.update(reached_prev)
 
-        # Remove u from Q
-        u = nodes[min_cost_node_id]
-        try:
-            queue.remove(nodes[min_cost_node_id])
-        except ValueError:
-            pass
+    return cost, prev
 
-        for v, c in u.neighbor_cost_pairs:
-            if cost[u.data.id] + c < cost[v.data.id]:
-                cost[v.data.id] = cost[u.data.id] + c
-                prev[v.data.id] = u
+
+@api_module.errorhandler(UpstreamError)
+def handle_upstream_error(error):
+    log.warn(str(error))
+    status = 503 if isinstance(error, UpstreamUnavailable) else 502
+    return json_response(error=str(error)), status
 
 
 @api_module.route('/station/<int:ars_id>/routes')
+@cached_response('routes_for_station', ttl=ttl_static, max_age=60,
+                 local=LRUCache(max_entries=4096, max_bytes=8 * 1024 ** 2))
 def routes_for_station(ars_id):
-    return jsonify(routes=get_routes_for_station(ars_id))
+    return json_response(routes=get_routes_for_station.raw(ars_id))
+
+
+@api_module.route('/station/<int:ars_id>/arrivals')
+def arrivals(ars_id):
+    """Arrival estimates at a station, usually served from the snapshots of
+    `transporter.arrivals.ArrivalPoller`."""
+    record_hit(ars_id)
+    return json_response(arrivals=get_arrivals.raw(ars_id))
 
 
 @api_module.route('/nearest_stations')
 def nearest_stations():
 
-    latitude = request.args['latitude']
-    longitude = request.args['longitude']
+    latitude = request.args.get('latitude', type=float)
+    longitude = request.args.get('longitude', type=float)
+    if latitude is None or longitude is None:
+        return json_response(error='Latitude and longitude are required'), 400
+    radius = request.args.get('radius', 300, type=int)
+    max_workers = current_app.config['UPSTREAM_FAN_OUT']
 
-    stations = get_nearest_stations(latitude, longitude)
-    routes = [get_routes_for_station(s['ars_id']) for s in stations]
+    stations = get_station_index().nearest_stations(
+        latitude, longitude, radius)
+    if not stations:
+        stations = get_nearest_stations(latitude, longitude, radius)
+    routes = get_routes_for_station.get_many(
+        [(s['ars_id'],) for s in stations], max_workers,
+        errors=(UpstreamError,))
+    # Stations without routes are left out
+    stations = [s for s, r in zip(stations, routes) if r is not None]
 
-    entries = sum([r['entries'] for r in routes if len(r) > 0], [])
-    routes = [get_route(x['route_id']) for x in entries]
+    # Many nearby stations share the same routes, so fetch each route once
+    entries = chain.from_iterable(r['entries'] for r in routes
+                                  if r is not None)
+    route_ids = dict.fromkeys(x['route_id'] for x in entries)
+    routes = get_route.get_many([(r,) for r in route_ids], max_workers,
+                                raw=True)
 
-    return jsonify(stations=stations, routes=routes)
+    return json_response(stations=stations, routes=routes)
 
 
 @api_module.route('/route/<int:route_id>')
+@cached_response('route', ttl=ttl_static, max_age=60,
+                 local=LRUCache(max_entries=1024, max_bytes=32 * 1024 ** 2))
 def route(route_id):
 
-    route = get_route(route_id)
-    return jsonify(route)
+    return json_response(get_route.raw(route_id))
+
+
+@api_module.route('/route/<int:route_id>/vehicles')
+def route_vehicles(route_id):
+    """A stream of server-sent events with the vehicle positions of a route.
+    See `transporter.vehicles`."""
+    subscription = get_vehicle_hub().subscribe(route_id)
+
+    def generate():
+        for event in subscription:
+            yield format_event(event)
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    response.call_on_close(subscription.close)
+    return response
+
+
+@api_module.route('/path/<int:source>/<int:target>')
+def path(source, target):
+    """Shortest path between two stations on the station graph. With
+    `departure` (seconds since midnight), routes out of service are avoided
+    and learned travel times of that time of day are used if available."""
+    departure = request.args.get('departure', type=float)
+    profiles = get_travel_time_profiles() if departure is not None else None
+    hierarchy = get_contraction_hierarchy() if departure is None else None
+    try:
+        if profiles is not None:
+            cost, stations = profiles.shortest_path(source, target, departure)
+        elif hierarchy is not None:
+            cost, stations, _ = hierarchy.query(source, target)
+        else:
+            cost, stations = get_transit_graph().shortest_path(
+                source, target, departure=departure)
+    except KeyError as e:
+        return json_response(error='Unknown station {}'.format(e)), 404
+
+    if not stations:
+        return json_response(error='No path found'), 404
+
+    return json_response(cost=cost, stations=stations)
+
+
+@api_module.route('/journey')
+def journey():
+    """Journeys between two locations given as `origin_latitude`,
+    `origin_longitude`, `destination_latitude` and `destination_longitude`.
+    """
+    coordinates = [request.args.get(name, type=float) for name in (
+        'origin_latitude', 'origin_longitude', 'destination_latitude',
+        'destination_longitude')]
+    if None in coordinates:
+        return json_response(error='Origin and destination are required'), 400
+
+    departure = request.args.get('departure', type=float)
+    radius = request.args.get('radius', default_access_radius, type=int)
+
+    network = get_route_network()
+    origins = network.access(coordinates[0], coordinates[1], radius)
+    targets = network.access(coordinates[2], coordinates[3], radius)
+
+    journeys = []
+    if origins and targets:
+        journeys = JourneyPlanner(network).plan_many(
+            [(origins, targets)], departure)[0]
+
+    return json_response(origins=list(origins), destinations=list(targets),
+                         journeys=[j.serialize() for j in journeys])
+
+
+@api_module.route('/journey', methods=['POST'])
+def journey_batch():
+    """Journeys for many origin/destination pairs. The request body is a JSON
+    object such as
+
+        {"pairs": [[origin_latitude, origin_longitude,
+                    destination_latitude, destination_longitude], ...],
+         "departure": 28800, "radius": 500, "legs": false}
+
+    and the response holds a list of journeys for each pair, in order.
+    `departure` (seconds since midnight) is optional.
+    """
+    body = request.get_json(silent=True) or {}
+    pairs = body.get('pairs')
+    if not isinstance(pairs, list):
+        return json_response(error='A list of pairs is required'), 400
+    if len(pairs) > current_app.config['MAX_JOURNEY_PAIRS']:
+        return json_response(error='Too many pairs'), 400
+
+    try:
+        pairs = [tuple(float(x) for x in pair) for pair in pairs]
+        departure = body.get('departure')
+        if departure is not None:
+            departure = float(departure)
+        radius = float(body.get('radius', default_access_radius))
+    except (TypeError, ValueError):
+        return json_response(error='Invalid pairs'), 400
+    if any(len(pair) != 4 for pair in pairs):
+        return json_response(error='Each pair needs four coordinates'), 400
+    legs = bool(body.get('legs', False))
+
+    network = get_route_network()
+    # Analyses typically share a small set of locations
+    access = {}
+    for pair in pairs:
+        for location in (pair[:2], pair[2:]):
+            if location not in access:
+                access[location] = network.access(
+                    location[0], location[1], radius)
+
+    results = JourneyPlanner(network).plan_many(
+        [(access[pair[:2]], access[pair[2:]]) for pair in pairs], departure)
+
+    return json_response(journeys=[[j.serialize(legs) for j in journeys]
+                                   for journeys in results])
+
+
+@api_module.route('/isochrone/<int:source>')
+def station_isochrone(source):
+    """Stations reachable from a station within `budget` seconds."""
+    budget = request.args.get('budget', 1800, type=float)
+    try:
+        station_ids, times = isochrone(get_transit_graph(), source, budget)
+    except KeyError as e:
+        return json_response(error='Unknown station {}'.format(e)), 404
+
+    return json_response(source=source, budget=budget,
+                         stations=station_ids.tolist(),
+                         times=compact_times(times))
+
+
+@api_module.route('/matrix', methods=['POST'])
+def matrix():
+    """Travel times between stations. The request body is a JSON object such
+    as
+
+        {"origins": [station_id, ...], "targets": [station_id, ...],
+         "cutoff": 3600}
+
+    where `targets` defaults to `origins`. The response is newline-delimited
+    JSON: the list of targets first, then one row per origin in the order
+    they are computed.
+    """
+    body = request.get_json(silent=True) or {}
+    origins = body.get('origins')
+    targets = body.get('targets', origins)
+    if not isinstance(origins, list) or not isinstance(targets, list):
+        return json_response(
+            error='Lists of origins and targets are required'), 400
+    try:
+        cutoff = float(body.get('cutoff') or inf)
+    except (TypeError, ValueError):
+        return json_response(error='Invalid cutoff'), 400
+
+    graph = get_transit_graph()
+    unknown = [s for s in chain(origins, targets) if s not in graph.index]
+    if unknown:
+        return json_response(error='Unknown stations', stations=unknown), 404
+
+    pool = get_matrix_pool() if graph.path is not None else None
+    rows = travel_time_rows(graph, origins, targets, cutoff, pool)
+
+    def generate():
+        yield dumps({'targets': targets}) + b'\n'
+        for origin, row in rows:
+            yield dumps({'origin': origin,
+                         'times': compact_times(row)}) + b'\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
@@ -0,0 +1,123 @@
+"""Arrival estimates at stations, refreshed in the background.
+
+Arrival estimates change every few seconds, and a popular station is looked
+at by many clients at once. Instead of calling the upstream service for each
+of them, a poller refreshes the estimates of the most requested stations on
+a fixed cadence and stores them in the cache entries of
+`transporter.utils.get_arrivals()`, which is where requests read them from.
+The number of upstream calls is thus proportional to the number of hot
+stations rather than to traffic.
+
+    python -m transporter.cli poll-arrivals
+
+Requests count how often each station is asked for in a sorted set in Redis.
+The counts decay with a half-life, so the hot set follows demand. Stations
+outside of it are fetched on demand, at most once per `ttl_realtime`.
+Only a single poller is meant to run at a time.
+"""
+import threading
+import time
+
+from logbook import Logger
+
+from transporter import redis_store
+from transporter.upstream import UpstreamError
+from transporter.utils import fan_out, get_arrivals
+
+
+log = Logger(__name__)
+
+#: A sorted set of request counts by station
+hits_key = 'arrivals:hits'
+
+#: Counts that decay below this are dropped
+min_tracked_hits = 0.01
+
+
+def record_hit(ars_id: int, client=None):
+    """Counts a request for the arrivals at a station."""
+    (client or redis_store).zincrby(hits_key, 1, ars_id)
+
+
+def hot_stations(max_stations: int, min_hits: float=1, client=None):
+    """The most requested stations, most requested first.
+
+    :param min_hits: Stations requested less often than this are left out
+    """
+    members = (client or redis_store).zrevrangebyscore(
+        hits_key, '+inf', min_hits, start=0, num=max_stations)
+    return [int(m) for m in members]
+
+
+def decay_hits(factor: float, client=None):
+    """Multiplies all counts by `factor` and drops the ones that become
+    negligible."""
+    pipeline = (client or redis_store).pipeline(transaction=True)
+    pipeline.zunionstore(hits_key, {hits_key: factor})
+    pipeline.zremrangebyscore(hits_key, '-inf', min_tracked_hits)
+    pipeline.execute()
+
+
+class ArrivalPoller(object):
+
+    def __init__(self, max_stations: int=500, interval: float=10,
+                 half_life: float=300, min_hits: float=2,
+                 max_workers: int=8, client=None):
+        """
+        :param max_stations: Maximum number of stations refreshed per cycle
+        :param interval: Seconds between the start of successive cycles
+        :param half_life: Seconds it takes for request counts to halve
+        :param min_hits: Decayed request count that makes a station hot
+        :param max_workers: Maximum number of concurrent upstream calls
+        """
+        self.max_stations = max_stations
+        self.interval = interval
+        self.decay = 0.5 ** (interval / half_life)
+        self.min_hits = min_hits
+        self.max_workers = max_workers
+        self.client = client
+        self.stopped = threading.Event()
+
+    def poll(self):
+        """Runs a single cycle.
+
+        :return: A `(refreshed, failed)` tuple of station ID lists
+        """
+        stations = hot_stations(self.max_stations, self.min_hits, self.client)
+
+        def fetch(ars_id):
+            try:
+                return get_arrivals.func(ars_id)
+            except UpstreamError as e:
+                log.warn('Failed to refresh station {}: {}'.format(ars_id, e))
+                return None
+
+        results = fan_out(fetch, stations, self.max_workers)
+        refreshed = [(s, r) for s, r in zip(stations, results)
+                     if r is not None]
+        # Entries outlive a cycle so that readers never miss them while the
+        # next one is in progress
+        get_arrivals.store_many([((s,), r) for s, r in refreshed],
+                                ttl=int(2 * self.interval) + 1)
+        decay_hits(self.decay, self.client)
+
+        failed = [s for s, r in zip(stations, results) if r is None]
+        return [s for s, _ in refreshed], failed
+
+    def run(self, cycles: int=None):
+        """Polls on a fixed cadence until `stop()` is called or `cycles`
+        cycles have run."""
+        count = 0
+        while not self.stopped.is_set() and (cycles is None or count < cycles):
+            started_at = time.monotonic()
+            refreshed, failed = self.poll()
+            count += 1
+            log.info('Refreshed {} stations ({} failed) in {:.2f}s'.format(
+                len(refreshed), len(failed), time.monotonic() - started_at))
+
+            if cycles is None or count < cycles:
+                self.stopped.wait(max(
+                    0, self.interval - (time.monotonic() - started_at)))
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,384 @@
+"""An asyncio serving mode.
+
+    uvicorn --factory transporter.asgi:create_asgi_app
+
+Endpoints that mostly wait for the upstream service (`/api/nearest_stations`,
+`/api/route/<route_id>`, `/api/station/<ars_id>/routes` and
+`/api/station/<ars_id>/arrivals`) are served on the
+event loop with `async_upstream` and a `redis.asyncio` client, so a single
+process can have hundreds of upstream calls in flight. They respond with the
+same bodies as their Flask counterparts in `transporter.api` and share the
+same cache entries.
+
+Streams of vehicle positions (`/api/route/<route_id>/vehicles`) are sent from
+the event loop as well, so that subscribers do not hold on to threads.
+
+Every other request is passed on to the Flask application, which runs in a
+thread pool.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import io
+import re
+import sys
+import threading
+from urllib.parse import parse_qs
+
+from logbook import Logger
+
+from transporter import api, create_app
+from transporter.arrivals import hits_key
+from transporter.serialization import encode
+from transporter.spatial import get_station_index
+from transporter.upstream import UpstreamError, UpstreamUnavailable, \
+    async_upstream
+from transporter.utils import get_arrivals, get_nearest_stations, \
+    get_route, get_routes_for_station
+from transporter.vehicles import AsyncSubscription, format_event, \
+    get_vehicle_hub
+
+
+log = Logger(__name__)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+class ASGIApplication(object):
+
+    def __init__(self, app, redis=None):
+        """
+        :param app: The Flask application
+        :param redis: A `redis.asyncio` client. By default, one is made from
+            `REDIS_URL` with a pool of `REDIS_MAX_CONNECTIONS` connections.
+        """
+        self.app = app
+        self._redis = redis
+        self.executor = ThreadPoolExecutor(app.config['WSGI_THREADS'])
+        self.routes = [
+            (re.compile(r'/api/nearest_stations$'), self.nearest_stations),
+            (re.compile(r'/api/route/(?P<route_id>\d+)$'), self.route),
+            (re.compile(r'/api/station/(?P<ars_id>\d+)/routes$'),
+             self.routes_for_station),
+            (re.compile(r'/api/station/(?P<ars_id>\d+)/arrivals$'),
+             self.arrivals),
+        ]
+        self.vehicles_pattern = re.compile(
+            r'/api/route/(?P<route_id>\d+)/vehicles$')
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            import redis.asyncio
+            # Requests wait for a free connection instead of failing when
+            # all of them are in use
+            pool = redis.asyncio.BlockingConnectionPool.from_url(
+                self.app.config['REDIS_URL'],
+                max_connections=self.app.config['REDIS_MAX_CONNECTIONS'])
+            self._redis = redis.asyncio.Redis(connection_pool=pool)
+        return self._redis
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'GET':
+            match = self.vehicles_pattern.match(scope['path'])
+            if match is not None:
+                await self.vehicles(int(match.group('route_id')), receive,
+                                    send)
+                return
+
+        if scope['method'] in ('GET', 'HEAD'):
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match is not None:
+                    await self.handle(handler, match.groupdict(), scope,
+                                      send)
+                    return
+
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def aclose(self):
+        await async_upstream.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+        self.executor.shutdown(wait=False)
+
+    async def handle(self, handler, view_args: dict, scope, send):
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        headers = dict((k.decode('latin-1'), v.decode('latin-1'))
+                       for k, v in scope['headers'])
+        try:
+            status, body, extra_headers = await handler(
+                query, headers, **view_args)
+        except HTTPError as e:
+            status, body, extra_headers = e.status, encode(
+                {'error': str(e)}), []
+        except UpstreamError as e:
+            log.warn(str(e))
+            status = 503 if isinstance(e, UpstreamUnavailable) else 502
+            body, extra_headers = encode({'error': str(e)}), []
+
+        response_headers = [(b'content-type', b'application/json')]
+        response_headers.extend(
+            (k.encode('latin-1'), v.encode('latin-1'))
+            for k, v in extra_headers)
+        if status != 304:
+            response_headers.append(
+                (b'content-length', str(len(body)).encode('ascii')))
+        if scope['method'] == 'HEAD' or status == 304:
+            body = b''
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def query_float(self, query: dict, name: str, default=None):
+        try:
+            return float(query[name][0])
+        except KeyError:
+            if default is None:
+                raise HTTPError(400, 'Missing parameter: {}'.format(name))
+            return default
+        except ValueError:
+            raise HTTPError(400, 'Invalid parameter: {}'.format(name))
+
+    async def run_in_app_context(self, func, *args):
+        def call():
+            with self.app.app_context():
+                return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, call)
+
+    async def nearest_stations(self, query: dict, headers: dict):
+        latitude = self.query_float(query, 'latitude')
+        longitude = self.query_float(query, 'longitude')
+        radius = int(self.query_float(query, 'radius', 300))
+
+        # The index is built from the database on first use
+        index = await self.run_in_app_context(get_station_index)
+        stations = index.nearest_stations(latitude, longitude, radius)
+        if not stations:
+            stations = await get_nearest_stations.acall(
+                self.redis, latitude, longitude, radius)
+        routes = await get_routes_for_station.aget_many(
+            self.redis, [(s['ars_id'],) for s in stations],
+            errors=(UpstreamError,))
+        # Stations without routes are left out
+        stations = [s for s, r in zip(stations, routes) if r is not None]
+
+        entries = chain.from_iterable(
+            r['entries'] for r in routes if r is not None)
+        route_ids = dict.fromkeys(x['route_id'] for x in entries)
+        routes = await get_route.aget_many(
+            self.redis, [(r,) for r in route_ids], raw=True)
+
+        return 200, encode({'stations': stations, 'routes': routes}), []
+
+    async def route(self, query: dict, headers: dict, route_id: str):
+        route_id = int(route_id)
+
+        async def build():
+            return encode(await get_route.acall(
+                self.redis, route_id, raw=True))
+
+        return await self.cached_response(
+            api.route, {'route_id': route_id}, query, headers, build)
+
+    async def routes_for_station(self, query: dict, headers: dict,
+                                 ars_id: str):
+        ars_id = int(ars_id)
+
+        async def build():
+            return encode({'routes': await get_routes_for_station.acall(
+                self.redis, ars_id, raw=True)})
+
+        return await self.cached_response(
+            api.routes_for_station, {'ars_id': ars_id}, query, headers,
+            build)
+
+    async def arrivals(self, query: dict, headers: dict, ars_id: str):
+        ars_id = int(ars_id)
+        await self.redis.zincrby(hits_key, 1, ars_id)
+        return 200, encode({'arrivals': await get_arrivals.acall(
+            self.redis, ars_id, raw=True)}), []
+
+    async def cached_response(self, view, view_args: dict, query: dict,
+                              headers: dict, build):
+        """Serves a response through the cache of a `CachedResponse` view,
+        with the same headers."""
+        etag, body = await view.alookup(self.redis, view_args, query, build)
+        quoted = '"{}"'.format(etag)
+        response_headers = [
+            ('etag', quoted),
+            ('cache-control', 'public, max-age={}'.format(view.max_age)),
+        ]
+
+        if_none_match = headers.get('if-none-match', '')
+        candidates = [t.strip() for t in if_none_match.split(',')]
+        if quoted in candidates or 'W/' + quoted in candidates or \
+                '*' in candidates:
+            return 304, b'', response_headers
+        return 200, body, response_headers
+
+    async def vehicles(self, route_id: int, receive, send):
+        """Streams the vehicle positions of a route until the client goes
+        away."""
+        hub = get_vehicle_hub(self.app)
+        subscription = hub.subscribe(
+            route_id, AsyncSubscription(hub.keep_alive), self.app)
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream'),
+                                    (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            while True:
+                event = asyncio.ensure_future(subscription.queue.get())
+                done, _ = await asyncio.wait(
+                    {event, disconnected}, timeout=subscription.keep_alive,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if event not in done:
+                    event.cancel()
+                if disconnected in done:
+                    break
+                await send({'type': 'http.response.body', 'more_body': True,
+                            'body': format_event(
+                                event.result() if event in done else None)})
+        finally:
+            disconnected.cancel()
+            subscription.close()
+
+    async def call_wsgi(self, scope, receive, send):
+        """Runs the Flask application for a request, in the thread pool.
+
+        The application is called, its response iterated over and closed on
+        a single thread, as Flask keeps its contexts in thread-local stacks.
+        That thread hands the response over to the event loop through a
+        queue.
+        """
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        environ = make_environ(scope, bytes(body))
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def put(message):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+            except RuntimeError:
+                # The loop has been closed
+                cancelled.set()
+
+        def start_response(status, headers, exc_info=None):
+            put({'type': 'http.response.start',
+                 'status': int(status.split(' ', 1)[0]),
+                 'headers': [(k.lower().encode('latin-1'),
+                              v.encode('latin-1')) for k, v in headers]})
+
+        def run():
+            try:
+                result = self.app(environ, start_response)
+                try:
+                    # Streamed responses are sent as they are generated
+                    for chunk in result:
+                        if cancelled.is_set():
+                            return
+                        if chunk:
+                            put({'type': 'http.response.body',
+                                 'body': chunk, 'more_body': True})
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except Exception as e:
+                put(e)
+                return
+            put({'type': 'http.response.body', 'body': b''})
+
+        loop.run_in_executor(self.executor, run)
+        try:
+            while True:
+                message = await queue.get()
+                if isinstance(message, Exception):
+                    raise message
+                await send(message)
+                if message['type'] == 'http.response.body' and \
+                        not message.get('more_body'):
+                    break
+        finally:
+            # Stops generating the response if the client went away
+            cancelled.set()
+
+
+def make_environ(scope, body: bytes):
+    """Makes a WSGI environment for an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_{}'.format(name)
+            if key in environ:
+                value = '{},{}'.format(environ[key], value)
+            environ[key] = value
+
+    return environ
+
+
+def create_asgi_app(config=None, redis=None):
+    """Makes the ASGI application. See `create_app()` for `config`."""
+    app = create_app(__name__, config=config)
+    async_upstream.init_app(app)
+    return ASGIApplication(app, redis)
@@ -0,0 +1,631 @@
+"""Caching of upstream data in Redis.
+
+    @cached('route', ttl=ttl_static)
+    def get_route(route_id):
+        ...
+
+    get_route(100100508)                      # GET, or fetch + SET on a miss
+    get_route.get_many([(100100508,), ...])   # MGET + pipelined SET
+    get_route.invalidate(100100508)
+
+Keys are derived from a hash of the JSON-encoded arguments, so they are
+stable across processes and Python versions. When a value is missing, only
+one caller acquires a short-lived lock and calls the underlying function;
+concurrent callers wait for the value to appear instead of hitting the
+upstream service all at once.
+
+Frequently used functions may also keep an in-process `LRUCache` in front of
+Redis, which saves the network round trip and the decoding of the payload.
+Values served from it are shared, so callers must not modify them.
+
+Callers that only pass a value on to a client can ask for it in its encoded
+form with `raw=True`, which skips decoding it altogether:
+
+    get_route.raw(100100508)                  # RawJSON
+    get_route.get_many([...], raw=True)
+
+The asyncio serving mode reads and writes the same entries through a
+`redis.asyncio` client, with a coroutine registered for each function:
+
+    @get_route.coroutine
+    async def get_route_async(route_id):
+        ...
+
+    await get_route.acall(client, 100100508)
+
+Whole API responses can be cached as well, with `cached_response()`. The
+stored body comes with a hash of itself, which is sent as the `ETag` so that
+clients can revalidate their copy with a conditional GET.
+"""
+import asyncio
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+from threading import Lock
+import time
+import uuid
+from weakref import WeakSet
+
+from flask import Response, request
+from logbook import Logger
+
+from transporter import redis_store
+from transporter.serialization import RawJSON, dumps, loads
+
+
+log = Logger(__name__)
+
+#: For data that rarely changes, such as route topology (in seconds)
+ttl_static = 24 * 3600
+#: For stations near a location
+ttl_nearby = 3600
+#: For real-time data such as bus arrivals
+ttl_realtime = 15
+#: For vehicle positions, which are polled by many processes at once
+ttl_positions = 5
+
+key_prefix = 'cache'
+
+_local_caches = WeakSet()
+
+#: Marks calls that failed in `CachedFunction.get_many()`
+_failed = object()
+
+
+def make_key(namespace: str, args: tuple, kwargs: dict=None):
+    """Makes a stable cache key for a function call."""
+    payload = json.dumps([args, kwargs or {}], sort_keys=True,
+                         separators=(',', ':'), default=str)
+    digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+    return '{}:{}:{}'.format(key_prefix, namespace, digest)
+
+
+class LRUCache(object):
+    """A bounded, thread-safe, in-process cache with a time to live.
+
+    Entries are evicted in least-recently-used order once either the number
+    of entries or their total approximate size exceeds its limit.
+    """
+
+    def __init__(self, max_entries: int=1024, max_bytes: int=16 * 1024 ** 2,
+                 ttl: float=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        _local_caches.add(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str):
+        """Returns the value of a key, or `None` if absent or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value, size = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value, size: int):
+        """
+        :param size: Approximate size of the value in bytes
+        """
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (time.monotonic() + self.ttl, value, size)
+            self.size += size
+
+            while len(self.entries) > self.max_entries \
+                    or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def delete(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key: str):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+
+def clear_local_caches():
+    """Empties all in-process caches of this process."""
+    for cache in list(_local_caches):
+        cache.clear()
+
+
+class CachedFunction(object):
+
+    def __init__(self, func, namespace: str, ttl: int, lock_timeout: float,
+                 wait_timeout: float, client=None, local: LRUCache=None):
+        self.func = func
+        self.namespace = namespace
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.local = local
+        self.async_func = None
+        self._client = client
+        wraps(func)(self)
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else redis_store
+
+    def key(self, *args, **kwargs):
+        return make_key(self.namespace, args, kwargs)
+
+    def dumps(self, value):
+        return dumps(value)
+
+    def loads(self, data: bytes):
+        return loads(data)
+
+    def _load_local(self, key: str, raw: bool=False):
+        if self.local is None:
+            return None
+        # Entries hold both the value and its encoded form
+        entry = self.local.get(key)
+        if entry is None:
+            return None
+        return RawJSON(entry[1]) if raw else entry[0]
+
+    def _store_local(self, key: str, value, data):
+        if self.local is not None:
+            self.local.set(key, (value, data), len(data))
+
+    def _decode(self, key: str, data: bytes, raw: bool=False):
+        if raw:
+            return RawJSON(data)
+        value = self.loads(data)
+        self._store_local(key, value, data)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return self._get(args, kwargs)
+
+    def raw(self, *args, **kwargs):
+        """Same as calling the function, but returns the value as
+        `RawJSON`."""
+        return self._get(args, kwargs, raw=True)
+
+    def _get(self, args: tuple, kwargs: dict, raw: bool=False):
+        key = self.key(*args, **kwargs)
+        value = self._load_local(key, raw)
+        if value is not None:
+            return value
+
+        data = self.client.get(key)
+
+        if data is not None:
+            log.debug('Data entry for "{}" was loaded from cache.'.format(key))
+            return self._decode(key, data, raw)
+
+        log.info('Data entry for "{}" does not exist. Fetching one.'
+                 .format(key))
+
+        token = self._acquire_lock(key)
+        if token is None:
+            data = self._wait_for(key)
+            if data is not None:
+                return self._decode(key, data, raw)
+
+        try:
+            value = self.func(*args, **kwargs)
+            data = self.dumps(value)
+            self.client.set(key, data, ex=self.ttl)
+            self._store_local(key, value, data)
+        finally:
+            if token is not None:
+                self._release_lock(key, token)
+
+        return RawJSON(data) if raw else value
+
+    def get_many(self, args_list: list, max_workers: int=8,
+                 raw: bool=False, errors: tuple=()):
+        """Looks up many calls at once. Missing values are fetched
+        concurrently and stored in a single round trip.
+
+        :param args_list: A list of positional argument tuples
+        :param raw: Return values as `RawJSON`
+        :param errors: Exception types that fail a single call rather than
+            all of them. The value of such a call is `None` and not cached.
+        :return: A list of values in the same order as `args_list`
+        """
+        if not args_list:
+            return []
+
+        keys = [self.key(*args) for args in args_list]
+        values = [self._load_local(key, raw) for key in keys]
+
+        remote = [i for i, value in enumerate(values) if value is None]
+        if not remote:
+            return values
+
+        found = self.client.mget([keys[i] for i in remote])
+        for i, data in zip(remote, found):
+            if data is not None:
+                values[i] = self._decode(keys[i], data, raw)
+
+        missing = [i for i in remote if values[i] is None]
+        if not missing:
+            return values
+
+        # Acquire locks for all missing keys in one round trip
+        tokens = [uuid.uuid4().hex for _ in missing]
+        pipeline = self.client.pipeline(transaction=False)
+        for i, token in zip(missing, tokens):
+            pipeline.set(self._lock_key(keys[i]), token, nx=True,
+                         px=int(self.lock_timeout * 1000))
+        acquired = pipeline.execute()
+
+        owned = [(i, t) for i, t, ok in zip(missing, tokens, acquired) if ok]
+        others = [i for i, ok in zip(missing, acquired) if not ok]
+
+        # Values being fetched by someone else that do not show up in time
+        # are fetched here as well
+        found = self._wait_for_many([keys[i] for i in others])
+        for i, data in zip(others, found):
+            if data is not None:
+                values[i] = self._decode(keys[i], data, raw)
+            else:
+                owned.append((i, None))
+
+        # In order to avoid circular import...
+        from transporter.utils import fan_out
+
+        def fetch(i):
+            try:
+                return self.func(*args_list[i])
+            except errors as e:
+                log.warn('{} failed: {}'.format(keys[i], e))
+                return _failed
+
+        try:
+            results = fan_out(fetch, [i for i, _ in owned], max_workers)
+
+            pipeline = self.client.pipeline(transaction=False)
+            for (i, _), value in zip(owned, results):
+                if value is _failed:
+                    continue
+                data = self.dumps(value)
+                values[i] = RawJSON(data) if raw else value
+                pipeline.set(keys[i], data, ex=self.ttl)
+                self._store_local(keys[i], value, data)
+            pipeline.execute()
+        finally:
+            for i, token in owned:
+                if token is not None:
+                    self._release_lock(keys[i], token)
+
+        return values
+
+    def store_many(self, items: list, ttl: int=None):
+        """Stores values computed elsewhere, such as by a background job, in
+        a single round trip.
+
+        :param items: A list of `(args, value)` tuples, where `args` is a
+            positional argument tuple
+        :param ttl: Overrides the time to live of the function
+        """
+        if not items:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for args, value in items:
+            key = self.key(*args)
+            data = self.dumps(value)
+            pipeline.set(key, data, ex=ttl or self.ttl)
+            self._store_local(key, value, data)
+        pipeline.execute()
+
+    def invalidate(self, *args, **kwargs):
+        """Removes a value from the cache. In-process caches of other
+        processes are not affected and expire on their own."""
+        self.invalidate_many([args], kwargs)
+
+    def invalidate_many(self, args_list: list, kwargs: dict=None):
+        keys = [self.key(*args, **(kwargs or {})) for args in args_list]
+        if not keys:
+            return
+        if self.local is not None:
+            for key in keys:
+                self.local.delete(key)
+        self.client.delete(*keys)
+
+    def coroutine(self, func):
+        """Registers a coroutine function computing the same values as the
+        wrapped function, for `acall()` and `aget_many()`."""
+        self.async_func = func
+        return func
+
+    async def acall(self, client, *args, raw: bool=False):
+        """Same as calling the function, but with a `redis.asyncio` client
+        and the coroutine registered with `coroutine()`."""
+        key = self.key(*args)
+        value = self._load_local(key, raw)
+        if value is not None:
+            return value
+
+        data = await client.get(key)
+        if data is not None:
+            return self._decode(key, data, raw)
+
+        token = uuid.uuid4().hex
+        if not await client.set(self._lock_key(key), token, nx=True,
+                                px=int(self.lock_timeout * 1000)):
+            token = None
+            data = await self._async_wait_for(client, key)
+            if data is not None:
+                return self._decode(key, data, raw)
+
+        try:
+            value = await self.async_func(*args)
+            data = self.dumps(value)
+            await client.set(key, data, ex=self.ttl)
+            self._store_local(key, value, data)
+        finally:
+            if token is not None:
+                lock_key = self._lock_key(key)
+                if await client.get(lock_key) == token.encode('ascii'):
+                    await client.delete(lock_key)
+
+        return RawJSON(data) if raw else value
+
+    async def aget_many(self, client, args_list: list, raw: bool=False,
+                        errors: tuple=()):
+        """Same as `get_many()`, but with a `redis.asyncio` client. Missing
+        values are fetched concurrently, without a limit."""
+        keys = [self.key(*args) for args in args_list]
+        values = [self._load_local(key, raw) for key in keys]
+
+        remote = [i for i, value in enumerate(values) if value is None]
+        if not remote:
+            return values
+
+        found = await client.mget([keys[i] for i in remote])
+        for i, data in zip(remote, found):
+            if data is not None:
+                values[i] = self._decode(keys[i], data, raw)
+
+        async def fetch(i):
+            try:
+                return await self.acall(client, *args_list[i], raw=raw)
+            except errors as e:
+                log.warn('{} failed: {}'.format(keys[i], e))
+                return None
+
+        missing = [i for i in remote if values[i] is None]
+        results = await asyncio.gather(*(fetch(i) for i in missing))
+        for i, value in zip(missing, results):
+            values[i] = value
+
+        return values
+
+    async def _async_wait_for(self, client, key: str, interval: float=0.05):
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            data = await client.get(key)
+            if data is not None:
+                return data
+            if not await client.exists(self._lock_key(key)):
+                return await client.get(key)
+        return None
+
+    def _lock_key(self, key: str):
+        return '{}:lock'.format(key)
+
+    def _acquire_lock(self, key: str):
+        token = uuid.uuid4().hex
+        if self.client.set(self._lock_key(key), token, nx=True,
+                           px=int(self.lock_timeout * 1000)):
+            return token
+        return None
+
+    def _release_lock(self, key: str, token: str):
+        lock_key = self._lock_key(key)
+        # Do not release a lock that has expired and been taken by someone
+        # else in the meantime
+        if self.client.get(lock_key) == token.encode('ascii'):
+            self.client.delete(lock_key)
+
+    def _wait_for(self, key: str, interval: float=0.05):
+        """Waits for a value being fetched by another caller. Returns `None`
+        if the other caller gave up or the wait timed out."""
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            data = self.client.get(key)
+            if data is not None:
+                return data
+            if not self.client.exists(self._lock_key(key)):
+                return self.client.get(key)
+        return None
+
+    def _wait_for_many(self, keys: list, interval: float=0.05):
+        """Same as `_wait_for()`, but waits for many values at once, until a
+        single deadline.
+
+        :return: A list of values in the same order as `keys`, with `None`
+            where there is none
+        """
+        found = [None] * len(keys)
+        pending = list(range(len(keys)))
+        deadline = time.monotonic() + self.wait_timeout
+        while pending and time.monotonic() < deadline:
+            time.sleep(interval)
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.mget([keys[i] for i in pending])
+            pipeline.mget([self._lock_key(keys[i]) for i in pending])
+            data, locks = pipeline.execute()
+
+            given_up = []
+            waiting = []
+            for i, value, lock in zip(pending, data, locks):
+                if value is not None:
+                    found[i] = value
+                elif lock is None:
+                    given_up.append(i)
+                else:
+                    waiting.append(i)
+
+            # The value may have been stored right before the lock was
+            # released
+            if given_up:
+                for i, value in zip(given_up, self.client.mget(
+                        [keys[i] for i in given_up])):
+                    found[i] = value
+            pending = waiting
+        return found
+
+
+def cached(namespace: str, ttl: int, lock_timeout: float=10,
+           wait_timeout: float=5, client=None, local: LRUCache=None):
+    """Caches the return values of a function in Redis.
+
+    :param namespace: Part of the cache keys, unique for each function
+    :param ttl: Time to live in seconds
+    :param lock_timeout: Expiry of the lock held while fetching a value
+    :param wait_timeout: How long to wait for a value being fetched by
+        another caller before fetching it anyway
+    :param client: A Redis client (defaults to `redis_store`)
+    :param local: An in-process cache consulted before Redis
+    """
+    def wrap(func):
+        return CachedFunction(func, namespace, ttl, lock_timeout,
+                              wait_timeout, client, local)
+    return wrap
+
+
+class CachedResponse(object):
+
+    def __init__(self, view, namespace: str, ttl: int, max_age: int,
+                 client=None, local: LRUCache=None):
+        self.view = view
+        self.namespace = 'response:{}'.format(namespace)
+        self.ttl = ttl
+        self.max_age = max_age
+        self.local = local
+        self._client = client
+        wraps(view)(self)
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else redis_store
+
+    def key(self, view_args: dict, query: dict=None):
+        return make_key(self.namespace, (), dict(query or {}, **view_args))
+
+    def __call__(self, **view_args):
+        key = self.key(view_args, request.args.to_dict(flat=False))
+
+        entry = self.local.get(key) if self.local is not None else None
+        if entry is None:
+            data = self.client.get(key)
+            if data is not None:
+                entry = self._parse(data)
+            else:
+                resp = self.view(**view_args)
+                if not isinstance(resp, Response) or resp.status_code != 200:
+                    return resp
+                entry = self._entry(resp.get_data())
+                self.client.set(key, entry[0].encode('ascii') + entry[1],
+                                ex=self.ttl)
+            if self.local is not None:
+                self.local.set(key, entry, len(entry[1]))
+
+        return self.make_response(*entry)
+
+    def _parse(self, data: bytes):
+        # A 40-character digest, followed by the body
+        return data[:40].decode('ascii'), data[40:]
+
+    def _entry(self, body: bytes):
+        return hashlib.sha1(body).hexdigest(), body
+
+    async def alookup(self, client, view_args: dict, query: dict, build):
+        """Looks up a response with a `redis.asyncio` client.
+
+        :param build: A coroutine function that returns the body of the
+            response if it is not cached
+        :return: An `(etag, body)` tuple
+        """
+        key = self.key(view_args, query)
+
+        entry = self.local.get(key) if self.local is not None else None
+        if entry is None:
+            data = await client.get(key)
+            if data is not None:
+                entry = self._parse(data)
+            else:
+                entry = self._entry(await build())
+                await client.set(key, entry[0].encode('ascii') + entry[1],
+                                 ex=self.ttl)
+            if self.local is not None:
+                self.local.set(key, entry, len(entry[1]))
+
+        return entry
+
+    def make_response(self, etag: str, body: bytes):
+        resp = Response(body, mimetype='application/json')
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = self.max_age
+        return resp.make_conditional(request)
+
+    def invalidate_many(self, view_args_list: list):
+        """Removes the responses for the given URL arguments. Responses to
+        URLs with a query string are left to expire."""
+        keys = [self.key(view_args) for view_args in view_args_list]
+        if not keys:
+            return
+        if self.local is not None:
+            for key in keys:
+                self.local.delete(key)
+        self.client.delete(*keys)
+
+    def invalidate(self, **view_args):
+        self.invalidate_many([view_args])
+
+
+def cached_response(namespace: str, ttl: int, max_age: int=0, client=None,
+                    local: LRUCache=None):
+    """Caches the JSON responses of a view function, keyed by its URL
+    arguments and query string. Only successful responses are cached.
+
+    :param max_age: How long clients may use their copy without revalidating
+        it, in seconds
+    """
+    def wrap(view):
+        return CachedResponse(view, namespace, ttl, max_age, client, local)
+    return wrap
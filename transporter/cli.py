@@ -0,0 +1,196 @@
+"""Command line tools.
+
+    python -m transporter.cli --help
+"""
+import click
+from logbook import Logger, StreamHandler
+
+from transporter import create_app
+
+
+log = Logger(__name__)
+
+
+@click.group()
+def cli():
+    StreamHandler(click.get_text_stream('stderr')).push_application()
+
+
+@cli.command('export-graph')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def export_graph(path):
+    """Exports the station graph to a file that can be used as GRAPH_PATH."""
+    from transporter.graph import TransitGraph, dump_graph, graph_signature
+
+    app = create_app(__name__)
+    with app.app_context():
+        graph = TransitGraph.from_db()
+        dump_graph(graph, path, graph_signature())
+
+    log.info('Exported {} to {}'.format(graph, path))
+
+
+@cli.command('build-hierarchy')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--previous', type=click.Path(exists=True, dir_okay=False),
+              help='Reuse the node order of an earlier hierarchy.')
+def build_hierarchy(path, previous):
+    """Builds a contraction hierarchy that can be used as HIERARCHY_PATH."""
+    from transporter.contraction import ContractionHierarchy, \
+        dump_hierarchy, load_hierarchy
+    from transporter.graph import TransitGraph, graph_signature
+
+    app = create_app(__name__)
+    with app.app_context():
+        graph = TransitGraph.from_db()
+        if previous is not None:
+            previous = load_hierarchy(previous)
+        hierarchy = ContractionHierarchy.build(graph, previous)
+        dump_hierarchy(hierarchy, path, graph_signature())
+
+    log.info('Exported {} to {}'.format(hierarchy, path))
+
+
+@cli.command()
+@click.argument('route_ids', nargs=-1, type=int)
+@click.option('--from-file', type=click.File(),
+              help='Read route IDs from a file, one per line.')
+@click.option('--workers', default=8, show_default=True,
+              help='Maximum number of concurrent upstream requests.')
+@click.option('--batch-size', default=50, show_default=True,
+              help='Number of routes written per transaction.')
+def ingest(route_ids, from_file, workers, batch_size):
+    """Fetches and stores route information."""
+    from transporter.ingest import ingest_routes
+
+    route_ids = list(route_ids)
+    if from_file is not None:
+        route_ids.extend(int(line) for line in from_file if line.strip())
+
+    app = create_app(__name__)
+    with app.app_context():
+        report = ingest_routes(route_ids, workers, batch_size)
+
+    click.echo(str(report))
+
+
+@cli.command('refresh-routes')
+@click.argument('route_ids', nargs=-1, type=int)
+@click.option('--workers', default=8, show_default=True,
+              help='Maximum number of concurrent upstream requests.')
+@click.option('--batch-size', default=50, show_default=True,
+              help='Number of routes written per transaction.')
+def refresh_routes(route_ids, workers, batch_size):
+    """Fetches stored routes again and stores what changed. Refreshes all
+    stored routes unless route IDs are given."""
+    from transporter.ingest import refresh_routes
+
+    app = create_app(__name__)
+    with app.app_context():
+        report = refresh_routes(list(route_ids) or None, workers, batch_size)
+
+    click.echo(str(report))
+
+
+@cli.command('poll-arrivals')
+@click.option('--max-stations', default=500, show_default=True,
+              help='Maximum number of stations refreshed per cycle.')
+@click.option('--interval', default=10.0, show_default=True,
+              help='Seconds between cycles.')
+@click.option('--half-life', default=300.0, show_default=True,
+              help='Seconds it takes for request counts to halve.')
+@click.option('--min-hits', default=2.0, show_default=True,
+              help='Request count that makes a station hot.')
+@click.option('--workers', default=8, show_default=True,
+              help='Maximum number of concurrent upstream requests.')
+def poll_arrivals(max_stations, interval, half_life, min_hits, workers):
+    """Keeps arrival estimates of frequently requested stations fresh."""
+    from transporter.arrivals import ArrivalPoller
+
+    poller = ArrivalPoller(max_stations, interval, half_life, min_hits,
+                           workers)
+    app = create_app(__name__)
+    with app.app_context():
+        try:
+            poller.run()
+        except KeyboardInterrupt:
+            pass
+
+
+@cli.command('learn-travel-times')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.argument('route_ids', nargs=-1, type=int)
+@click.option('--interval', default=30.0, show_default=True,
+              help='Seconds between polls of vehicle positions.')
+@click.option('--save-interval', default=600.0, show_default=True,
+              help='Seconds between writes of the profiles.')
+@click.option('--bucket-size', default=900, show_default=True,
+              help='Seconds per time-of-day bucket of new profiles.')
+@click.option('--workers', default=8, show_default=True,
+              help='Maximum number of concurrent upstream requests.')
+def learn_travel_times(path, route_ids, interval, save_interval,
+                       bucket_size, workers):
+    """Learns travel times from vehicle positions into a file that can be
+    used as PROFILES_PATH. Updates the file if it exists. Follows all routes
+    of the graph unless ROUTE_IDS are given."""
+    import os
+    import time
+
+    from transporter.graph import GraphFileError, get_transit_graph, \
+        graph_signature
+    from transporter.profiles import RouteTracker, TravelTimeProfiles, \
+        dump_profiles, load_profiles, time_of_day
+    from transporter.upstream import UpstreamError
+    from transporter.utils import fan_out, get_vehicle_positions
+
+    app = create_app(__name__)
+    with app.app_context():
+        graph = get_transit_graph()
+        signature = graph_signature()
+        profiles = None
+        if os.path.exists(path):
+            try:
+                profiles = load_profiles(path, graph, signature,
+                                         writable=True)
+            except GraphFileError as e:
+                log.warn('Starting over: {}'.format(e))
+        if profiles is None:
+            profiles = TravelTimeProfiles(graph, bucket_size)
+
+        trackers = [RouteTracker(profiles, r)
+                    for r in (route_ids or graph.route_ids)]
+
+        def poll(tracker):
+            try:
+                return get_vehicle_positions(tracker.route_id)
+            except UpstreamError as e:
+                log.warn('Failed to poll route {}: {}'.format(
+                    tracker.route_id, e))
+                return None
+
+        saved_at = time.monotonic()
+        try:
+            while True:
+                started_at = time.monotonic()
+                polled_at = time_of_day()
+
+                observed = 0
+                for tracker, positions in zip(
+                        trackers, fan_out(poll, trackers, workers)):
+                    if positions is not None:
+                        observed += tracker.update(positions, polled_at)
+                log.info('Observed {} arcs'.format(observed))
+
+                if time.monotonic() - saved_at >= save_interval:
+                    dump_profiles(profiles, path, signature)
+                    saved_at = time.monotonic()
+
+                time.sleep(max(0, interval - (time.monotonic() - started_at)))
+        except KeyboardInterrupt:
+            dump_profiles(profiles, path, signature)
+
+    log.info('Saved {} to {}'.format(profiles, path))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,342 @@
+"""Contraction hierarchies for fast point-to-point queries.
+
+Preprocessing contracts the nodes of a `TransitGraph` one by one, in the
+order of increasing importance. Contracting a node removes it from the graph
+and adds a shortcut between each pair of its neighbors whose shortest path
+went through it. A query then runs a bidirectional Dijkstra in which both
+searches only move towards more important nodes, so each settles a small
+fraction of the graph (Geisberger et al., "Contraction Hierarchies: Faster
+and Simpler Hierarchical Routing in Road Networks").
+
+Node ordering is the expensive part of preprocessing. When routes are added
+to the database, `ContractionHierarchy.build()` can reuse the order of a
+previous hierarchy, which skips the ordering and leaves only the contraction
+itself.
+"""
+from array import array
+from heapq import heapify, heappop, heappush
+from threading import Lock
+
+from flask import current_app
+from logbook import Logger
+
+from transporter.graph import GraphFileError, TransitGraph, dump_arrays, \
+    graph_signature, load_arrays
+from transporter.routing import inf
+
+
+log = Logger(__name__)
+
+hierarchy_magic = b'TRNSCHGR'
+
+#: Witness searches give up after settling this many nodes. A failed search
+#: only adds a shortcut that may not be needed.
+witness_settle_limit = 64
+
+_lock = Lock()
+
+
+def _witness_search(out, contracted, source, excluded, limit: float):
+    """Bounded Dijkstra from `source` that avoids `excluded`."""
+    cost = {source: 0}
+    heap = [(0, source)]
+    settled = 0
+
+    while heap and settled < witness_settle_limit:
+        u_cost, u = heappop(heap)
+        if u_cost > cost.get(u, inf) or u_cost > limit:
+            continue
+        settled += 1
+        for v, c in out[u].items():
+            if v == excluded or contracted[v]:
+                continue
+            v_cost = u_cost + c
+            if v_cost < cost.get(v, inf):
+                cost[v] = v_cost
+                heappush(heap, (v_cost, v))
+
+    return cost
+
+
+class ContractionHierarchy(object):
+    """Upward and downward arcs of a contraction hierarchy in CSR arrays.
+
+    `up_*` arrays hold arcs `u -> v` with `rank[u] < rank[v]` grouped by `u`.
+    `down_*` arrays hold arcs `u -> v` with `rank[u] > rank[v]` grouped by `v`,
+    which is what the backward search needs. `*_middles` is the contracted
+    node a shortcut bypasses, or -1 for arcs of the original graph.
+    """
+
+    def __init__(self, station_ids, ranks, up_offsets, up_targets, up_weights,
+                 up_middles, down_offsets, down_sources, down_weights,
+                 down_middles):
+        self.station_ids = station_ids
+        self.ranks = ranks
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_weights = up_weights
+        self.up_middles = up_middles
+        self.down_offsets = down_offsets
+        self.down_sources = down_sources
+        self.down_weights = down_weights
+        self.down_middles = down_middles
+
+        self.index = {s: i for i, s in enumerate(station_ids)}
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def __repr__(self):
+        return u'<ContractionHierarchy: {} nodes, {} arcs>'.format(
+            len(self), len(self.up_targets) + len(self.down_sources))
+
+    @classmethod
+    def build(cls, graph: TransitGraph, previous=None):
+        """Contracts a graph.
+
+        :param previous: A hierarchy built from an earlier version of the
+            graph. Its node order is reused; nodes that are new to the graph
+            are contracted first.
+        """
+        n = len(graph)
+        out = [dict() for _ in range(n)]
+        inc = [dict() for _ in range(n)]
+        for u in range(n):
+            for v, c in graph.neighbors(u):
+                if u != v and c < out[u].get(v, inf):
+                    out[u][v] = c
+                    inc[v][u] = c
+
+        # (u, v) -> bypassed node
+        middles = {}
+        contracted = [False] * n
+        ranks = array('i', [0]) * n
+
+        def shortcuts(v):
+            """Returns the shortcuts needed to contract `v`."""
+            found = []
+            targets = [(w, c) for w, c in out[v].items() if not contracted[w]]
+            if not targets:
+                return found
+            max_out = max(c for _, c in targets)
+
+            for u, c_in in inc[v].items():
+                if contracted[u]:
+                    continue
+                witness = _witness_search(out, contracted, u, v,
+                                          c_in + max_out)
+                for w, c_out in targets:
+                    if w != u and witness.get(w, inf) > c_in + c_out:
+                        found.append((u, w, c_in + c_out))
+            return found
+
+        def priority(v):
+            # Edge difference plus the number of contracted neighbors, which
+            # spreads contraction evenly over the graph
+            degree = len(out[v]) + len(inc[v])
+            neighbors = sum(1 for u in inc[v] if contracted[u]) + \
+                sum(1 for w in out[v] if contracted[w])
+            return len(shortcuts(v)) - degree + neighbors
+
+        def contract(v, rank):
+            for u, w, c in shortcuts(v):
+                if c < out[u].get(w, inf):
+                    out[u][w] = c
+                    inc[w][u] = c
+                    middles[(u, w)] = v
+            contracted[v] = True
+            ranks[v] = rank
+
+        if previous is not None:
+            old_ranks = {previous.station_ids[i]: previous.ranks[i]
+                         for i in range(len(previous))}
+            order = sorted(range(n), key=lambda v: old_ranks.get(
+                graph.station_ids[v], -1))
+            for rank, v in enumerate(order):
+                contract(v, rank)
+        else:
+            heap = [(priority(v), v) for v in range(n)]
+            heapify(heap)
+            rank = 0
+            while heap:
+                _, v = heappop(heap)
+                # Priorities change as neighbors get contracted, so they are
+                # updated lazily
+                p = priority(v)
+                if heap and p > heap[0][0]:
+                    heappush(heap, (p, v))
+                    continue
+                contract(v, rank)
+                rank += 1
+
+        up = []
+        down = []
+        for u in range(n):
+            for v, c in out[u].items():
+                middle = middles.get((u, v), -1)
+                if ranks[u] < ranks[v]:
+                    up.append((u, v, c, middle))
+                else:
+                    down.append((v, u, c, middle))
+
+        return cls(array('i', graph.station_ids), ranks,
+                   *(_csr(up, n) + _csr(down, n)))
+
+    def _up(self, u: int):
+        for a in range(self.up_offsets[u], self.up_offsets[u + 1]):
+            yield self.up_targets[a], self.up_weights[a]
+
+    def _down(self, v: int):
+        for a in range(self.down_offsets[v], self.down_offsets[v + 1]):
+            yield self.down_sources[a], self.down_weights[a]
+
+    def query(self, source: int, target: int):
+        """Returns the cost and the list of station IDs of the shortest path
+        between two stations, and the number of nodes settled.
+
+        :param source: Station ID
+        :param target: Station ID
+        """
+        s, t = self.index[source], self.index[target]
+
+        costs = ({s: 0}, {t: 0})
+        prevs = ({s: None}, {t: None})
+        heaps = ([(0, s)], [(0, t)])
+        expand = (self._up, self._down)
+        settled = 0
+        best, meeting = inf, None
+
+        # Unlike plain bidirectional Dijkstra, neither search can stop at the
+        # first meeting node, only once its queue exceeds the best cost
+        while heaps[0] or heaps[1]:
+            for d in (0, 1):
+                heap, cost, prev = heaps[d], costs[d], prevs[d]
+                if not heap:
+                    continue
+                u_cost, u = heappop(heap)
+                if u_cost > cost[u]:
+                    continue
+                if u_cost >= best:
+                    del heap[:]
+                    continue
+
+                settled += 1
+                other = costs[1 - d].get(u)
+                if other is not None and u_cost + other < best:
+                    best, meeting = u_cost + other, u
+
+                for v, c in expand[d](u):
+                    v_cost = u_cost + c
+                    if v_cost < cost.get(v, inf):
+                        cost[v] = v_cost
+                        prev[v] = u
+                        heappush(heap, (v_cost, v))
+
+        if meeting is None:
+            return inf, [], settled
+
+        path = []
+        u = meeting
+        while u is not None:
+            path.append(u)
+            u = prevs[0][u]
+        path.reverse()
+        u = prevs[1][meeting]
+        while u is not None:
+            path.append(u)
+            u = prevs[1][u]
+
+        return best, [self.station_ids[i] for i in self._unpack(path)], \
+            settled
+
+    def _middle(self, u: int, v: int):
+        """Returns the node bypassed by the arc `u -> v`, or -1."""
+        if self.ranks[u] < self.ranks[v]:
+            for a in range(self.up_offsets[u], self.up_offsets[u + 1]):
+                if self.up_targets[a] == v:
+                    return self.up_middles[a]
+        else:
+            for a in range(self.down_offsets[v], self.down_offsets[v + 1]):
+                if self.down_sources[a] == u:
+                    return self.down_middles[a]
+        raise KeyError((u, v))
+
+    def _unpack(self, path: list):
+        """Replaces shortcuts in a path with the arcs they stand for."""
+        if len(path) < 2:
+            return path
+
+        unpacked = [path[0]]
+        stack = [(u, v) for u, v in zip(path[::-1][1:], path[::-1])]
+        while stack:
+            u, v = stack.pop()
+            middle = self._middle(u, v)
+            if middle < 0:
+                unpacked.append(v)
+            else:
+                stack.append((middle, v))
+                stack.append((u, middle))
+        return unpacked
+
+    def _arrays(self):
+        return [self.station_ids, self.ranks, self.up_offsets,
+                self.up_targets, self.up_weights, self.up_middles,
+                self.down_offsets, self.down_sources, self.down_weights,
+                self.down_middles]
+
+
+def _csr(arcs: list, n: int):
+    """Builds `(offsets, others, weights, middles)` arrays from `(node,
+    other, weight, middle)` tuples grouped by `node`."""
+    arcs.sort(key=lambda x: x[0])
+    offsets = array('i', [0]) * (n + 1)
+    others = array('i')
+    weights = array('f')
+    middles = array('i')
+    for node, other, weight, middle in arcs:
+        offsets[node + 1] += 1
+        others.append(other)
+        weights.append(weight)
+        middles.append(middle)
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    return offsets, others, weights, middles
+
+
+def dump_hierarchy(hierarchy: ContractionHierarchy, path: str,
+                   signature: int=0):
+    """Writes a hierarchy to a binary file in the same format as graph files.
+    """
+    dump_arrays(path, hierarchy_magic, hierarchy._arrays(), signature)
+
+
+def load_hierarchy(path: str, signature: int=None, verify: bool=True):
+    """Memory-maps a file written by `dump_hierarchy()`. See
+    `transporter.graph.load_arrays()` for the parameters."""
+    return ContractionHierarchy(
+        *load_arrays(path, hierarchy_magic, signature, verify))
+
+
+def get_contraction_hierarchy():
+    """Returns the hierarchy at `HIERARCHY_PATH` if it is up to date, or
+    `None`. Building one takes too long to do on demand."""
+    extensions = current_app.extensions
+    if 'contraction_hierarchy' not in extensions:
+        with _lock:
+            if 'contraction_hierarchy' not in extensions:
+                extensions['contraction_hierarchy'] = _load_hierarchy(
+                    current_app.config.get('HIERARCHY_PATH'))
+
+    return extensions['contraction_hierarchy']
+
+
+def _load_hierarchy(path):
+    if not path:
+        return None
+    try:
+        hierarchy = load_hierarchy(path, graph_signature(), verify=False)
+        log.info('Loaded {} from {}'.format(hierarchy, path))
+        return hierarchy
+    except (GraphFileError, OSError) as e:
+        log.warn('Could not load the contraction hierarchy: {}'.format(e))
+        return None
@@ -0,0 +1,543 @@
+"""A compact, read-only snapshot of the station graph.
+
+The graph is stored as compressed sparse rows (CSR). Stations are mapped to
+dense indices and the outgoing arcs of station `i` occupy the slots
+`offsets[i]` to `offsets[i + 1]` of the `targets`, `weights` and `routes`
+arrays. Each arc corresponds to a row of `route_edge_assoc`, that is, an edge
+served by a particular route. Edges that do not belong to any route are kept
+with a route index of -1.
+
+Station coordinates are kept alongside in `latitudes` and `longitudes` (NaN
+where unknown), and the service hours of route `r` in `service_windows[2 * r]`
+and `service_windows[2 * r + 1]` (seconds since midnight, -1 where unknown),
+so that time-dependent searches can tell whether an arc is usable in constant
+time. Point-to-point queries use them for the A* heuristic: no bus
+covers the straight-line distance between two stations faster than the
+fastest edge of the graph does, so that distance divided by `max_speed` is a
+lower bound of the travel time.
+
+A graph can be exported to a binary file with `dump_graph()` and loaded back
+with `load_graph()`. The loader memory-maps the file and uses the mapped pages
+as arrays without copying, so every worker process that loads the same file
+shares a single physical copy of the graph.
+
+`dump_arrays()` and `load_arrays()` implement the file format, which is
+shared with other precomputed data such as contraction hierarchies. Its
+layout (in native byte order) is
+
+    header | section table | section 1 | section 2 | ...
+
+where the section table holds the type code and the length of each array,
+and each section starts on an 8-byte boundary.
+"""
+from array import array
+from math import isnan
+import mmap
+import os
+import struct
+from threading import Lock
+import zlib
+
+from flask import current_app
+from logbook import Logger
+
+from transporter.routing import astar, earliest_arrivals, inf, \
+    reconstruct_path, shortest_paths
+from transporter.spatial import haversine
+
+
+log = Logger(__name__)
+
+#: Used for edges whose average time is unknown. This is the same value
+#: `transporter.utils.guess_time_diff()` falls back to.
+default_average_time = 150
+#: Edge times are derived from arrival times with a resolution of one minute,
+#: so some edges appear to take no time at all. These are given half of that
+#: resolution instead, so that the speed over every arc is finite.
+min_average_time = 30
+
+seconds_per_day = 24 * 3600
+
+#: Bump this whenever the file layout or the way weights are derived changes
+file_version = 5
+graph_magic = b'TRNSGRPH'
+#: Detects files written on a machine with a different byte order
+byte_order_mark = 0x01020304
+
+# magic, version, byte order mark, signature, checksum, number of sections
+header_format = '=8sIIIII'
+header_size = struct.calcsize(header_format)
+# type code, length
+section_format = '=c7xQ'
+section_size = struct.calcsize(section_format)
+
+_lock = Lock()
+
+
+class GraphFileError(Exception):
+    """Raised when a graph file cannot be used."""
+
+
+class StaleGraphError(GraphFileError):
+    """Raised when a graph file does not match the database anymore."""
+
+
+def in_service(service_windows, r: int, time_of_day: float):
+    """Tells whether the route with the dense index `r` runs at
+    `time_of_day` (seconds since midnight, possibly past a day).
+
+    :param service_windows: `(first, last)` pairs of seconds since midnight
+        in a flat array. `last` exceeds a day for routes running past
+        midnight, and `first` is negative where the hours are unknown.
+    """
+    if r < 0 or not service_windows:
+        return True
+    first = service_windows[2 * r]
+    if first < 0:
+        return True
+    t = time_of_day % seconds_per_day
+    last = service_windows[2 * r + 1]
+    return first <= t <= last or t + seconds_per_day <= last
+
+
+def make_service_windows(route_ids, windows: dict):
+    """Packs `(first, last)` tuples keyed by route ID into an array for
+    `in_service()`, in the order of `route_ids`. Missing or incomplete
+    windows are marked as unknown."""
+    packed = array('i')
+    for route_id in route_ids:
+        first, last = windows.get(route_id) or (None, None)
+        if first is None or last is None:
+            first = last = -1
+        packed.extend((first, last))
+    return packed
+
+
+class TransitGraph(object):
+    """Array-backed station graph shared by all request handlers."""
+
+    def __init__(self, station_ids, offsets, targets, weights, routes,
+                 route_ids, latitudes=None, longitudes=None,
+                 service_windows=None):
+        #: Dense index -> station ID
+        self.station_ids = station_ids
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        #: Arc -> dense route index (or -1)
+        self.routes = routes
+        #: Dense route index -> route ID
+        self.route_ids = route_ids
+        #: Dense index -> coordinates. Empty if they are not known at all.
+        self.latitudes = latitudes if latitudes is not None else array('d')
+        self.longitudes = longitudes if longitudes is not None \
+            else array('d')
+        #: Dense route index -> service hours. See `in_service()`.
+        self.service_windows = service_windows \
+            if service_windows is not None else array('i')
+
+        #: The file the graph was loaded from, if any
+        self.path = None
+
+        self._max_speed = None
+        self._route_index = None
+        self.index = {s: i for i, s in enumerate(station_ids)}
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def __repr__(self):
+        return u'<TransitGraph: {} stations, {} arcs>'.format(
+            len(self), self.arc_count)
+
+    @property
+    def arc_count(self):
+        return len(self.targets)
+
+    @property
+    def has_coordinates(self):
+        return len(self.latitudes) == len(self) > 0
+
+    @property
+    def max_speed(self):
+        """The highest speed over any arc in meters per second, or zero if
+        it is unknown.
+
+        Arcs built by `from_rows()` take at least `min_average_time`. No
+        finite speed bounds an arc that covers a distance in no time at all,
+        hence the speed is unknown if there are any.
+        """
+        if self._max_speed is None:
+            self._max_speed = self._find_max_speed()
+        return self._max_speed
+
+    def _find_max_speed(self):
+        if not self.has_coordinates:
+            return 0.0
+
+        lats, lons = self.latitudes, self.longitudes
+        targets, weights = self.targets, self.weights
+        speed = 0.0
+        for u in range(len(self)):
+            if isnan(lats[u]) or isnan(lons[u]):
+                continue
+            for a in range(self.offsets[u], self.offsets[u + 1]):
+                v, w = targets[a], weights[a]
+                if isnan(lats[v]) or isnan(lons[v]):
+                    continue
+                distance = haversine(lats[u], lons[u], lats[v], lons[v])
+                if w <= 0:
+                    if distance > 0:
+                        return 0.0
+                    continue
+                speed = max(speed, distance / w)
+        return speed
+
+    def heuristic(self, t: int):
+        """Returns a function that bounds the travel time from a node to the
+        node `t` from below. Nodes without coordinates get a bound of zero.
+        """
+        lats, lons = self.latitudes, self.longitudes
+        lat_t, lon_t = lats[t], lons[t]
+        speed = self.max_speed
+
+        if speed <= 0 or isnan(lat_t) or isnan(lon_t):
+            return lambda u: 0
+
+        def estimate(u):
+            lat, lon = lats[u], lons[u]
+            if isnan(lat) or isnan(lon):
+                return 0
+            return haversine(lat, lon, lat_t, lon_t) / speed
+
+        return estimate
+
+    @classmethod
+    def from_rows(cls, station_ids, arcs, coordinates=None,
+                  service_windows=None):
+        """Builds a graph in a single pass.
+
+        :param station_ids: An iterable of station IDs
+        :param arcs: An iterable of `(start, end, average_time, route_id)`
+            tuples ordered by `start`. `route_id` may be `None`. Times below
+            `min_average_time` are raised to it.
+        :param coordinates: An optional iterable of `(latitude, longitude)`
+            pairs in the same order as `station_ids`. Either may be `None`.
+        :param service_windows: An optional dictionary of `(first, last)`
+            service hours by route ID, see `in_service()`
+        """
+        station_ids = array('i', station_ids)
+        latitudes, longitudes = array('d'), array('d')
+        if coordinates is not None:
+            nan = float('nan')
+            for latitude, longitude in coordinates:
+                latitudes.append(nan if latitude is None else latitude)
+                longitudes.append(nan if longitude is None else longitude)
+            if len(latitudes) != len(station_ids):
+                raise ValueError('Expected coordinates of {} stations'
+                                 .format(len(station_ids)))
+
+        index = {s: i for i, s in enumerate(station_ids)}
+
+        offsets = array('i', [0]) * (len(station_ids) + 1)
+        targets = array('i')
+        weights = array('f')
+        routes = array('i')
+        route_index = {}
+
+        prev_start = -1
+        for start, end, average_time, route_id in arcs:
+            try:
+                u, v = index[start], index[end]
+            except KeyError:
+                log.warn('Skipping edge {} -> {} with an unknown station'
+                         .format(start, end))
+                continue
+
+            if u < prev_start:
+                raise ValueError('Arcs must be ordered by their start')
+            prev_start = u
+
+            if average_time is None:
+                average_time = default_average_time
+            elif average_time < min_average_time:
+                average_time = min_average_time
+
+            if route_id is None:
+                r = -1
+            else:
+                r = route_index.setdefault(route_id, len(route_index))
+
+            # `offsets[u + 1]` temporarily holds the out-degree of `u`
+            offsets[u + 1] += 1
+            targets.append(v)
+            weights.append(average_time)
+            routes.append(r)
+
+        for i in range(len(station_ids)):
+            offsets[i + 1] += offsets[i]
+
+        route_ids = array('i', sorted(route_index, key=route_index.get))
+        if service_windows is not None:
+            service_windows = make_service_windows(route_ids, service_windows)
+
+        return cls(station_ids, offsets, targets, weights, routes, route_ids,
+                   latitudes, longitudes, service_windows)
+
+    @classmethod
+    def from_db(cls):
+        """Builds a graph from a bulk scan of the `station`, `edge` and
+        `route_edge_assoc` tables. Arcs are always in the same order, as
+        travel-time profiles are indexed by arc."""
+
+        # In order to avoid circular import...
+        from transporter.models import Edge, Route, Station, db, \
+            route_edge_assoc
+
+        stations = db.session \
+            .query(Station.id, Station.latitude, Station.longitude) \
+            .order_by(Station.id).all()
+
+        arcs = db.session \
+            .query(Edge.start, Edge.end, Edge.average_time,
+                   route_edge_assoc.c.route_id) \
+            .outerjoin(route_edge_assoc,
+                       route_edge_assoc.c.edge_id == Edge.id) \
+            .order_by(Edge.start, Edge.id, route_edge_assoc.c.route_id) \
+            .yield_per(10000)
+
+        windows = {r: (first, last) for r, first, last in db.session.query(
+            Route.id, Route.first_time, Route.last_time)}
+
+        return cls.from_rows((s for s, _, _ in stations), arcs,
+                             ((lat, lon) for _, lat, lon in stations),
+                             windows)
+
+    def arcs(self, i: int):
+        """Returns the range of arc indices leaving the node `i`."""
+        return range(self.offsets[i], self.offsets[i + 1])
+
+    def find_arc(self, start: int, end: int, route_id: int=None):
+        """Returns the index of an arc between two stations, or `None`.
+
+        :param start: Station ID
+        :param end: Station ID
+        :param route_id: Prefer the arc served by this route
+        """
+        u, v = self.index.get(start), self.index.get(end)
+        if u is None or v is None:
+            return None
+
+        if self._route_index is None:
+            self._route_index = {r: i for i, r in enumerate(self.route_ids)}
+        r = self._route_index.get(route_id, -2)
+
+        found = None
+        for a in range(self.offsets[u], self.offsets[u + 1]):
+            if self.targets[a] == v:
+                if self.routes[a] == r:
+                    return a
+                if found is None:
+                    found = a
+        return found
+
+    def neighbors(self, i: int):
+        """Yields `(node, cost)` pairs of the node `i` in dense indices."""
+        targets, weights = self.targets, self.weights
+        for a in range(self.offsets[i], self.offsets[i + 1]):
+            yield targets[a], weights[a]
+
+    def neighbors_at(self, i: int, time_of_day: float):
+        """Same as `neighbors()`, but leaves out arcs of routes that are
+        not in service at `time_of_day`."""
+        targets, weights, routes = self.targets, self.weights, self.routes
+        windows = self.service_windows
+        for a in range(self.offsets[i], self.offsets[i + 1]):
+            if in_service(windows, routes[a], time_of_day):
+                yield targets[a], weights[a]
+
+    def shortest_path(self, source: int, target: int, heuristic: bool=True,
+                      departure: float=None):
+        """Returns the cost and the list of station IDs of the shortest path
+        between two stations.
+
+        :param source: Station ID
+        :param target: Station ID
+        :param heuristic: Use A* if station coordinates are known, otherwise
+            plain Dijkstra
+        :param departure: Seconds since midnight. If given, only routes in
+            service at the time each arc is reached are used.
+        """
+        s, t = self.index[source], self.index[target]
+        if departure is not None:
+            arrival, prev = earliest_arrivals(s, departure, self.neighbors_at,
+                                              target=t)
+            cost = {t: arrival[t] - departure} if t in arrival else {}
+        elif heuristic and self.has_coordinates:
+            cost, prev = astar(s, t, self.neighbors, self.heuristic(t))
+        else:
+            cost, prev = shortest_paths(s, self.neighbors, target=t)
+
+        path = [self.station_ids[i] for i in reconstruct_path(prev, t)]
+        return cost.get(t, inf), path
+
+
+def graph_signature():
+    """Summarizes the routes and edges in the database as a 32-bit number.
+    The signature changes whenever `store_route_info()` adds routes or edges,
+    or when refreshing routes changes which edges they have or their service
+    hours, which tells us that an exported graph file is out of date."""
+
+    from transporter.models import Edge, Route, db, route_edge_assoc
+
+    def aggregate(column):
+        # One subquery per table, as selecting from several tables at once
+        # would aggregate over their cartesian product
+        return db.session.query(column).as_scalar()
+
+    # Route IDs are large enough for their products to overflow 32 bits
+    route_id = db.cast(route_edge_assoc.c.route_id, db.BigInteger)
+    row = db.session.query(
+        aggregate(db.func.count(Route.id)), aggregate(db.func.max(Route.id)),
+        aggregate(db.func.count(Edge.id)), aggregate(db.func.max(Edge.id)),
+        aggregate(db.func.count(route_edge_assoc.c.edge_id)),
+        aggregate(db.func.sum(route_id * route_edge_assoc.c.edge_id)),
+        aggregate(db.func.sum(Route.first_time)),
+        aggregate(db.func.sum(Route.last_time))).one()
+
+    return zlib.crc32(repr(tuple(row)).encode('ascii'))
+
+
+def _padding(offset: int):
+    return -offset % 8
+
+
+def dump_arrays(path: str, magic: bytes, arrays: list, signature: int=0):
+    """Writes arrays to a binary file.
+
+    :param magic: Eight bytes identifying the kind of data
+    :param arrays: A list of `array.array` or `memoryview` objects
+    :param signature: See `graph_signature()`
+    """
+    table = b''.join(
+        struct.pack(section_format, a.format.encode('ascii')
+                    if isinstance(a, memoryview)
+                    else a.typecode.encode('ascii'), len(a))
+        for a in arrays)
+
+    payload = bytearray(table)
+    for a in arrays:
+        payload += bytes(_padding(header_size + len(payload)))
+        payload += bytes(a)
+
+    header = struct.pack(
+        header_format, magic, file_version, byte_order_mark, signature,
+        zlib.crc32(payload), len(arrays))
+
+    # Write to a temporary file first so that workers never map a partially
+    # written file
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as fout:
+        fout.write(header)
+        fout.write(payload)
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path: str, magic: bytes, signature: int=None,
+                verify: bool=True):
+    """Memory-maps a file written by `dump_arrays()`.
+
+    :param signature: If given, raise `StaleGraphError` unless the file was
+        written with the same signature
+    :param verify: Verify the checksum of the payload
+    :return: A list of `memoryview` objects
+    """
+    with open(path, 'rb') as fin:
+        # An empty file cannot be mapped at all
+        if os.fstat(fin.fileno()).st_size < header_size:
+            raise GraphFileError('{} is too short'.format(path))
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    file_magic, version, bom, file_signature, checksum, n_sections = \
+        struct.unpack_from(header_format, buf)
+
+    if file_magic != magic or bom != byte_order_mark:
+        raise GraphFileError('{} is not a {} file'.format(
+            path, magic.decode('ascii')))
+    if version != file_version:
+        raise GraphFileError('{} has version {} (expected {})'.format(
+            path, version, file_version))
+    if signature is not None and signature != file_signature:
+        raise StaleGraphError('{} is out of date'.format(path))
+
+    view = memoryview(buf)
+    if verify and zlib.crc32(view[header_size:]) != checksum:
+        raise GraphFileError('{} is corrupted'.format(path))
+
+    arrays = []
+    offset = header_size + n_sections * section_size
+    for i in range(n_sections):
+        typecode, length = struct.unpack_from(
+            section_format, buf, header_size + i * section_size)
+        typecode = typecode.decode('ascii')
+
+        offset += _padding(offset)
+        size = struct.calcsize(typecode) * length
+        arrays.append(view[offset:offset + size].cast(typecode))
+        offset += size
+
+    return arrays
+
+
+def dump_graph(graph: TransitGraph, path: str, signature: int=0):
+    """Writes a graph to a binary file.
+
+    :param signature: See `graph_signature()`
+    """
+    dump_arrays(path, graph_magic, [
+        graph.station_ids, graph.offsets, graph.targets, graph.weights,
+        graph.routes, graph.route_ids, graph.latitudes, graph.longitudes,
+        graph.service_windows], signature)
+
+
+def load_graph(path: str, signature: int=None, verify: bool=True):
+    """Memory-maps a graph file written by `dump_graph()`. See
+    `load_arrays()` for the parameters."""
+    graph = TransitGraph(*load_arrays(path, graph_magic, signature, verify))
+    graph.path = path
+    return graph
+
+
+def get_transit_graph():
+    """Returns the graph of the current application. The same instance is
+    shared by every request.
+
+    If `GRAPH_PATH` is configured and the file there is up to date, the graph
+    is memory-mapped from it. Otherwise it is built from the database.
+    """
+    graph = current_app.extensions.get('transit_graph')
+    if graph is None:
+        with _lock:
+            graph = current_app.extensions.get('transit_graph')
+            if graph is None:
+                graph = _load_or_build_graph(
+                    current_app.config.get('GRAPH_PATH'))
+                current_app.extensions['transit_graph'] = graph
+
+    return graph
+
+
+def _load_or_build_graph(path):
+    if path and os.path.exists(path):
+        try:
+            # Checking every page of the file would defeat the purpose of
+            # sharing them lazily, so only the header is verified here
+            graph = load_graph(path, graph_signature(), verify=False)
+            log.info('Loaded {} from {}'.format(graph, path))
+            return graph
+        except GraphFileError as e:
+            log.warn('Could not load the graph file: {}'.format(e))
+
+    graph = TransitGraph.from_db()
+    log.info('Built {}'.format(graph))
+    return graph
@@ -0,0 +1,556 @@
+"""Bulk ingestion of route information.
+
+Unlike `transporter.utils.store_route_info()`, which stores one route at a
+time and commits once per row, this fetches routes concurrently and writes
+each batch of routes in a single transaction with bulk
+`INSERT ... ON CONFLICT DO NOTHING` statements.
+
+Routes that are already stored are left alone by `ingest_routes()`.
+`refresh_routes()` brings them up to date instead. Each route keeps a hash of
+its topology (stations, edges and service hours, but none of the real-time
+fields of the raw data), so unchanged routes are skipped without touching
+the database and only what differs is written for changed ones:
+
+    python -m transporter.cli refresh-routes
+"""
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+import hashlib
+import json
+import time
+
+from logbook import Logger
+from sqlalchemy import bindparam, case, or_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from transporter.utils import fetch_route_raw, guess_time_diff, \
+    invalidate_route_cache, service_window
+
+
+log = Logger(__name__)
+
+
+class RouteRows(object):
+    """Rows to be inserted for a single route."""
+
+    def __init__(self, route: dict, stations: list, edges: list):
+        #: A row of the `route` table
+        self.route = route
+        #: Rows of the `station` table in the order of the route
+        self.stations = stations
+        #: `(start, end, average_time)` tuples
+        self.edges = edges
+
+
+def route_rows(raw: dict):
+    """Extracts rows from the raw route data as returned by
+    `fetch_route_raw()`. The same stations are rejected as in
+    `store_route_info()`."""
+
+    entries = raw['resultList']
+    first_entry = entries[0]
+    first_time, last_time = service_window(entries)
+
+    route = {
+        'id': int(first_entry['busRouteId']),
+        'number': first_entry['busRouteNm'],
+        'type': int(first_entry['routeType']),
+        'first_time': first_time,
+        'last_time': last_time,
+        'raw': raw,
+    }
+
+    stations = []
+    edges = []
+    prev_station_info = None
+
+    for station_info in entries:
+        try:
+            station_number = int(station_info['stationNo'])
+        except ValueError:
+            # `station_number` may be '미정차'
+            station_number = None
+
+        if station_number == 0:
+            log.warn(
+                'Rejecting station {0} for having a station number of zero'
+                ''.format(station_info['stationNm']))
+            continue
+
+        stations.append({
+            'id': int(station_info['station']),
+            'number': station_number,
+            'name': station_info['stationNm'],
+            'latitude': float(station_info['gpsY']),
+            'longitude': float(station_info['gpsX']),
+        })
+
+        if prev_station_info is not None:
+            edges.append((
+                int(prev_station_info['station']),
+                int(station_info['station']),
+                guess_time_diff(prev_station_info, station_info)))
+
+        prev_station_info = station_info
+
+    rows = RouteRows(route, stations, edges)
+    route['topology_hash'] = topology_hash(rows)
+    return rows
+
+
+def topology_hash(rows: RouteRows):
+    """A digest of the columns and associations stored for a route. Other
+    fields of the raw data, such as vehicle positions, are left out as they
+    change all the time."""
+    route = rows.route
+    topology = [
+        [route['number'], route['type'], route['first_time'],
+         route['last_time']],
+        [[s['id'], s['number'], s['name'], s['latitude'], s['longitude']]
+         for s in rows.stations],
+        rows.edges,
+    ]
+    data = json.dumps(topology, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class RouteDiff(object):
+    """Changes of the associations of a route with stations and edges."""
+
+    def __init__(self, stations: list, edges: set, rows: RouteRows):
+        """
+        :param stations: IDs of the stations currently associated with the
+            route, in the order of their sequence numbers, which run from
+            zero
+        :param edges: `(start, end)` pairs currently associated with the
+            route
+        :param rows: The rows of the route as it is now
+        """
+        new_stations = [station['id'] for station in rows.stations]
+        new_edges = {(start, end) for start, end, _ in rows.edges}
+
+        #: `(station_id, sequence)` pairs
+        self.added_stations = []
+        #: `(station_id, sequence)` pairs, with sequence numbers as they were
+        self.removed_stations = []
+        #: `(first, last, offset)` tuples. Sequence numbers from `first` to
+        #: `last` move by `offset`, e.g. by -1 after a removed station.
+        self.shifted_stations = []
+
+        # Stations are compared in the order of the route, so that removing
+        # or adding a stop does not replace every association after it
+        matcher = SequenceMatcher(None, stations, new_stations,
+                                  autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                if i1 != j1:
+                    self.shifted_stations.append((i1, i2 - 1, j1 - i1))
+                continue
+            self.removed_stations.extend(
+                (stations[i], i) for i in range(i1, i2))
+            self.added_stations.extend(
+                (new_stations[j], j) for j in range(j1, j2))
+
+        self.added_edges = new_edges - edges
+        self.removed_edges = edges - new_edges
+
+    def __bool__(self):
+        return bool(self.added_stations or self.removed_stations or
+                    self.shifted_stations or self.added_edges or
+                    self.removed_edges)
+
+    def __repr__(self):
+        return u'<RouteDiff: +{} -{} stations, +{} -{} edges>'.format(
+            len(self.added_stations), len(self.removed_stations),
+            len(self.added_edges), len(self.removed_edges))
+
+
+class IngestionReport(object):
+
+    def __init__(self):
+        self.routes = 0
+        self.new_routes = 0
+        self.stations = 0
+        self.edges = 0
+        self.failures = []
+        self.started_at = time.time()
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def __str__(self):
+        elapsed = self.elapsed
+        return (
+            'Ingested {} routes ({} new), {} new stations and {} new edges '
+            'in {:.1f}s ({:.2f} routes/s, {} failed)'.format(
+                self.routes, self.new_routes, self.stations, self.edges,
+                elapsed,
+                self.routes / elapsed if elapsed > 0 else 0,
+                len(self.failures)))
+
+
+class RefreshReport(IngestionReport):
+
+    def __init__(self):
+        super(RefreshReport, self).__init__()
+        self.changed_routes = 0
+        self.unchanged_routes = 0
+
+    def __str__(self):
+        elapsed = self.elapsed
+        return (
+            'Refreshed {} routes ({} new, {} changed, {} unchanged), '
+            '{} new stations and {} new edges in {:.1f}s ({:.2f} routes/s, '
+            '{} failed)'.format(
+                self.routes, self.new_routes, self.changed_routes,
+                self.unchanged_routes, self.stations, self.edges, elapsed,
+                self.routes / elapsed if elapsed > 0 else 0,
+                len(self.failures)))
+
+
+def fetch_route_rows(route_id: int):
+    raw = fetch_route_raw(route_id)
+    if not raw.get('resultList'):
+        raise ValueError('No data for route {}'.format(route_id))
+    return route_rows(raw)
+
+
+def write_batch(batch: list):
+    """Writes rows of several routes in a single transaction.
+
+    :param batch: A list of `RouteRows`
+    :return: The number of new `(routes, stations, edges)`
+    """
+    from transporter.models import Route, db, route_edge_assoc, \
+        route_station_assoc
+
+    # Deduplicate in memory before touching the database
+    stations = {}
+    edge_times = {}
+    for rows in batch:
+        for station in rows.stations:
+            stations.setdefault(station['id'], station)
+        for start, end, average_time in rows.edges:
+            edge_times.setdefault((start, end), average_time)
+
+    session = db.session
+    try:
+        # Routes that already exist are left alone, including their
+        # associations with stations and edges
+        route_ids = {r for r, in session.execute(
+            insert(Route.__table__)
+            .values([rows.route for rows in batch])
+            .on_conflict_do_nothing()
+            .returning(Route.id))}
+
+        new_station_count = _store_stations(session, stations)
+        edge_ids, new_edge_count = _store_edges(session, edge_times)
+
+        station_assoc = []
+        edge_assoc = []
+        for rows in batch:
+            route_id = rows.route['id']
+            if route_id not in route_ids:
+                continue
+            station_assoc.extend(
+                {'route_id': route_id, 'station_id': station['id'],
+                 'sequence': sequence}
+                for sequence, station in enumerate(rows.stations))
+            edge_assoc.extend(
+                {'route_id': route_id, 'edge_id': edge_ids[(s, e)]}
+                for s, e, _ in rows.edges)
+
+        if station_assoc:
+            session.execute(route_station_assoc.insert(), station_assoc)
+        if edge_assoc:
+            session.execute(route_edge_assoc.insert(), edge_assoc)
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    for rows in batch:
+        invalidate_route_cache(rows.route['raw'])
+
+    return len(route_ids), new_station_count, new_edge_count
+
+
+def _store_stations(session, stations: dict, update: bool=False):
+    """Inserts stations that do not exist yet.
+
+    :param stations: Rows of the `station` table by station ID
+    :param update: Update existing stations whose rows differ as well
+    :return: The number of new stations
+    """
+    from transporter.models import Station, db
+
+    if not stations:
+        return 0
+    statement = insert(Station.__table__).values(list(stations.values()))
+    if not update:
+        return session.execute(statement.on_conflict_do_nothing()).rowcount
+
+    existing = session.query(db.func.count(Station.id)).filter(
+        Station.id.in_(list(stations))).scalar()
+    columns = [Station.__table__.c[k] for k in next(iter(stations.values()))
+               if k != 'id']
+    session.execute(statement.on_conflict_do_update(
+        index_elements=[Station.id],
+        set_={c.name: statement.excluded[c.name] for c in columns},
+        # Stations that did not change are left alone
+        where=or_(*(c.is_distinct_from(statement.excluded[c.name])
+                    for c in columns))))
+    return len(stations) - existing
+
+
+def _store_edges(session, edge_times: dict, update: bool=False):
+    """Inserts edges that do not exist yet.
+
+    :param edge_times: Average times by `(start, end)`
+    :param update: Update the average times of existing edges as well
+    :return: A `(edge_ids, new_edge_count)` tuple, where `edge_ids` maps
+        each `(start, end)` to an edge ID
+    """
+    from transporter.models import Edge
+
+    # There is no unique constraint on (start, end), so existing edges are
+    # looked up first
+    edge_ids = {}
+    changed_times = []
+    if edge_times:
+        existing = session.query(
+            Edge.id, Edge.start, Edge.end, Edge.average_time).filter(
+            tuple_(Edge.start, Edge.end).in_(list(edge_times)))
+        for i, s, e, t in existing:
+            edge_ids[(s, e)] = i
+            if update and t != edge_times[(s, e)]:
+                changed_times.append(
+                    {'edge_id': i, 'new_time': edge_times[(s, e)]})
+
+    if changed_times:
+        session.execute(
+            Edge.__table__.update()
+            .where(Edge.id == bindparam('edge_id'))
+            .values(average_time=bindparam('new_time')), changed_times)
+
+    new_edges = [
+        {'start': s, 'end': e, 'average_time': t}
+        for (s, e), t in edge_times.items() if (s, e) not in edge_ids]
+    if new_edges:
+        inserted = session.execute(
+            insert(Edge.__table__).values(new_edges)
+            .returning(Edge.id, Edge.start, Edge.end))
+        edge_ids.update({(s, e): i for i, s, e in inserted})
+
+    return edge_ids, len(new_edges)
+
+
+def update_batch(batch: list):
+    """Brings routes that are already stored up to date in a single
+    transaction. Stations and edges of the routes are updated where they
+    differ, and only the associations that changed are written. Stations
+    and edges no longer on a route are kept, as other routes may use them.
+
+    :param batch: A list of `RouteRows` of routes whose topology hash
+        changed
+    :return: The number of new `(stations, edges)`
+    """
+    from transporter.models import Edge, Route, db, route_edge_assoc, \
+        route_station_assoc
+
+    route_ids = [rows.route['id'] for rows in batch]
+    sequence = route_station_assoc.c.sequence
+    session = db.session
+    try:
+        stations = {route_id: [] for route_id in route_ids}
+        sequences = {route_id: [] for route_id in route_ids}
+        for route_id, station_id, i in session.query(
+                route_station_assoc.c.route_id,
+                route_station_assoc.c.station_id, sequence).filter(
+                route_station_assoc.c.route_id.in_(route_ids)).order_by(
+                route_station_assoc.c.route_id, sequence):
+            stations[route_id].append(station_id)
+            sequences[route_id].append(i)
+
+        for route_id in route_ids:
+            if sequences[route_id] != list(range(len(stations[route_id]))):
+                # Stored before sequence numbers were, so the associations
+                # are written again
+                session.execute(route_station_assoc.delete().where(
+                    route_station_assoc.c.route_id == route_id))
+                stations[route_id] = []
+
+        edges = {route_id: {} for route_id in route_ids}
+        for route_id, edge_id, start, end in session.query(
+                route_edge_assoc.c.route_id, Edge.id, Edge.start, Edge.end) \
+                .join(Edge, Edge.id == route_edge_assoc.c.edge_id) \
+                .filter(route_edge_assoc.c.route_id.in_(route_ids)):
+            edges[route_id][(start, end)] = edge_id
+
+        all_stations = {}
+        edge_times = {}
+        for rows in batch:
+            for station in rows.stations:
+                all_stations.setdefault(station['id'], station)
+            for start, end, average_time in rows.edges:
+                edge_times.setdefault((start, end), average_time)
+
+        new_station_count = _store_stations(session, all_stations,
+                                            update=True)
+        edge_ids, new_edge_count = _store_edges(session, edge_times,
+                                                update=True)
+
+        station_assoc = []
+        edge_assoc = []
+        for rows in batch:
+            route_id = rows.route['id']
+            diff = RouteDiff(stations[route_id], set(edges[route_id]), rows)
+            log.debug('Route {}: {}'.format(route_id, diff))
+
+            if diff.removed_stations:
+                session.execute(route_station_assoc.delete().where(
+                    route_station_assoc.c.route_id == route_id).where(
+                    tuple_(route_station_assoc.c.station_id, sequence).in_(
+                        diff.removed_stations)))
+            if diff.shifted_stations:
+                # A single statement, so that each row is shifted once
+                session.execute(route_station_assoc.update().where(
+                    route_station_assoc.c.route_id == route_id).where(
+                    or_(*(sequence.between(first, last)
+                          for first, last, _ in diff.shifted_stations)))
+                    .values(sequence=case(
+                        [(sequence.between(first, last), sequence + offset)
+                         for first, last, offset in diff.shifted_stations],
+                        else_=sequence)))
+            if diff.removed_edges:
+                session.execute(route_edge_assoc.delete().where(
+                    route_edge_assoc.c.route_id == route_id).where(
+                    route_edge_assoc.c.edge_id.in_(
+                        [edges[route_id][e] for e in diff.removed_edges])))
+
+            station_assoc.extend(
+                {'route_id': route_id, 'station_id': station_id,
+                 'sequence': i}
+                for station_id, i in diff.added_stations)
+            edge_assoc.extend(
+                {'route_id': route_id, 'edge_id': edge_ids[e]}
+                for e in diff.added_edges)
+
+            session.execute(
+                Route.__table__.update()
+                .where(Route.id == route_id)
+                .values({k: v for k, v in rows.route.items() if k != 'id'}))
+
+        if station_assoc:
+            session.execute(route_station_assoc.insert(), station_assoc)
+        if edge_assoc:
+            session.execute(route_edge_assoc.insert(), edge_assoc)
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    for rows in batch:
+        invalidate_route_cache(rows.route['raw'])
+
+    return new_station_count, new_edge_count
+
+
+def _fetch_batches(route_ids: list, report: IngestionReport,
+                   max_workers: int, batch_size: int):
+    """Fetches routes concurrently and yields lists of `RouteRows` of up to
+    `batch_size` routes. Routes that cannot be fetched are recorded in the
+    report."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # All routes are queued at once, so the pool keeps fetching while
+        # earlier batches are being written
+        futures = [(r, executor.submit(fetch_route_rows, r))
+                   for r in route_ids]
+
+        for i in range(0, len(futures), batch_size):
+            batch = []
+            for route_id, future in futures[i:i + batch_size]:
+                try:
+                    batch.append(future.result())
+                except Exception as e:
+                    log.warn('Could not fetch route {}: {}'.format(
+                        route_id, e))
+                    report.failures.append(route_id)
+
+            if batch:
+                yield batch
+
+            log.info('{}/{} routes processed'.format(
+                min(i + batch_size, len(futures)), len(futures)))
+
+
+def ingest_routes(route_ids, max_workers: int=8, batch_size: int=50):
+    """Fetches and stores many routes.
+
+    :param route_ids: An iterable of route IDs
+    :param max_workers: Maximum number of concurrent upstream requests
+    :param batch_size: Number of routes written per transaction
+    :return: An `IngestionReport`
+    """
+    report = IngestionReport()
+
+    for batch in _fetch_batches(list(route_ids), report, max_workers,
+                                batch_size):
+        routes, stations, edges = write_batch(batch)
+        report.routes += len(batch)
+        report.new_routes += routes
+        report.stations += stations
+        report.edges += edges
+
+    report.finished_at = time.time()
+    log.info(str(report))
+
+    return report
+
+
+def refresh_routes(route_ids=None, max_workers: int=8,
+                   batch_size: int=50):
+    """Fetches routes again and stores what changed since they were stored.
+
+    :param route_ids: An iterable of route IDs. All stored routes by
+        default. Routes that are not stored yet are ingested.
+    :return: A `RefreshReport`
+    """
+    from transporter.models import Route, db
+
+    if route_ids is None:
+        route_ids = [r for r, in db.session.query(Route.id).order_by(
+            Route.id)]
+
+    report = RefreshReport()
+
+    for batch in _fetch_batches(list(route_ids), report, max_workers,
+                                batch_size):
+        hashes = dict(db.session.query(Route.id, Route.topology_hash).filter(
+            Route.id.in_([rows.route['id'] for rows in batch])))
+
+        new = [rows for rows in batch if rows.route['id'] not in hashes]
+        changed = [rows for rows in batch if rows.route['id'] in hashes and
+                   hashes[rows.route['id']] != rows.route['topology_hash']]
+
+        report.routes += len(batch)
+        report.unchanged_routes += len(batch) - len(new) - len(changed)
+        if new:
+            routes, stations, edges = write_batch(new)
+            report.new_routes += routes
+            report.stations += stations
+            report.edges += edges
+        if changed:
+            stations, edges = update_batch(changed)
+            report.changed_routes += len(changed)
+            report.stations += stations
+            report.edges += edges
+
+    report.finished_at = time.time()
+    log.info(str(report))
+
+    return report
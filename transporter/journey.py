@@ -0,0 +1,538 @@
+"""A round-based, transfer-aware journey planner.
+
+This follows the idea of RAPTOR (Delling et al., "Round-Based Public Transit
+Routing"). Round `k` finds the earliest arrival at every station using at
+most `k` buses, by scanning each route that serves a station improved in the
+previous round once, from the first such station onwards, followed by
+walking transfers to nearby stations. The arrivals of successive rounds give
+the Pareto set of journeys trading arrival time against number of transfers.
+
+We do not have timetables, only average travel times between consecutive
+stations of each route. Boarding a bus is therefore charged a fixed expected
+waiting time, `boarding_time`. Given a departure time, buses are only boarded
+within the service hours of their route.
+
+All times are in seconds, since midnight when a departure time is given.
+"""
+from array import array
+from itertools import groupby
+from threading import Lock
+
+from flask import current_app
+from logbook import Logger
+
+from transporter.graph import default_average_time, in_service, \
+    make_service_windows
+from transporter.routing import inf
+from transporter.spatial import StationIndex
+
+
+log = Logger(__name__)
+
+#: Stations within this many meters of each other are connected by walking
+default_transfer_radius = 200
+#: In meters per second
+default_walking_speed = 1.2
+#: Expected time waiting for a bus
+default_boarding_time = 300
+#: Maximum number of buses in a journey
+default_max_rounds = 5
+
+_lock = Lock()
+
+
+def _csr(rows: list, size: int, typecodes: tuple):
+    """Builds CSR arrays from `(row, value, ...)` tuples."""
+    rows.sort(key=lambda x: x[0])
+    offsets = array('i', [0]) * (size + 1)
+    columns = [array(typecode) for typecode in typecodes]
+    for row in rows:
+        offsets[row[0] + 1] += 1
+        for column, value in zip(columns, row[1:]):
+            column.append(value)
+    for i in range(size):
+        offsets[i + 1] += offsets[i]
+    return (offsets,) + tuple(columns)
+
+
+class RouteNetwork(object):
+    """Routes as sequences of stations, in compact arrays.
+
+    The stations of route `r` are `stops[route_offsets[r]:route_offsets[r +
+    1]]` and `times` holds the cumulative travel time from the first station
+    of the route to each of them. Stations are in dense indices.
+    """
+
+    def __init__(self, stations, routes,
+                 transfer_radius: float=default_transfer_radius,
+                 walking_speed: float=default_walking_speed,
+                 service_windows: dict=None):
+        """
+        :param stations: An iterable of `(station_id, latitude, longitude)`
+        :param routes: An iterable of `(route_id, stops)` where `stops` is a
+            list of `(station_id, time_from_previous_station)`
+        :param service_windows: `(first, last)` service hours by route ID.
+            See `transporter.graph.in_service()`.
+        """
+        self.station_ids = array('i')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        for station_id, latitude, longitude in stations:
+            self.station_ids.append(station_id)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+        self.index = {s: i for i, s in enumerate(self.station_ids)}
+
+        self.route_ids = array('i')
+        self.route_offsets = array('i', [0])
+        self.stops = array('i')
+        self.times = array('f')
+        for route_id, route_stops in routes:
+            elapsed = 0
+            count = 0
+            for station_id, time_diff in route_stops:
+                if station_id not in self.index:
+                    continue
+                elapsed += time_diff if count > 0 else 0
+                self.stops.append(self.index[station_id])
+                self.times.append(elapsed)
+                count += 1
+            if count > 0:
+                self.route_ids.append(route_id)
+                self.route_offsets.append(len(self.stops))
+
+        #: Dense route index -> service hours
+        self.service_windows = make_service_windows(
+            self.route_ids, service_windows or {})
+
+        # Station -> (route, position in the route)
+        self.station_route_offsets, self.station_routes, \
+            self.station_positions = _csr(
+                [(self.stops[a], r, a - self.route_offsets[r])
+                 for r in range(len(self.route_ids))
+                 for a in range(self.route_offsets[r],
+                                self.route_offsets[r + 1])],
+                len(self.station_ids), ('i', 'i'))
+
+        self.walking_speed = walking_speed
+        self.build_transfers(transfer_radius, walking_speed)
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def __repr__(self):
+        return u'<RouteNetwork: {} stations, {} routes, {} transfers>'.format(
+            len(self), len(self.route_ids), len(self.transfer_targets))
+
+    @classmethod
+    def from_db(cls, **kwargs):
+        """Builds a network from the `station`, `route_station_assoc`,
+        `route_edge_assoc` and `edge` tables. Routes whose stations have no
+        sequence number are skipped; refresh them to fix that, see
+        `transporter.ingest.refresh_routes()`."""
+
+        from transporter.models import Edge, Route, Station, db, \
+            route_edge_assoc, route_station_assoc
+
+        stations = db.session.query(
+            Station.id, Station.latitude, Station.longitude) \
+            .filter(Station.latitude.isnot(None)) \
+            .filter(Station.longitude.isnot(None))
+
+        edge_times = {
+            (r, s, e): t for r, s, e, t in db.session.query(
+                route_edge_assoc.c.route_id, Edge.start, Edge.end,
+                Edge.average_time)
+            .join(Edge, Edge.id == route_edge_assoc.c.edge_id)}
+
+        rows = db.session.query(
+            route_station_assoc.c.route_id, route_station_assoc.c.station_id,
+            route_station_assoc.c.sequence) \
+            .order_by(route_station_assoc.c.route_id,
+                      route_station_assoc.c.sequence)
+
+        def routes():
+            for route_id, group in groupby(rows, key=lambda x: x[0]):
+                group = list(group)
+                if any(sequence is None for _, _, sequence in group):
+                    log.warn('Skipping route {} without sequence numbers'
+                             .format(route_id))
+                    continue
+
+                stops = []
+                prev = None
+                for _, station_id, _ in group:
+                    t = edge_times.get((route_id, prev, station_id))
+                    stops.append((station_id, default_average_time
+                                  if t is None else t))
+                    prev = station_id
+                yield route_id, stops
+
+        windows = {r: (first, last) for r, first, last in db.session.query(
+            Route.id, Route.first_time, Route.last_time)}
+
+        return cls(stations, routes(), service_windows=windows, **kwargs)
+
+    def build_transfers(self, radius: float, walking_speed: float):
+        """Connects stations within `radius` meters of each other."""
+        self.spatial_index = index = StationIndex(
+            (s, None, None, lat, lon) for s, lat, lon in
+            zip(self.station_ids, self.latitudes, self.longitudes))
+
+        rows = []
+        for p in range(len(self)):
+            for d, q in index.within(
+                    self.latitudes[p], self.longitudes[p], radius):
+                if q != p:
+                    rows.append((p, q, d / walking_speed))
+
+        self.transfer_offsets, self.transfer_targets, self.transfer_times = \
+            _csr(rows, len(self), ('i', 'f'))
+
+    def access(self, latitude: float, longitude: float, radius: float):
+        """Snaps a location to the stations within `radius` meters.
+
+        :return: Station ID -> walking time between the location and the
+            station, to be used as `origins` or `targets` of a search
+        """
+        return {self.station_ids[p]: d / self.walking_speed
+                for d, p in self.spatial_index.within(
+                    latitude, longitude, radius)}
+
+    def routes_at(self, p: int):
+        """Yields `(route, position)` pairs of routes serving station `p`."""
+        for a in range(self.station_route_offsets[p],
+                       self.station_route_offsets[p + 1]):
+            yield self.station_routes[a], self.station_positions[a]
+
+    def transfers(self, p: int):
+        """Yields `(station, walking time)` pairs."""
+        for a in range(self.transfer_offsets[p], self.transfer_offsets[p + 1]):
+            yield self.transfer_targets[a], self.transfer_times[a]
+
+
+class Leg(object):
+
+    def __init__(self, mode: str, route_id, start: int, end: int,
+                 departure: float, arrival: float):
+        #: Either `bus` or `walk`
+        self.mode = mode
+        #: `None` for walking
+        self.route_id = route_id
+        #: Station IDs
+        self.start = start
+        self.end = end
+        self.departure = departure
+        self.arrival = arrival
+
+    def __repr__(self):
+        return u'<Leg {} {} -> {}>'.format(
+            self.route_id or self.mode, self.start, self.end)
+
+    def serialize(self):
+        return {
+            'mode': self.mode,
+            'route_id': self.route_id,
+            'start': self.start,
+            'end': self.end,
+            'departure': self.departure,
+            'arrival': self.arrival,
+        }
+
+
+class Journey(object):
+
+    def __init__(self, arrival: float, legs: list):
+        self.arrival = arrival
+        self.legs = legs
+
+    @property
+    def transfers(self):
+        return max(0, sum(1 for leg in self.legs if leg.mode == 'bus') - 1)
+
+    def __repr__(self):
+        return u'<Journey: arrival {:.0f}, {} transfers>'.format(
+            self.arrival, self.transfers)
+
+    def serialize(self, legs: bool=True):
+        serialized = {
+            'arrival': self.arrival,
+            'transfers': self.transfers,
+        }
+        if legs:
+            serialized['legs'] = [leg.serialize() for leg in self.legs]
+        return serialized
+
+
+class SearchState(object):
+    """Labels of a search from a set of origins. A single search answers
+    queries to any number of destinations."""
+
+    def __init__(self, departure: float, origins: dict):
+        self.departure = departure
+        self.origins = origins
+        #: `arrivals[k][p]` is the earliest arrival at `p` using at most `k`
+        #: buses
+        self.arrivals = []
+        #: `parents[k][p]` describes how `arrivals[k][p]` was reached, for
+        #: stations improved in round `k` only. It is either
+        #: `(route, boarding position, alighting position, boarding time)` or
+        #: `(-1, previous station, departure time, None)` for walking.
+        self.parents = []
+        #: `ride_parents[k][p]` describes the earliest arrival at `p` by bus
+        #: in round `k`, if it improved on earlier rounds. Walks start from
+        #: these, as walking twice in a row is not a transfer.
+        self.ride_parents = []
+
+
+class JourneyPlanner(object):
+
+    def __init__(self, network: RouteNetwork,
+                 boarding_time: float=default_boarding_time,
+                 max_rounds: int=default_max_rounds):
+        self.network = network
+        self.boarding_time = boarding_time
+        self.max_rounds = max_rounds
+
+    def search(self, origins: dict, departure: float=None,
+               targets: dict=None):
+        """Runs the rounds of the search.
+
+        :param origins: Station ID -> time to reach the station from the
+            actual origin (e.g., on foot)
+        :param departure: Departure time in seconds since midnight. If not
+            given, service hours are ignored and times are relative to a
+            departure at zero.
+        :param targets: If given (station ID -> time from the station to the
+            actual destination), stations that cannot lead to an earlier
+            arrival at a target are pruned
+        :return: A `SearchState`
+        """
+        return self._search(origins, departure,
+                            [targets] if targets else [])
+
+    def _search(self, origins: dict, departure: float, target_groups: list):
+        """Same as `search()`, but prunes only those stations that cannot
+        improve the arrival at any of `target_groups`, a list of `targets`
+        dictionaries."""
+        network = self.network
+        n = len(network)
+        windows = network.service_windows if departure is not None else None
+        departure = departure or 0
+        state = SearchState(departure, origins)
+
+        tau = array('d', [inf]) * n
+        best = array('d', [inf]) * n
+        #: The earliest arrival at each station by bus. A walking label may
+        #: be earlier but cannot be walked from.
+        best_ride = array('d', [inf]) * n
+        parents = {}
+        marked = set()
+
+        for station_id, access_time in origins.items():
+            p = network.index[station_id]
+            tau[p] = best[p] = min(tau[p], departure + access_time)
+            marked.add(p)
+
+        groups = [[(network.index[s], t) for s, t in targets.items()]
+                  for targets in target_groups]
+
+        def target_bound():
+            # A label no earlier than the best arrival at every group cannot
+            # improve any of them
+            return max((min((best[p] + t for p, t in group), default=inf)
+                        for group in groups), default=inf)
+
+        self._relax_transfers(tau, best, parents, marked,
+                              {p: tau[p] for p in marked}, target_bound())
+        state.arrivals.append(tau)
+        state.parents.append(parents)
+        state.ride_parents.append({})
+
+        for k in range(1, self.max_rounds + 1):
+            if not marked:
+                break
+
+            prev_tau = tau
+            tau = array('d', prev_tau)
+            parents = {}
+            ride_parents = {}
+            # Station -> arrival by bus in this round, where walks start
+            rides = {}
+
+            # Each route is scanned from the earliest marked station
+            queue = {}
+            for p in marked:
+                for r, position in network.routes_at(p):
+                    if position < queue.get(r, inf):
+                        queue[r] = position
+
+            marked = set()
+            bound = target_bound()
+            stops, times = network.stops, network.times
+
+            for r, start in queue.items():
+                offset = network.route_offsets[r]
+                end = network.route_offsets[r + 1] - offset
+
+                board_position = None
+                board_time = inf
+                for position in range(start, end):
+                    p = stops[offset + position]
+
+                    arrival = inf
+                    if board_position is not None:
+                        arrival = board_time + times[offset + position] - \
+                            times[offset + board_position]
+                        if arrival < best_ride[p] and arrival < bound:
+                            parent = (r, board_position, position,
+                                      board_time)
+                            best_ride[p] = rides[p] = arrival
+                            ride_parents[p] = parent
+                            if arrival < best[p]:
+                                tau[p] = best[p] = arrival
+                                parents[p] = parent
+                                marked.add(p)
+
+                    # Catching the bus here may be earlier
+                    if prev_tau[p] + self.boarding_time < arrival and \
+                            in_service(windows, r, prev_tau[p]):
+                        board_position = position
+                        board_time = prev_tau[p] + self.boarding_time
+
+            self._relax_transfers(tau, best, parents, marked, rides, bound)
+            state.arrivals.append(tau)
+            state.parents.append(parents)
+            state.ride_parents.append(ride_parents)
+
+        return state
+
+    def _relax_transfers(self, tau, best, parents, marked, sources: dict,
+                         bound):
+        """Walks from the stations in `sources` (station -> arrival time).
+        Labels set here are never walked from again, as footpaths are not
+        transitively closed."""
+        for p, departure in sources.items():
+            for q, walking_time in self.network.transfers(p):
+                arrival = departure + walking_time
+                if arrival < best[q] and arrival < bound:
+                    tau[q] = best[q] = arrival
+                    parents[q] = (-1, p, departure, None)
+                    marked.add(q)
+
+    def journeys(self, state: SearchState, targets: dict):
+        """Extracts Pareto-optimal journeys from a search.
+
+        :param targets: Station ID -> time from the station to the actual
+            destination
+        :return: A list of `Journey`, in the order of increasing number of
+            transfers and decreasing arrival time
+        """
+        network = self.network
+        target_indices = {network.index[s]: t for s, t in targets.items()}
+
+        journeys = []
+        best_arrival = inf
+        for k, tau in enumerate(state.arrivals):
+            arrival, p = min(((tau[p] + t, p)
+                              for p, t in target_indices.items()),
+                             default=(inf, None))
+            if arrival < best_arrival:
+                best_arrival = arrival
+                journeys.append(
+                    Journey(arrival, self._reconstruct(state, k, p)))
+
+        return journeys
+
+    def _reconstruct(self, state: SearchState, k: int, p: int):
+        network = self.network
+        legs = []
+
+        walked = False
+        while True:
+            if walked:
+                # A walk in round `k` starts from an arrival by bus in the
+                # same round, or from an origin
+                parent = state.ride_parents[k].get(p)
+            else:
+                # The label of `p` in round `k` was set in the latest round
+                # up to `k` in which `p` was improved
+                while k > 0 and p not in state.parents[k]:
+                    k -= 1
+                parent = state.parents[k].get(p)
+            if parent is None:
+                break
+
+            r, a, b, board_time = parent
+            walked = r < 0
+            if walked:
+                legs.append(Leg(
+                    'walk', None, network.station_ids[a],
+                    network.station_ids[p], b, state.arrivals[k][p]))
+                p = a
+            else:
+                offset = network.route_offsets[r]
+                start = network.stops[offset + a]
+                legs.append(Leg(
+                    'bus', network.route_ids[r], network.station_ids[start],
+                    network.station_ids[p], board_time,
+                    board_time + network.times[offset + b] -
+                    network.times[offset + a]))
+                p = start
+                k -= 1
+
+        legs.reverse()
+        return legs
+
+    def plan(self, origin: int, destination: int, departure: float=None):
+        """Finds journeys between two stations.
+
+        :param origin: Station ID
+        :param destination: Station ID
+        """
+        state = self.search({origin: 0}, departure,
+                            targets={destination: 0})
+        return self.journeys(state, {destination: 0})
+
+    def plan_many(self, queries: list, departure: float=None):
+        """Finds journeys for many origin/destination pairs at once. Pairs
+        with the same origins share a single search.
+
+        :param queries: A list of `(origins, targets)` tuples of dictionaries
+            as taken by `search()` and `journeys()`
+        :return: A list of lists of `Journey`, one for each query
+        """
+        by_origins = {}
+        for i, (origins, targets) in enumerate(queries):
+            by_origins.setdefault(frozenset(origins.items()), []).append(i)
+
+        results = [[] for _ in queries]
+        for key, indices in by_origins.items():
+            origins = dict(key)
+            if not origins:
+                continue
+            target_groups = [queries[i][1] for i in indices
+                             if queries[i][1]]
+            state = self._search(origins, departure, target_groups)
+            for i in indices:
+                if queries[i][1]:
+                    results[i] = self.journeys(state, queries[i][1])
+
+        return results
+
+
+def get_route_network():
+    """Returns the route network of the current application, building it on
+    first use."""
+    network = current_app.extensions.get('route_network')
+    if network is None:
+        with _lock:
+            network = current_app.extensions.get('route_network')
+            if network is None:
+                network = RouteNetwork.from_db(
+                    transfer_radius=current_app.config['TRANSFER_RADIUS'],
+                    walking_speed=current_app.config['WALKING_SPEED'])
+                log.info('Built {}'.format(network))
+                current_app.extensions['route_network'] = network
+
+    return network
@@ -1,14 +1,14 @@
-from collections import deque
 from datetime import datetime
-import json
 
 from flask_sqlalchemy import SQLAlchemy
-from geopy.distance import vincenty
 from geopy.point import Point
 from logbook import Logger
-import requests
 from sqlalchemy.dialects.postgresql import JSON
 
+from transporter.routing import shortest_paths
+from transporter.spatial import distances, haversine
+from transporter.upstream import STATION_BY_UID, upstream
+
 
 db = SQLAlchemy()
 JsonType = db.String().with_variant(JSON(), 'postgresql')
@@ -58,9 +58,9 @@ class GraphNode(object):
         self.data = data
         self.neighbor_cost_pairs = []
 
-    def add_neighbor(self, node):
+    def add_neighbor(self, node, cost=1):
         if node not in self.neighbors:
-            self.neighbors.append(node)
+            self.neighbor_cost_pairs.append((node, cost))
 
     @property
     def neighbors(self):
@@ -172,14 +172,14 @@ class Map(object):
         """Given a starting point, find all vertices (stations) within a
         rectangular bound. Initially, all vertices have an infinite cost.
         """
+        stations = list(stations)
+        station_distances = distances(
+            starting_point.latitude, starting_point.longitude,
+            [s.latitude for s in stations], [s.longitude for s in stations])
 
-        for station in stations:
-            location = Point(
-                latitude=station.latitude, longitude=station.longitude)
-            distance = vincenty(starting_point, location).m
-
+        for station, distance in zip(stations, station_distances):
             if distance <= radius:
-                station.cost = distance
+                station.cost = float(distance)
             else:
                 station.cost = inf
 
@@ -187,59 +187,24 @@ class Map(object):
 
     @staticmethod
     def calculate_distance_for_all_nodes(graph, starting_node_id: int):
-        queue = deque()
-        costs = {}
-
-        for key, value in graph.items():
-            node = value['node']
-            # edges = list(value['edges'])
-
-            if key != starting_node_id:
-                node.cost = inf
-                costs[key] = inf
-
-            queue.append(key)
-
-        # graph[starting_node_id]['node'].cost = 0
-        costs[starting_node_id] = 0
-
-        while len(queue) > 0:
-
-            min_cost_node_id = queue[0]
-            min_cost = costs[min_cost_node_id]
-            for key in queue:
-                if costs[key] < min_cost:
-                    min_cost = costs[key]
-                    min_cost_node_id = key
-
-            print(min_cost_node_id, min_cost, queue)
-
-            u = graph[min_cost_node_id]['node']
-            try:
-                queue.remove(min_cost_node_id)
-            except ValueError:
-                pass
-
-            # adjacent_nodes = [graph[e[0]]['node'] for e in u['edges']]
-            # adjacent_costs = [e[1] for e in u['edges']]
-
-            # print(adjacent_nodes)
-
-            # for v, c in zip(adjacent_nodes, adjacent_costs):
-            for v_key, c in graph[u.id]['edges']:
-                try:
-                    v = graph[v_key]['node']
-                except KeyError:
-                    continue
+        """Calculates the cost of reaching each node of a graph built by
+        `transporter.utils.build_graph()` from a starting node. The cost of
+        each node is stored in its `cost` attribute as well.
+        """
+        def neighbors(key):
+            for v_key, c in graph[key]['edges']:
+                # Edges may point to stations outside of the graph
+                if v_key in graph:
+                    yield v_key, c
 
-                # if u.cost + c < v.cost:
-                #     v.cost = u.cost + c
+        costs = dict.fromkeys(graph, inf)
+        reached, _ = shortest_paths(starting_node_id, neighbors)
+        costs.update(reached)
 
-                if costs[u.id] + c < costs[v.id]:
-                    costs[v.id] = costs[u.id] + c
-                print(costs[u.id], c, costs[v.id])
+        for key, value in graph.items():
+            value['node'].cost = costs[key]
 
-        print(costs)
+        return costs
 
 
 class Station(db.Model, CRUDMixin):
@@ -355,33 +320,38 @@ class Station(db.Model, CRUDMixin):
         return Edge.query.filter(Edge.start == self.id).all()
 
     def fetch(self):
-        from transporter.bus import STATION_URL
-        resp = requests.post(STATION_URL, data={'arsId': self.id})
-        return json.loads(resp.text)
+        return upstream.post_json(STATION_BY_UID, data={'arsId': self.id})
 
     def get_distance_to(self, latitude, longitude):
         assert self.latitude is not None
         assert self.longitude is not None
-        return vincenty(
-            (latitude, longitude), (self.latitude, self.longitude)).m
+        return haversine(latitude, longitude, self.latitude, self.longitude)
 
     def calculate_distance_to_stations(self, stations: list):
         """Calculate the distance from a particular station to each station in
         the list.
         """
-        for station in stations:
-            import pdb; pdb.set_trace()
+        return distances(self.latitude, self.longitude,
+                         [s.latitude for s in stations],
+                         [s.longitude for s in stations])
 
     @staticmethod
     def get_stations_in_bound(sw_latitude: float, sw_longitude: float,
                               ne_latitude: float, ne_longitude: float):
-        # Pathological case:
-        # SW = (0, 350), NE = (10, 10)
-        return Station.query \
+        query = Station.query \
             .filter(sw_latitude <= Station.latitude) \
-            .filter(Station.latitude <= ne_latitude) \
-            .filter(sw_longitude <= Station.longitude) \
-            .filter(Station.longitude <= ne_longitude)
+            .filter(Station.latitude <= ne_latitude)
+
+        if sw_longitude <= ne_longitude:
+            return query \
+                .filter(sw_longitude <= Station.longitude) \
+                .filter(Station.longitude <= ne_longitude)
+        else:
+            # The bound crosses the antimeridian, e.g. SW = (0, 350) and
+            # NE = (10, 10)
+            return query.filter(db.or_(
+                sw_longitude <= Station.longitude,
+                Station.longitude <= ne_longitude))
 
 
 # NOTE: How are we going to store the actual routes (roads taken by buses)?
@@ -408,6 +378,15 @@ class Route(db.Model, CRUDMixin):
     #: Route type
     type = db.Column(db.Integer)
 
+    #: Service hours in seconds since midnight, from the first departure at
+    #: the first station to the last arrival at the last one. `last_time`
+    #: exceeds a day for routes running past midnight.
+    first_time = db.Column(db.Integer)
+    last_time = db.Column(db.Integer)
+
+    #: See `transporter.ingest.topology_hash()`
+    topology_hash = db.Column(db.String(40))
+
     #: Many-to-many relationship between route and station
     stations = db.relationship(
         'Station', secondary=route_station_assoc, backref='route',
@@ -0,0 +1,257 @@
+"""Travel times of the arcs of the station graph by time of day.
+
+`Edge.average_time` is a single guess per edge, derived from the timetable.
+`TravelTimeProfiles` learns actual travel times instead, from the vehicle
+positions polled by `transporter.vehicles`, and keeps one running mean per
+arc of a `TransitGraph` and per time-of-day bucket (15 minutes by default).
+Means and observation counts live in two flat arrays, arc-major, so that
+looking up the weight of an arc is a single index computation:
+
+    profiles.weight(arc, departure_time)
+
+Arcs or buckets with too few observations fall back to the weight of the arc
+in the graph. Updates are incremental: once a bucket has seen
+`max_count` observations, older ones fade out exponentially, which lets the
+profiles follow changing traffic when they are learned continuously.
+
+    python -m transporter.cli learn-travel-times profiles.bin
+    export PROFILES_PATH="$PWD/profiles.bin"
+
+Profiles are tied to the arc indices of the graph they were learned on, so
+they are written with the signature of the graph and ignored once it changes.
+"""
+from array import array
+from datetime import datetime, timedelta, timezone
+import os
+from threading import Lock
+import time
+
+from flask import current_app
+from logbook import Logger
+
+from transporter.graph import GraphFileError, TransitGraph, dump_arrays, \
+    get_transit_graph, graph_signature, in_service, load_arrays, \
+    seconds_per_day
+from transporter.routing import earliest_arrivals, inf, reconstruct_path
+
+
+log = Logger(__name__)
+
+profiles_magic = b'TRNSPROF'
+
+#: Observations that take longer than this are assumed to be bogus
+max_travel_time = 1800
+
+#: Timetables and vehicle positions are in Asia/Seoul time, which has been
+#: UTC+9 without daylight saving time since 1988
+seoul = timezone(timedelta(hours=9), 'Asia/Seoul')
+
+_lock = Lock()
+
+
+def time_of_day(timestamp: float=None):
+    """Seconds since midnight in Seoul at a Unix time (now by default),
+    whatever the time zone of the machine is."""
+    if timestamp is None:
+        timestamp = time.time()
+    t = datetime.fromtimestamp(timestamp, seoul)
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+class TravelTimeProfiles(object):
+
+    def __init__(self, graph: TransitGraph, bucket_size: int=900,
+                 means=None, counts=None, min_count: int=3,
+                 max_count: int=1000):
+        """
+        :param bucket_size: Seconds per time-of-day bucket. Must divide a
+            day.
+        :param min_count: Observations a bucket needs to be used
+        :param max_count: Observations after which a bucket turns into an
+            exponential moving average
+        """
+        if seconds_per_day % bucket_size:
+            raise ValueError('A day must be a multiple of the bucket size')
+
+        self.graph = graph
+        self.bucket_size = bucket_size
+        self.buckets = seconds_per_day // bucket_size
+        self.min_count = min_count
+        self.max_count = max_count
+
+        size = graph.arc_count * self.buckets
+        self.means = means if means is not None \
+            else array('f', [0]) * size
+        #: Saturates at `max_count`
+        self.counts = counts if counts is not None \
+            else array('H', [0]) * size
+        if len(self.means) != size or len(self.counts) != size:
+            raise ValueError('Expected {} buckets'.format(size))
+
+    def __repr__(self):
+        return u'<TravelTimeProfiles: {} arcs, {} buckets>'.format(
+            self.graph.arc_count, self.buckets)
+
+    def _slot(self, arc: int, time_of_day: float):
+        bucket = int(time_of_day % seconds_per_day) // self.bucket_size
+        return arc * self.buckets + bucket
+
+    def observe(self, arc: int, time_of_day: float, travel_time: float):
+        """Adds an observation of an arc entered at `time_of_day` (seconds
+        since midnight) and left `travel_time` seconds later.
+
+        :return: `False` if the observation was discarded
+        """
+        if not 0 < travel_time <= max_travel_time:
+            return False
+        i = self._slot(arc, time_of_day)
+        count = min(self.counts[i] + 1, self.max_count)
+        self.means[i] += (travel_time - self.means[i]) / count
+        self.counts[i] = count
+        return True
+
+    def weight(self, arc: int, time_of_day: float):
+        """The travel time of an arc entered at `time_of_day`."""
+        i = self._slot(arc, time_of_day)
+        if self.counts[i] >= self.min_count:
+            return self.means[i]
+        return self.graph.weights[arc]
+
+    def neighbors(self, u: int, time_of_day: float):
+        """Yields `(node, cost)` pairs of the node `u` reached at
+        `time_of_day`, for `transporter.routing.earliest_arrivals()`. Arcs of
+        routes out of service are left out."""
+        graph = self.graph
+        targets, weights, routes = graph.targets, graph.weights, graph.routes
+        windows = graph.service_windows
+        means, counts, buckets = self.means, self.counts, self.buckets
+        bucket = int(time_of_day % seconds_per_day) // self.bucket_size
+        min_count = self.min_count
+        for a in range(graph.offsets[u], graph.offsets[u + 1]):
+            if not in_service(windows, routes[a], time_of_day):
+                continue
+            i = a * buckets + bucket
+            yield targets[a], (means[i] if counts[i] >= min_count
+                               else weights[a])
+
+    def shortest_path(self, source: int, target: int, departure: float):
+        """Same as `TransitGraph.shortest_path()`, for a departure at
+        `departure` seconds since midnight."""
+        graph = self.graph
+        s, t = graph.index[source], graph.index[target]
+        arrival, prev = earliest_arrivals(s, departure, self.neighbors,
+                                          target=t)
+
+        path = [graph.station_ids[i] for i in reconstruct_path(prev, t)]
+        return arrival.get(t, inf) - departure, path
+
+
+class RouteTracker(object):
+    """Infers the travel times of the arcs of a route from successive
+    snapshots of its vehicle positions.
+
+    Positions only tell at which stations there are buses, not which buses.
+    A bus is assumed to have moved from one station to the next when the
+    station is vacated and the next one is taken at the same time. The time
+    between a bus showing up at a station and at the next one is taken as
+    the travel time of the arc between them, with the resolution of the
+    polling interval.
+    """
+
+    def __init__(self, profiles: TravelTimeProfiles, route_id: int):
+        self.profiles = profiles
+        self.route_id = route_id
+        #: seq -> (station ID, time a bus showed up there)
+        self.arrivals = {}
+
+    def update(self, positions, time_of_day: float):
+        """
+        :param positions: Positions as returned by
+            `transporter.utils.get_vehicle_positions()`
+        :param time_of_day: Seconds since midnight
+        :return: The number of observations made
+        """
+        current = {p['seq']: p['station_id'] for p in positions}
+        arrivals = {}
+        observed = 0
+
+        for seq, station_id in current.items():
+            if seq in self.arrivals:
+                arrivals[seq] = self.arrivals[seq]
+                continue
+            arrivals[seq] = (station_id, time_of_day)
+
+            previous = self.arrivals.get(seq - 1)
+            if previous is None or seq - 1 in current:
+                continue
+            start, started_at = previous
+            arc = self.profiles.graph.find_arc(start, station_id,
+                                               self.route_id)
+            if arc is not None:
+                travel_time = (time_of_day - started_at) % seconds_per_day
+                observed += self.profiles.observe(arc, started_at,
+                                                  travel_time)
+
+        self.arrivals = arrivals
+        return observed
+
+
+def dump_profiles(profiles: TravelTimeProfiles, path: str,
+                  signature: int=0):
+    """Writes profiles to a binary file in the same format as graph files.
+
+    :param signature: The signature of the graph, see
+        `transporter.graph.graph_signature()`
+    """
+    parameters = array('i', [profiles.bucket_size, profiles.min_count,
+                             profiles.max_count])
+    dump_arrays(path, profiles_magic,
+                [parameters, profiles.means, profiles.counts], signature)
+
+
+def load_profiles(path: str, graph: TransitGraph, signature: int=None,
+                  verify: bool=True, writable: bool=False):
+    """Loads a file written by `dump_profiles()`. See
+    `transporter.graph.load_arrays()` for the parameters.
+
+    :param writable: Copy the arrays into memory so that the profiles can
+        be updated. Otherwise they are memory-mapped and read-only.
+    """
+    parameters, means, counts = load_arrays(
+        path, profiles_magic, signature, verify)
+    bucket_size, min_count, max_count = parameters
+    if writable:
+        means, counts = array('f', means), array('H', counts)
+    try:
+        return TravelTimeProfiles(graph, bucket_size, means, counts,
+                                  min_count, max_count)
+    except ValueError as e:
+        raise GraphFileError('{} does not match the graph: {}'.format(
+            path, e))
+
+
+def get_travel_time_profiles():
+    """Returns the profiles at `PROFILES_PATH` if they are up to date, or
+    `None`."""
+    extensions = current_app.extensions
+    if 'travel_time_profiles' not in extensions:
+        with _lock:
+            if 'travel_time_profiles' not in extensions:
+                extensions['travel_time_profiles'] = _load_profiles(
+                    current_app.config.get('PROFILES_PATH'),
+                    get_transit_graph())
+
+    return extensions['travel_time_profiles']
+
+
+def _load_profiles(path, graph):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        profiles = load_profiles(path, graph, graph_signature(),
+                                 verify=False)
+        log.info('Loaded {} from {}'.format(profiles, path))
+        return profiles
+    except GraphFileError as e:
+        log.warn('Could not load travel time profiles: {}'.format(e))
+        return None
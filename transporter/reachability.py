@@ -0,0 +1,149 @@
+"""Isochrones and travel-time matrices on the station graph.
+
+An isochrone is the set of stations reachable from a station within a time
+budget, which is a single Dijkstra search cut off at the budget. A matrix row
+is a search from one origin to all targets. Rows are independent of each
+other, so `travel_time_rows()` spreads them over a pool of worker processes
+that memory-map the same graph file, and yields each row as soon as it is
+done. Results are `array.array` objects rather than dictionaries.
+
+The pool of an application is created once by `get_matrix_pool()` and kept
+for its lifetime. Workers are started with the forkserver (or spawn) method,
+so they do not inherit the threads, sockets and locks of a web worker, and
+each loads the graph file on its first row.
+"""
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+import multiprocessing
+import os
+from threading import Lock
+
+from flask import current_app
+
+from transporter.graph import TransitGraph, load_graph
+from transporter.routing import inf, shortest_paths
+
+
+#: The graph of a worker process and the `(path, inode, mtime)` it was
+#: loaded from
+_worker_graph = None
+_worker_key = None
+
+_lock = Lock()
+
+
+def isochrone(graph: TransitGraph, source: int, budget: float):
+    """Finds the stations reachable from `source` within `budget` seconds.
+
+    :param source: Station ID
+    :return: A `(station_ids, times)` tuple of arrays, in the order of
+        increasing travel time
+    """
+    cost, _ = shortest_paths(graph.index[source], graph.neighbors,
+                             cutoff=budget)
+    reached = sorted((c, u) for u, c in cost.items())
+
+    station_ids = array('i', (graph.station_ids[u] for _, u in reached))
+    times = array('f', (c for c, _ in reached))
+    return station_ids, times
+
+
+def travel_time_row(graph: TransitGraph, source: int, targets,
+                    cutoff: float=inf):
+    """Travel times from one station to many.
+
+    :param source: Dense index of the origin
+    :param targets: Dense indices of the targets
+    :return: An array of travel times, `inf` for unreachable targets
+    """
+    cost, _ = shortest_paths(source, graph.neighbors, cutoff=cutoff)
+    return array('f', (cost.get(t, inf) for t in targets))
+
+
+def _worker_row(path: str, origin: int, targets: array, cutoff: float):
+    global _worker_graph, _worker_key
+    stat = os.stat(path)
+    key = (path, stat.st_ino, stat.st_mtime_ns)
+    if key != _worker_key:
+        _worker_graph = load_graph(path, verify=False)
+        _worker_key = key
+
+    graph = _worker_graph
+    row = travel_time_row(graph, graph.index[origin],
+                          [graph.index[t] for t in targets], cutoff)
+    return origin, row
+
+
+class MatrixPool(ProcessPoolExecutor):
+    """A pool of `max_workers` processes (one per CPU by default) for
+    `travel_time_rows()`. Processes are started as rows are submitted.
+    """
+
+    def __init__(self, max_workers: int=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in methods else 'spawn')
+        super(MatrixPool, self).__init__(self.max_workers,
+                                         mp_context=context)
+
+
+def get_matrix_pool():
+    """Returns the worker pool of the current application, or `None` if
+    `MATRIX_WORKERS` is zero. The same pool is shared by every request.
+    """
+    max_workers = current_app.config.get('MATRIX_WORKERS')
+    if max_workers == 0:
+        return None
+
+    pool = current_app.extensions.get('matrix_pool')
+    if pool is None:
+        with _lock:
+            pool = current_app.extensions.get('matrix_pool')
+            if pool is None:
+                pool = MatrixPool(max_workers)
+                current_app.extensions['matrix_pool'] = pool
+
+    return pool
+
+
+def travel_time_rows(graph: TransitGraph, origins: list, targets: list,
+                     cutoff: float=inf, pool: MatrixPool=None):
+    """Computes a travel-time matrix one row at a time.
+
+    If the graph was loaded from a file and a `pool` is given, rows are
+    computed by its processes, which load the same file. Otherwise they are computed in this process.
+
+    :param origins: Station IDs
+    :param targets: Station IDs
+    :return: A generator of `(origin, row)` tuples where `row` is an array
+        of travel times in the order of `targets`. Rows from a pool are
+        yielded in the order they finish.
+    """
+    if graph.path is None or pool is None:
+        target_indices = [graph.index[t] for t in targets]
+        for origin in origins:
+            yield origin, travel_time_row(
+                graph, graph.index[origin], target_indices, cutoff)
+        return
+
+    # Only a few rows are queued at a time so that finished rows do not pile
+    # up if the consumer is slower than the workers
+    window = 2 * pool.max_workers
+    targets = array('i', targets)
+    origins = iter(origins)
+    pending = {pool.submit(_worker_row, graph.path, origin, targets, cutoff)
+               for origin in islice(origins, window)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+            for origin in islice(origins, len(done)):
+                pending.add(pool.submit(_worker_row, graph.path, origin,
+                                        targets, cutoff))
+    finally:
+        # The consumer may stop early, e.g. if the client disconnects
+        for future in pending:
+            future.cancel()
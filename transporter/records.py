@@ -0,0 +1,95 @@
+"""Compact records for rows of upstream responses.
+
+`make_record()` generates a class with `__slots__` for a fixed set of fields,
+much like `collections.namedtuple`, except that its instances read like the
+dictionaries they replace (`entry['route_id']`, `'ars_id' in entry`, ...).
+Records take far less memory than dictionaries and are serialized to JSON
+objects through `json_default()`.
+"""
+from collections.abc import Mapping
+import keyword
+
+from flask.json import JSONEncoder
+
+
+class Record(Mapping):
+    """Base class of the classes made by `make_record()`."""
+
+    __slots__ = ()
+
+    #: Field names in order
+    _fields = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return u'{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(f, getattr(self, f)) for f in self._fields))
+
+    def __reduce__(self):
+        return type(self), tuple(getattr(self, f) for f in self._fields)
+
+    def as_dict(self):
+        return {f: getattr(self, f) for f in self._fields}
+
+
+def make_record(name: str, fields: tuple, module: str=None,
+                qualname: str=None):
+    """Makes a subclass of `Record` with the given fields. Its constructor
+    takes the values of all fields, positionally.
+
+    :param module: The module the class can be found in, for pickling
+    :param qualname: The path to the class within `module`
+    """
+    for field in fields:
+        if not field.isidentifier() or keyword.iskeyword(field) or \
+                field.startswith('_') or hasattr(Record, field):
+            raise ValueError('Invalid field name: {!r}'.format(field))
+
+    args = ', '.join(fields)
+    source = 'def __init__(self, {}):\n'.format(args) + ''.join(
+        '    self.{0} = {0}\n'.format(f) for f in fields)
+    source += 'def as_dict(self):\n    return {{{}}}\n'.format(', '.join(
+        '{0!r}: self.{0}'.format(f) for f in fields))
+
+    namespace = {}
+    exec(source, namespace)
+
+    return type(name, (Record,), {
+        '__module__': module or __name__,
+        '__qualname__': qualname or name,
+        '__slots__': tuple(fields),
+        '_fields': tuple(fields),
+        '_field_set': frozenset(fields),
+        '__init__': namespace['__init__'],
+        'as_dict': namespace['as_dict'],
+    })
+
+
+def json_default(obj):
+    """A `default` hook for `json.dumps()`."""
+    if isinstance(obj, Record):
+        return obj.as_dict()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+class RecordJSONEncoder(JSONEncoder):
+    """Lets `flask.jsonify()` serialize records."""
+
+    def default(self, obj):
+        if isinstance(obj, Record):
+            return obj.as_dict()
+        return super(RecordJSONEncoder, self).default(obj)
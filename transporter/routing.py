@@ -0,0 +1,156 @@
+"""Shortest-path routines shared by the routing code.
+
+Graphs are not tied to any particular representation here. Callers provide a
+`neighbors` callable that yields `(node, cost)` pairs for a given node, so the
+same engine works for the dict-based graphs built from `GraphNode` objects as
+well as for array-backed graphs.
+"""
+from heapq import heappop, heappush
+from itertools import count
+
+
+inf = float('inf')
+
+
+def shortest_paths(source, neighbors, target=None, cutoff=inf):
+    """Single-source Dijkstra over non-negative edge costs.
+
+    The priority queue is a binary heap with lazy deletion: a node may be
+    pushed several times and stale entries are skipped when popped, which
+    avoids a decrease-key operation altogether.
+
+    :param source: Starting node
+    :param neighbors: A callable that takes a node and returns an iterable of
+        `(node, cost)` pairs
+    :param target: If given, stop as soon as this node is settled
+    :param cutoff: Nodes farther than this are not settled
+    :return: A `(cost, prev)` tuple. `cost` maps each reached node to its
+        distance from `source` and `prev` maps it to its predecessor.
+    """
+    cost = {source: 0}
+    prev = {source: None}
+    settled = set()
+
+    # The counter breaks ties so that nodes themselves are never compared
+    tie = count()
+    heap = [(0, next(tie), source)]
+
+    while heap:
+        u_cost, _, u = heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+
+        if u == target:
+            break
+
+        for v, c in neighbors(u):
+            v_cost = u_cost + c
+            if v_cost < cost.get(v, inf) and v_cost <= cutoff:
+                cost[v] = v_cost
+                prev[v] = u
+                heappush(heap, (v_cost, next(tie), v))
+
+    return cost, prev
+
+
+def astar(source, target, neighbors, heuristic):
+    """Point-to-point A* search over non-negative edge costs.
+
+    Nodes are popped in the order of their cost plus `heuristic(node)`, an
+    estimate of the remaining cost to `target`. As long as the estimate never
+    exceeds the actual remaining cost, the path found is a shortest path and
+    far fewer nodes are settled than with `shortest_paths()`. A node is
+    settled again if a cheaper path to it turns up later, which only happens
+    with inconsistent estimates.
+
+    :param heuristic: A callable that takes a node and returns a lower bound
+        of its cost to `target`
+    :return: A `(cost, prev)` tuple as returned by `shortest_paths()`
+    """
+    cost = {source: 0}
+    prev = {source: None}
+    estimates = {}
+
+    tie = count()
+    heap = [(heuristic(source), next(tie), 0, source)]
+
+    while heap:
+        _, _, u_cost, u = heappop(heap)
+        if u_cost > cost[u]:
+            continue
+
+        if u == target:
+            break
+
+        for v, c in neighbors(u):
+            v_cost = u_cost + c
+            if v_cost < cost.get(v, inf):
+                cost[v] = v_cost
+                prev[v] = u
+                h = estimates.get(v)
+                if h is None:
+                    h = estimates[v] = heuristic(v)
+                heappush(heap, (v_cost + h, next(tie), v_cost, v))
+
+    return cost, prev
+
+
+def earliest_arrivals(source, departure: float, neighbors, target=None,
+                      cutoff=inf):
+    """Dijkstra over time-dependent edge costs, which depend on when an edge
+    is entered.
+
+    The result is exact as long as costs are FIFO, that is, entering an edge
+    later never means leaving it earlier. Averaged travel times are, as long
+    as they do not drop faster than time passes.
+
+    :param departure: Time of leaving `source`, in seconds since midnight
+    :param neighbors: A callable that takes a node and the time it is reached
+        at and returns an iterable of `(node, cost)` pairs
+    :param cutoff: Nodes reached more than this many seconds after
+        `departure` are not settled
+    :return: A `(arrival, prev)` tuple. `arrival` maps each reached node to
+        the time it is reached at and `prev` maps it to its predecessor.
+    """
+    arrival = {source: departure}
+    prev = {source: None}
+    settled = set()
+    deadline = departure + cutoff
+
+    tie = count()
+    heap = [(departure, next(tie), source)]
+
+    while heap:
+        u_time, _, u = heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+
+        if u == target:
+            break
+
+        for v, c in neighbors(u, u_time):
+            v_time = u_time + c
+            if v_time < arrival.get(v, inf) and v_time <= deadline:
+                arrival[v] = v_time
+                prev[v] = u
+                heappush(heap, (v_time, next(tie), v))
+
+    return arrival, prev
+
+
+def reconstruct_path(prev: dict, target):
+    """Returns the list of nodes from the source to `target`, or an empty list
+    if `target` was not reached."""
+    if target not in prev:
+        return []
+
+    path = []
+    node = target
+    while node is not None:
+        path.append(node)
+        node = prev[node]
+    path.reverse()
+
+    return path
@@ -0,0 +1,89 @@
+"""JSON encoding of API responses and cached values.
+
+`dumps()` and `loads()` use orjson when it is installed and fall back to the
+standard library otherwise. Output is always compact UTF-8.
+
+Values that are already encoded, such as those read from the cache, can be
+wrapped in `RawJSON` and passed to `json_response()`, which copies them into
+the response as they are instead of decoding and encoding them again.
+"""
+import json
+
+from flask import Response
+
+from transporter.records import json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class RawJSON(object):
+    """An encoded JSON value."""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __repr__(self):
+        return u'RawJSON({!r})'.format(self.data[:40])
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and self.data == other.data
+
+    def __hash__(self):
+        return hash(self.data)
+
+
+if orjson is not None:
+    _orjson_options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(value) -> bytes:
+        return orjson.dumps(value, default=json_default,
+                            option=_orjson_options)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                                default=json_default)
+
+    def dumps(value) -> bytes:
+        return _encoder.encode(value).encode('utf-8')
+
+    def loads(data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8')
+        return json.loads(data)
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, RawJSON):
+        return value.data
+    if isinstance(value, (list, tuple)) and \
+            any(isinstance(v, RawJSON) for v in value):
+        return b'[' + b','.join(_encode(v) for v in value) + b']'
+    return dumps(value)
+
+
+def encode(value) -> bytes:
+    """Same as `dumps()`, except that `RawJSON` objects are copied as they
+    are. They may be the value itself, values of a top-level dictionary or
+    items of a list found there."""
+    if isinstance(value, dict) and \
+            any(isinstance(v, (RawJSON, list, tuple)) for v in value.values()):
+        return b'{' + b','.join(
+            dumps(str(k)) + b':' + _encode(v) for k, v in value.items()) + \
+            b'}'
+    return _encode(value)
+
+
+def json_response(*args, **kwargs):
+    """A replacement of `flask.jsonify()` built on `encode()`. Takes either a
+    single value or keyword arguments."""
+    if args and kwargs:
+        raise TypeError('Pass either a value or keyword arguments')
+    value = args[0] if len(args) == 1 else list(args) if args else kwargs
+    return Response(encode(value), mimetype='application/json')
@@ -0,0 +1,263 @@
+"""An in-memory spatial index over stations.
+
+Stations are bucketed into a grid of cells of roughly `cell_size` meters. A
+radius query only looks at the cells overlapping the bounding box of the
+circle, and a k-nearest query scans rings of cells outwards from the query
+point until no unvisited cell can contain a closer station.
+
+`distances()` computes the distances from one point to many at once. It is
+vectorized with NumPy when it is installed and falls back to a plain loop
+otherwise.
+"""
+from array import array
+from math import asin, cos, radians, sin, sqrt
+from threading import Lock
+import time
+
+from flask import current_app
+from geopy.distance import vincenty
+from logbook import Logger
+from sqlalchemy.exc import SQLAlchemyError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+log = Logger(__name__)
+
+#: Mean radius of the earth in meters
+earth_radius = 6371008.8
+#: Length of one degree of latitude in meters
+meters_per_degree = 111195.0
+#: Seconds to wait before building the station index again if stations could
+#: not be loaded or there were none
+index_retry_interval = 60
+
+_lock = Lock()
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float):
+    """Great-circle distance in meters."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * asin(min(1.0, sqrt(a)))
+
+
+def equirectangular(lat1: float, lon1: float, lat2: float, lon2: float):
+    """Approximate distance in meters, which is accurate to well within a
+    meter for distances up to a few kilometers."""
+    x = radians(lon2 - lon1) * cos(radians((lat1 + lat2) / 2))
+    y = radians(lat2 - lat1)
+    return earth_radius * sqrt(x * x + y * y)
+
+
+def distances(latitude: float, longitude: float, latitudes, longitudes,
+              method: str='haversine', refine: float=None):
+    """Calculates the distances in meters from one point to many points.
+
+    :param latitudes: A sequence of latitudes (a NumPy array, an
+        `array.array` or a list)
+    :param longitudes: A sequence of longitudes of the same length
+    :param method: Either `haversine` or `equirectangular`. The latter is
+        cheaper and good enough for short distances.
+    :param refine: If given, distances up to this many meters are
+        recalculated with Vincenty's formulae on the WGS-84 ellipsoid
+    :return: A NumPy array if NumPy is available, otherwise an `array.array`
+    """
+    if method not in ('haversine', 'equirectangular'):
+        raise ValueError('Unknown method: {}'.format(method))
+
+    if np is not None:
+        result = _distances_numpy(latitude, longitude, latitudes, longitudes,
+                                  method)
+    else:
+        func = haversine if method == 'haversine' else equirectangular
+        result = array('d', (func(latitude, longitude, lat, lon)
+                             for lat, lon in zip(latitudes, longitudes)))
+
+    if refine is not None:
+        origin = (latitude, longitude)
+        for i, d in enumerate(result):
+            if d <= refine:
+                result[i] = vincenty(
+                    origin, (latitudes[i], longitudes[i])).m
+
+    return result
+
+
+def _distances_numpy(latitude, longitude, latitudes, longitudes, method):
+    lat1 = np.radians(latitude)
+    lat2 = np.radians(np.asarray(latitudes, dtype=np.float64))
+    dlon = np.radians(np.asarray(longitudes, dtype=np.float64) - longitude)
+
+    if method == 'haversine':
+        a = np.sin((lat2 - lat1) / 2) ** 2 + \
+            np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+        return 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    else:
+        x = dlon * np.cos((lat1 + lat2) / 2)
+        y = lat2 - lat1
+        return earth_radius * np.hypot(x, y)
+
+
+class StationIndex(object):
+    """A grid index over station coordinates.
+
+    :param stations: An iterable of `(station_id, ars_id, name, latitude,
+        longitude)` tuples
+    :param cell_size: Approximate size of grid cells in meters
+    """
+
+    def __init__(self, stations, cell_size: float=250):
+        self.ids = array('i')
+        self.ars_ids = []
+        self.names = []
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+
+        for station_id, ars_id, name, latitude, longitude in stations:
+            self.ids.append(station_id)
+            self.ars_ids.append(ars_id)
+            self.names.append(name)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+
+        self.cell_degrees = cell_size / meters_per_degree
+        self.cells = {}
+        for i, (lat, lon) in enumerate(zip(self.latitudes, self.longitudes)):
+            self.cells.setdefault(self.cell(lat, lon), array('i')).append(i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_db(cls, **kwargs):
+        from transporter.models import Station, db
+
+        stations = db.session.query(
+            Station.id, Station.number, Station.name, Station.latitude,
+            Station.longitude) \
+            .filter(Station.latitude.isnot(None)) \
+            .filter(Station.longitude.isnot(None)) \
+            .yield_per(10000)
+
+        return cls(stations, **kwargs)
+
+    def cell(self, latitude: float, longitude: float):
+        # Longitude cells are as wide in degrees as latitude cells. This makes
+        # them narrower in meters away from the equator, which only costs a
+        # few extra cells per query at the latitudes we deal with.
+        return (int(latitude // self.cell_degrees),
+                int(longitude // self.cell_degrees))
+
+    def _cell_span(self, latitude: float, radius: float):
+        """Number of cells to look at in each direction."""
+        lat_span = radius / meters_per_degree
+        lon_span = lat_span / max(cos(radians(latitude)), 1e-6)
+        return (int(lat_span // self.cell_degrees) + 1,
+                int(lon_span // self.cell_degrees) + 1)
+
+    def within(self, latitude: float, longitude: float, radius: float):
+        """Returns `(distance, index)` pairs of all stations within `radius`
+        meters, closest first."""
+        cy, cx = self.cell(latitude, longitude)
+        span_y, span_x = self._cell_span(latitude, radius)
+
+        lats, lons = self.latitudes, self.longitudes
+        found = []
+        for y in range(cy - span_y, cy + span_y + 1):
+            for x in range(cx - span_x, cx + span_x + 1):
+                for i in self.cells.get((y, x), ()):
+                    d = haversine(latitude, longitude, lats[i], lons[i])
+                    if d <= radius:
+                        found.append((d, i))
+
+        found.sort()
+        return found
+
+    def nearest(self, latitude: float, longitude: float, k: int=10,
+                max_radius: float=5000):
+        """Returns `(distance, index)` pairs of the `k` nearest stations
+        within `max_radius` meters, closest first."""
+        cy, cx = self.cell(latitude, longitude)
+        max_span_y, max_span_x = self._cell_span(latitude, max_radius)
+        # Any station in ring `r` or beyond is at least `(r - 1)` times this
+        # far away
+        ring_distance = self.cell_degrees * meters_per_degree * \
+            min(1.0, cos(radians(latitude)))
+
+        lats, lons = self.latitudes, self.longitudes
+        found = []
+        for r in range(max(max_span_y, max_span_x) + 1):
+            if len(found) >= k and found[k - 1][0] <= (r - 1) * ring_distance:
+                break
+
+            for y in range(cy - r, cy + r + 1):
+                # Only the border of the ring is new
+                step = 1 if abs(y - cy) == r else 2 * r
+                for x in range(cx - r, cx + r + 1, max(step, 1)):
+                    for i in self.cells.get((y, x), ()):
+                        d = haversine(latitude, longitude, lats[i], lons[i])
+                        if d <= max_radius:
+                            found.append((d, i))
+            found.sort()
+
+        return found[:k]
+
+    def serialize(self, distance: float, i: int):
+        """Serializes a station in the same form as `NearestStationsMapper`
+        does."""
+        return {
+            'latitude': self.latitudes[i],
+            'longitude': self.longitudes[i],
+            'ars_id': self.ars_ids[i],
+            'station_name': self.names[i],
+            'distance_from_current_location': int(distance),
+        }
+
+    def nearest_stations(self, latitude: float, longitude: float,
+                         radius: int=300):
+        """A local counterpart of `transporter.utils.get_nearest_stations()`.
+        Stations without a station number are left out as there is nothing
+        to look up for them."""
+        return [self.serialize(d, i)
+                for d, i in self.within(latitude, longitude, radius)
+                if self.ars_ids[i] is not None]
+
+
+def get_station_index():
+    """Returns the station index of the current application, building it on
+    first use. If stations cannot be loaded from the database, or there are
+    none yet, an empty index is returned and callers are expected to fall
+    back to the upstream service. Such an index is not kept, and building it
+    is tried again after `index_retry_interval` seconds.
+    """
+    index = current_app.extensions.get('station_index')
+    if index is not None:
+        return index
+
+    with _lock:
+        index = current_app.extensions.get('station_index')
+        if index is not None:
+            return index
+        if time.monotonic() < \
+                current_app.extensions.get('station_index_retry_at', 0):
+            return StationIndex([])
+
+        try:
+            index = StationIndex.from_db()
+        except SQLAlchemyError as e:
+            log.warn('Could not load stations: {}'.format(e))
+            index = StationIndex([])
+
+        if len(index) > 0:
+            log.info('Indexed {} stations'.format(len(index)))
+            current_app.extensions['station_index'] = index
+        else:
+            current_app.extensions['station_index_retry_at'] = \
+                time.monotonic() + index_retry_interval
+
+    return index
@@ -0,0 +1,397 @@
+"""A shared client for the upstream service at m.bus.go.kr.
+
+All upstream calls go through `upstream`, a connection-pooled session with
+per-endpoint timeouts, bounded retries with exponential backoff and a circuit
+breaker that fails fast while the upstream service is down.
+
+Responses list their items under `resultList`. `UpstreamClient.iter_results()`
+parses those items one at a time as the body arrives, so that a long route
+never has to be held in memory as a whole, neither as text nor as a decoded
+object.
+
+`async_upstream` is the asyncio counterpart of `upstream`, used by the ASGI
+application in `transporter.asgi`. It requires httpx.
+"""
+import asyncio
+import codecs
+import json
+from threading import Lock
+import time
+
+from logbook import Logger
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+log = Logger(__name__)
+
+default_base_url = 'http://m.bus.go.kr/mBus/bus/'
+
+STATION_BY_POS = 'getStationByPos.bms'
+STATION_BY_UID = 'getStationByUid.bms'
+ROUTE_AND_POS = 'getRouteAndPos.bms'
+
+#: (connect, read) timeouts in seconds
+default_timeouts = {
+    STATION_BY_POS: (3.05, 5),
+    STATION_BY_UID: (3.05, 5),
+    ROUTE_AND_POS: (3.05, 10),
+}
+default_timeout = (3.05, 10)
+
+#: Bytes read from a streamed response at a time
+chunk_size = 16 * 1024
+
+
+class UpstreamError(Exception):
+    """Raised when the upstream service could not serve a request."""
+
+
+class UpstreamUnavailable(UpstreamError):
+    """Raised without making a request while the circuit is open."""
+
+
+class CircuitBreaker(object):
+    """Stops calling the upstream service after `failure_threshold`
+    consecutive failures. After `reset_timeout` seconds a single trial call is
+    let through; the circuit closes again if it succeeds."""
+
+    def __init__(self, failure_threshold: int=5, reset_timeout: float=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise UpstreamUnavailable('Circuit is open')
+            # Half-open: let this call through, but keep failing fast for the
+            # others until it completes
+            self.opened_at = time.monotonic()
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log.warn('Opening circuit after {} failures'.format(
+                        self.failures))
+                self.opened_at = time.monotonic()
+
+
+class _JSONStream(object):
+    """A cursor over JSON text that arrives in chunks."""
+
+    whitespace = ' \t\n\r'
+    number_chars = '0123456789.eE+-'
+
+    def __init__(self, chunks, encoding: str):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def fill(self):
+        """Reads one more chunk. Returns `False` at the end of the input."""
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        # Consumed text is dropped so that the buffer stays small
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character, or `''` at the end."""
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars: str):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of {!r} at {!r}'.format(
+                chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # Most likely the value continues in the next chunk
+                if not self.fill():
+                    raise
+                continue
+            # A number may continue in the next chunk, unless it is followed
+            # by something else
+            if (end < len(self.buf) and
+                    self.buf[end] not in self.number_chars) or \
+                    not self.fill():
+                self.pos = end
+                return value
+
+
+def iter_json_items(chunks, key: str='resultList', encoding: str='utf-8'):
+    """Yields the items of an array under `key` of a top-level JSON object
+    without decoding the rest of the document.
+
+    :param chunks: An iterable of `bytes`
+    """
+    stream = _JSONStream(chunks, encoding)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name == key:
+            if stream.peek() != '[':
+                # `null`, most likely
+                stream.value()
+                return
+            stream.expect('[')
+            if stream.peek() == ']':
+                return
+            while True:
+                yield stream.value()
+                if stream.expect(',]') == ']':
+                    return
+        stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+
+retry_statuses = (500, 502, 503, 504)
+
+
+def make_retry(total: int, backoff_factor: float):
+    kwargs = dict(
+        total=total, backoff_factor=backoff_factor,
+        status_forcelist=retry_statuses, raise_on_status=False)
+    # The upstream endpoints are read-only, so retrying POST is safe
+    try:
+        return Retry(allowed_methods=frozenset(['POST']), **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(['POST']), **kwargs)
+
+
+class UpstreamClient(object):
+
+    def __init__(self, base_url: str=default_base_url, timeouts: dict=None,
+                 retries: int=2, backoff_factor: float=0.2,
+                 pool_maxsize: int=32, circuit_breaker: CircuitBreaker=None):
+        self.base_url = base_url
+        self.timeouts = dict(default_timeouts)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_maxsize = pool_maxsize
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.session = self.make_session()
+
+    def init_app(self, app):
+        """Reads `UPSTREAM_BASE_URL` from the application config."""
+        self.base_url = app.config.get('UPSTREAM_BASE_URL') or self.base_url
+
+    def make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.pool_maxsize,
+            max_retries=make_retry(self.retries, self.backoff_factor))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def url(self, endpoint: str):
+        return self.base_url + endpoint
+
+    def post(self, endpoint: str, data: dict, stream: bool=False):
+        """Posts form data to an endpoint.
+
+        :param endpoint: One of `STATION_BY_POS`, `STATION_BY_UID` and
+            `ROUTE_AND_POS`
+        :return: A `requests.Response`
+        """
+        self.circuit_breaker.before_call()
+        try:
+            resp = self.session.post(
+                self.url(endpoint), data=data, stream=stream,
+                timeout=self.timeouts.get(endpoint, default_timeout))
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            self.circuit_breaker.on_failure()
+            raise UpstreamError(
+                'Request to {} failed: {}'.format(endpoint, e)) from e
+
+        self.circuit_breaker.on_success()
+        return resp
+
+    def post_json(self, endpoint: str, data: dict):
+        """Same as `post()`, but returns a decoded JSON response."""
+        resp = self.post(endpoint, data)
+        # `resp.text` would guess the encoding of an undeclared body by
+        # scanning all of it
+        return json.loads(resp.content.decode(resp.encoding or 'utf-8'))
+
+    def iter_results(self, endpoint: str, data: dict):
+        """Same as `post()`, but yields the items of `resultList` as the
+        response body is being received.
+
+        :raise UpstreamError: If the body is not what we expected
+        """
+        resp = self.post(endpoint, data, stream=True)
+        try:
+            yield from iter_json_items(
+                resp.iter_content(chunk_size),
+                encoding=resp.encoding or 'utf-8')
+        except (ValueError, requests.RequestException) as e:
+            raise UpstreamError(
+                'Could not load data from {}: {}'.format(endpoint, e)) from e
+        finally:
+            resp.close()
+
+
+class AsyncUpstreamClient(object):
+    """Same as `UpstreamClient`, but for asyncio.
+
+    The underlying `httpx.AsyncClient` is created on first use and belongs to
+    the event loop it was created in; `aclose()` releases it. Unless one is
+    given, the circuit breaker of `upstream` is used, so that both serving
+    modes agree on the state of the upstream service.
+    """
+
+    def __init__(self, base_url: str=default_base_url, timeouts: dict=None,
+                 retries: int=2, backoff_factor: float=0.2,
+                 max_connections: int=512,
+                 circuit_breaker: CircuitBreaker=None):
+        self.base_url = base_url
+        self.timeouts = dict(default_timeouts)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_connections = max_connections
+        self._circuit_breaker = circuit_breaker
+        self._client = None
+
+    def init_app(self, app):
+        """Reads `UPSTREAM_BASE_URL` from the application config."""
+        self.base_url = app.config.get('UPSTREAM_BASE_URL') or self.base_url
+
+    @property
+    def circuit_breaker(self):
+        if self._circuit_breaker is not None:
+            return self._circuit_breaker
+        return upstream.circuit_breaker
+
+    @property
+    def client(self):
+        if self._client is None:
+            if httpx is None:
+                raise RuntimeError('httpx is required for the async client')
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=min(self.max_connections, 64)))
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def url(self, endpoint: str):
+        return self.base_url + endpoint
+
+    def timeout(self, endpoint: str):
+        connect, read = self.timeouts.get(endpoint, default_timeout)
+        return httpx.Timeout(read, connect=connect)
+
+    async def post(self, endpoint: str, data: dict):
+        """Posts form data to an endpoint.
+
+        :return: A `httpx.Response` whose body has been read
+        """
+        client = self.client
+        self.circuit_breaker.before_call()
+        try:
+            resp = await self._post_with_retries(client, endpoint, data)
+            resp.raise_for_status()
+        except httpx.HTTPError as e:
+            self.circuit_breaker.on_failure()
+            raise UpstreamError(
+                'Request to {} failed: {}'.format(endpoint, e)) from e
+
+        self.circuit_breaker.on_success()
+        return resp
+
+    async def _post_with_retries(self, client, endpoint: str, data: dict):
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                resp = await client.post(
+                    self.url(endpoint), data=data,
+                    timeout=self.timeout(endpoint))
+                if resp.status_code not in retry_statuses or last_attempt:
+                    return resp
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def post_json(self, endpoint: str, data: dict):
+        """Same as `post()`, but returns a decoded JSON response."""
+        resp = await self.post(endpoint, data)
+        return json.loads(resp.content.decode(
+            resp.charset_encoding or 'utf-8'))
+
+    async def results(self, endpoint: str, data: dict):
+        """Same as `post()`, but returns the items of `resultList`."""
+        resp = await self.post(endpoint, data)
+        try:
+            return list(iter_json_items(
+                [resp.content], encoding=resp.charset_encoding or 'utf-8'))
+        except ValueError as e:
+            raise UpstreamError(
+                'Could not load data from {}: {}'.format(endpoint, e)) from e
+
+
+upstream = UpstreamClient()
+async_upstream = AsyncUpstreamClient()
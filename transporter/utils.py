@@ -1,134 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import json
+from itertools import chain
 
+from flask import current_app, has_app_context
 from logbook import Logger
 from sqlalchemy.exc import IntegrityError
-import requests
 
-from transporter import redis_store
+from transporter.cache import LRUCache, cached, ttl_nearby, ttl_positions, \
+    ttl_realtime, ttl_static
+from transporter.records import make_record
+from transporter.upstream import ROUTE_AND_POS, STATION_BY_POS, \
+    STATION_BY_UID, UpstreamError, async_upstream, upstream
 
 
 log = Logger(__name__)
 inf = float('inf')
 
 
+def compile_mapper(mapper: tuple, record=None):
+    """Turns `(source_key, target_key, func)` triples into a function that
+    builds the target in a single expression, rather than walking the
+    triples for each dictionary.
+
+    :param record: A record class made by `transporter.records.make_record()`
+        with the target keys as its fields. If not given, the function
+        builds dictionaries.
+    """
+    compiled = _compiled_mappers.get((mapper, record))
+    if compiled is None:
+        namespace = {'f{}'.format(i): func
+                     for i, (_, _, func) in enumerate(mapper)}
+        values = ['f{}(d[{!r}])'.format(i, source_key)
+                  for i, (source_key, _, _) in enumerate(mapper)]
+        if record is None:
+            body = '{{{}}}'.format(', '.join(
+                '{!r}: {}'.format(target_key, value)
+                for (_, target_key, _), value in zip(mapper, values)))
+        else:
+            namespace['record'] = record
+            body = 'record({})'.format(', '.join(values))
+        exec('def transform(d):\n    return {}'.format(body), namespace)
+        compiled = _compiled_mappers[(mapper, record)] = \
+            namespace['transform']
+    return compiled
+
+
+_compiled_mappers = {}
+
+
 class DictMapper(object):
-    """A dictionary mapper that transforms a map to another."""
+    """A dictionary mapper that transforms a map to another.
 
-    def identity(self, value):
-        return value
+    Subclasses list `(source_key, target_key, func)` triples in `mapper`.
+    When a subclass is defined, a record class with the target keys as its
+    fields (`entry_record`) and a function that builds one from a source
+    dictionary are generated for it.
+    """
 
-    def transform(self, source_dict: dict, mapper: list=None):
-        target_dict = {}
+    mapper = ()
+    entry_record = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'mapper' in cls.__dict__:
+            cls.entry_record = make_record(
+                cls.__name__.replace('Mapper', 'Entry'),
+                tuple(target_key for _, target_key, _ in cls.mapper),
+                cls.__module__, cls.__qualname__ + '.entry_record')
+            cls._transform_entry = staticmethod(
+                compile_mapper(cls.mapper, cls.entry_record))
+
+    @staticmethod
+    def identity(value):
+        return value
 
+    def transform(self, source_dict: dict, mapper: tuple=None):
+        """Transforms a dictionary into an `entry_record`, or into a
+        dictionary if `mapper` is given."""
         if mapper is None:
-            mapper = self.mapper
+            return self._transform_entry(source_dict)
+        return compile_mapper(tuple(mapper))(source_dict)
 
-        for source_key, target_key, func in mapper:
-            target_dict[target_key] = func(source_dict[source_key])
-
-        return target_dict
+    def transform_entries(self, entries):
+        """Transforms an iterable of dictionaries into records lazily."""
+        return map(self._transform_entry, entries)
 
 
 class NearestStationsMapper(DictMapper):
 
-    def __init__(self):
-        self.mapper = (
-            # (source key), (target_key), (func)
-            ('gpsY', 'latitude', float),
-            ('gpsX', 'longitude', float),
-            ('arsId', 'ars_id', int),
-            ('stationNm', 'station_name', self.identity),
-            ('dist', 'distance_from_current_location', int),
-        )
+    mapper = (
+        # (source key), (target_key), (func)
+        ('gpsY', 'latitude', float),
+        ('gpsX', 'longitude', float),
+        ('arsId', 'ars_id', int),
+        ('stationNm', 'station_name', DictMapper.identity),
+        ('dist', 'distance_from_current_location', int),
+    )
 
 
 class RoutesForStationMapper(DictMapper):
 
-    def __init__(self):
-        self.mapper = (
-            ('busRouteId', 'route_id', int),
-            ('rtNm', 'route_number', self.identity),
-        )
+    mapper = (
+        ('busRouteId', 'route_id', int),
+        ('rtNm', 'route_number', DictMapper.identity),
+    )
 
     def transform_entry(self, source_dict: dict):
-        target_dict = {}
-
-        for source_key, target_key, func in self.mapper:
-            target_dict[target_key] = func(source_dict[source_key])
-
-        return target_dict
+        return self._transform_entry(source_dict)
 
     def transform(self, source_dict: dict):
-        target_dict = {}
-
-        entries = source_dict['resultList']
-        if entries is not None and len(entries) > 0:
-            first_entry = entries[0]
-
-            target_dict['latitude'] = first_entry['gpsY']
-            target_dict['longitude'] = first_entry['gpsX']
-
-            target_dict['entries'] = [self.transform_entry(e) for e in entries]
-
-        return target_dict
+        return self.transform_results(source_dict.get('resultList') or ())
+
+    def transform_results(self, entries):
+        """Same as `transform()`, but takes the items of `resultList`, which
+        may be a generator.
+
+        :raise UpstreamError: If there are none, as the upstream service
+            responds to errors that way
+        """
+        entries = iter(entries)
+        first_entry = next(entries, None)
+        if first_entry is None:
+            raise UpstreamError('No routes found for the station')
+
+        return {
+            'latitude': first_entry['gpsY'],
+            'longitude': first_entry['gpsX'],
+            'entries': list(self.transform_entries(
+                chain([first_entry], entries))),
+        }
 
 
 class RouteMapper(DictMapper):
 
-    def map_ars_id(self, ars_id: str):
+    route_mapper = (
+        ('routeType', 'route_type', int),
+        ('busRouteNm', 'route_number', DictMapper.identity),
+    )
+
+    @staticmethod
+    def map_ars_id(ars_id: str):
         try:
             return int(ars_id)
         except ValueError:
             return None
 
+    mapper = (
+        ('arsId', 'ars_id', map_ars_id.__func__),
+        ('gpsY', 'latitude', float),
+        ('gpsX', 'longitude', float),
+    )
+
     def transform_entry(self, source_dict: dict):
-        mapper = (
-            ('arsId', 'ars_id', self.map_ars_id),
-            ('gpsY', 'latitude', float),
-            ('gpsX', 'longitude', float),
-        )
-        return super(RouteMapper, self).transform(source_dict, mapper)
+        return self._transform_entry(source_dict)
 
     def transform(self, source_dict: dict):
-        target_dict = {}
-
-        mapper = (
-            ('routeType', 'route_type', int),
-            ('busRouteNm', 'route_number', self.identity),
-        )
+        return self.transform_results(source_dict.get('resultList') or ())
 
-        entries = source_dict['resultList']
-        first_entry = entries[0]
+    def transform_results(self, entries):
+        """Same as `transform()`, but takes the items of `resultList`, which
+        may be a generator.
 
-        target_dict = super(RouteMapper, self).transform(first_entry, mapper)
+        :raise UpstreamError: If there are none
+        """
+        entries = iter(entries)
+        first_entry = next(entries, None)
+        if first_entry is None:
+            raise UpstreamError('No route information found')
 
-        target_dict['entries'] = [self.transform_entry(e) for e in entries]
+        target_dict = super(RouteMapper, self).transform(
+            first_entry, self.route_mapper)
+        target_dict['entries'] = list(self.transform_entries(
+            chain([first_entry], entries)))
 
         return target_dict
 
 
-def auto_fetch(url):
-    def wrap(func):
-        def wrapper(*args, **kwargs):
-            key = '{}_{}'.format(url, args)
-            data = redis_store.get(key)
+class ArrivalsMapper(DictMapper):
+
+    mapper = (
+        ('busRouteId', 'route_id', int),
+        ('rtNm', 'route_number', DictMapper.identity),
+        # Estimated time to arrival in seconds
+        ('traTime1', 'first_arrival', int),
+        ('arrmsg1', 'first_message', DictMapper.identity),
+        ('vehId1', 'first_vehicle_id', int),
+        ('traTime2', 'second_arrival', int),
+        ('arrmsg2', 'second_message', DictMapper.identity),
+        ('vehId2', 'second_vehicle_id', int),
+    )
+
+
+class VehiclePositionsMapper(DictMapper):
+    """Maps the stations of a route where a bus currently is."""
+
+    mapper = (
+        # Position of the station along the route
+        ('seq', 'seq', int),
+        ('station', 'station_id', int),
+        ('arsId', 'ars_id', RouteMapper.map_ars_id),
+        ('gpsY', 'latitude', float),
+        ('gpsX', 'longitude', float),
+        ('busType', 'bus_type', DictMapper.identity),
+    )
+
+    def transform_results(self, entries):
+        return list(self.transform_entries(
+            e for e in entries if e['existYn'] == 'Y'))
+
+
+def fan_out(func, args: list, max_workers: int=8):
+    """Calls `func` for each of `args` concurrently and returns the results
+    in the same order. This is meant for upstream-bound calls, where latency
+    is dominated by waiting for the network.
+
+    :param max_workers: Maximum number of concurrent calls
+    """
+    if len(args) <= 1:
+        return [func(arg) for arg in args]
 
-            if data is None:
-                log.info('Data entry for "{}" does not exist. Fetching one.'
-                         .format(key))
-                data = func(*args, **kwargs)
-                redis_store.set(key, json.dumps(data))
-            else:
-                log.info('Data entry for "{}" was loaded from cache.'
-                         .format(key))
-                data = json.loads(data.decode('utf-8'))
+    # Worker threads need the application context of the caller
+    app = current_app._get_current_object() if has_app_context() else None
 
-            return data
-        return wrapper
-    return wrap
+    def call(arg):
+        if app is None:
+            return func(arg)
+        with app.app_context():
+            return func(arg)
 
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(args))) \
+            as executor:
+        return list(executor.map(call, args))
 
+
+@cached('nearest_stations', ttl=ttl_nearby)
 def get_nearest_stations(latitude: float, longitude: float, radius: int=300):
     """
     Request Example:
@@ -170,41 +275,88 @@ def get_nearest_stations(latitude: float, longitude: float, radius: int=300):
         }
 
     """
-    url = 'http://m.bus.go.kr/mBus/bus/getStationByPos.bms'
     data = {'tmX': longitude, 'tmY': latitude, 'radius': radius}
 
-    resp = requests.post(url, data=data)
+    mapper = NearestStationsMapper()
 
-    try:
-        # FIXME: Handle one error at a time
-        rows = json.loads(resp.text)['resultList']
-    except ValueError:
-        return 'Could not load data', 500
+    return list(mapper.transform_entries(
+        upstream.iter_results(STATION_BY_POS, data=data)))
 
+
+@get_nearest_stations.coroutine
+async def get_nearest_stations_async(latitude: float, longitude: float,
+                                     radius: int=300):
+    data = {'tmX': longitude, 'tmY': latitude, 'radius': radius}
     mapper = NearestStationsMapper()
 
-    return [mapper.transform(r) for r in rows]
+    return list(mapper.transform_entries(
+        await async_upstream.results(STATION_BY_POS, data=data)))
 
 
-@auto_fetch('http://m.bus.go.kr/mBus/bus/getStationByUid.bms')
+@cached('routes_for_station', ttl=ttl_static,
+        local=LRUCache(max_entries=4096, max_bytes=8 * 1024 ** 2))
 def get_routes_for_station(ars_id):
     """Get route information that goes through a particular station."""
-    station_url = 'http://m.bus.go.kr/mBus/bus/getStationByUid.bms'
-    resp = requests.post(station_url, data={'arsId': ars_id})
     mapper = RoutesForStationMapper()
 
-    return mapper.transform(json.loads(resp.text))
+    return mapper.transform_results(
+        upstream.iter_results(STATION_BY_UID, data={'arsId': ars_id}))
+
+
+@get_routes_for_station.coroutine
+async def get_routes_for_station_async(ars_id):
+    mapper = RoutesForStationMapper()
+
+    return mapper.transform_results(
+        await async_upstream.results(STATION_BY_UID, data={'arsId': ars_id}))
 
 
+@cached('route', ttl=ttl_static,
+        local=LRUCache(max_entries=1024, max_bytes=32 * 1024 ** 2))
 def get_route(route_id):
     """Given a route ID, returns route info. The route_id is not a bus number.
     """
-    route_info_url = 'http://m.bus.go.kr/mBus/bus/getRouteAndPos.bms'
-    resp = requests.post(route_info_url, data={'busRouteId': route_id})
+    mapper = RouteMapper()
+
+    return mapper.transform_results(
+        upstream.iter_results(ROUTE_AND_POS, data={'busRouteId': route_id}))
+
 
+@get_route.coroutine
+async def get_route_async(route_id):
     mapper = RouteMapper()
 
-    return mapper.transform(json.loads(resp.text))
+    return mapper.transform_results(await async_upstream.results(
+        ROUTE_AND_POS, data={'busRouteId': route_id}))
+
+
+@cached('arrivals', ttl=ttl_realtime)
+def get_arrivals(ars_id):
+    """Arrival estimates of the next two buses of each route going through a
+    station. See `transporter.arrivals` for how they are kept fresh."""
+    mapper = ArrivalsMapper()
+
+    return list(mapper.transform_entries(
+        upstream.iter_results(STATION_BY_UID, data={'arsId': ars_id})))
+
+
+@get_arrivals.coroutine
+async def get_arrivals_async(ars_id):
+    mapper = ArrivalsMapper()
+
+    return list(mapper.transform_entries(
+        await async_upstream.results(STATION_BY_UID, data={'arsId': ars_id})))
+
+
+@cached('vehicle_positions', ttl=ttl_positions)
+def get_vehicle_positions(route_id):
+    """Stations of a route where a bus currently is. These are polled by
+    `transporter.vehicles`, and the cache lets processes polling the same
+    route share upstream calls."""
+    mapper = VehiclePositionsMapper()
+
+    return mapper.transform_results(
+        upstream.iter_results(ROUTE_AND_POS, data={'busRouteId': route_id}))
 
 
 def guess_time_diff(station_info1: dict, station_info2: dict):
@@ -219,6 +371,31 @@ def guess_time_diff(station_info1: dict, station_info2: dict):
     return time_diff.total_seconds()
 
 
+def parse_service_time(value: str):
+    """Parses `HH:MM` into seconds since midnight, or `None`."""
+    try:
+        hours, minutes = value.strip().split(':')
+        return int(hours) * 3600 + int(minutes) * 60
+    except (AttributeError, ValueError):
+        return None
+
+
+def service_window(entries: list):
+    """The service hours of a route as a `(first_time, last_time)` tuple,
+    given the `resultList` of its raw data. Either may be `None` if unknown.
+    """
+    if not entries:
+        return None, None
+
+    first_time = parse_service_time(entries[0].get('beginTm'))
+    last_time = parse_service_time(entries[-1].get('lastTm'))
+    if first_time is not None and last_time is not None and \
+            last_time < first_time:
+        # Runs past midnight
+        last_time += 24 * 3600
+    return first_time, last_time
+
+
 def stations_with_aux_info(raw):
     buf = []
     prev_station_info = None
@@ -240,12 +417,32 @@ def stations_with_aux_info(raw):
 def fetch_route_raw(route_id: int):
     """Fetch raw JSON data for a particular route."""
 
-    url = 'http://m.bus.go.kr/mBus/bus/getRouteAndPos.bms'
-    data = {'busRouteId': route_id}
+    return upstream.post_json(ROUTE_AND_POS, data={'busRouteId': route_id})
+
 
-    resp = requests.post(url, data=data)
+def invalidate_route_cache(raw: dict):
+    """Removes cached data that depends on a route, given its raw data as
+    returned by `fetch_route_raw()`."""
+    entries = raw['resultList']
+    if not entries:
+        return
 
-    return json.loads(resp.text)
+    # In order to avoid circular import...
+    from transporter.api import route, routes_for_station
+
+    route_id = int(entries[0]['busRouteId'])
+    get_route.invalidate(route_id)
+    route.invalidate(route_id=route_id)
+
+    ars_ids = []
+    for station_info in entries:
+        try:
+            ars_ids.append((int(station_info['arsId']),))
+        except ValueError:
+            pass
+    get_routes_for_station.invalidate_many(ars_ids)
+    routes_for_station.invalidate_many(
+        [{'ars_id': ars_id} for ars_id, in ars_ids])
 
 
 def store_route_info(route_id: int):
@@ -261,12 +458,16 @@ def store_route_info(route_id: int):
 
     log.info('Fetching route info...')
 
+    first_time, last_time = service_window(raw['resultList'])
+
     route = None
     try:
         route = Route.create(
             id=first_node['busRouteId'],
             number=first_node['busRouteNm'],
             type=first_node['routeType'],
+            first_time=first_time,
+            last_time=last_time,
             raw=raw,
         )
         log.info('Stored route {}'.format(route.number))
@@ -334,21 +535,27 @@ def store_route_info(route_id: int):
         prev_station = station
         prev_station_info = station_info
 
+    invalidate_route_cache(raw)
+
 
 def build_graph(stations):
+    """Builds a dict-of-dicts graph for `Map.calculate_distance_for_all_nodes`.
+    For anything larger than a handful of stations, use
+    `transporter.graph.TransitGraph` instead."""
 
-    from transporter.models import GraphNode
+    from transporter.models import Edge, GraphNode_
 
     graph = {}
 
     for station in stations:
         graph[station.id] = {
-            'node': GraphNode(station.id, inf),
-            'edges': set([(e.end, e.average_time) for e in station.edges])
+            'node': GraphNode_(station.id, inf),
+            'edges': set(),
         }
 
-    # Filter out non-existing graph nodes
-    # for key, value in graph.items():
-    #     value['edges'] = filter(lambda x: x[0] in graph, value['edges'])
+    # Fetch all edges at once rather than one query per station
+    edges = Edge.query.filter(Edge.start.in_(list(graph)))
+    for e in edges:
+        graph[e.start]['edges'].add((e.end, e.average_time))
 
     return graph
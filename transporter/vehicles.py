@@ -0,0 +1,249 @@
+"""Live vehicle positions of routes.
+
+Clients subscribe to a route with `/api/route/<route_id>/vehicles`, a stream
+of server-sent events. Each process runs at most one poller per route with
+subscribers, whatever their number, and sends them the changes between
+successive polls only:
+
+    event: snapshot
+    data: {"positions": [{"seq": 3, "station_id": 5378, ...}, ...]}
+
+    event: delta
+    data: {"changed": [{"seq": 11, ...}], "removed": [3]}
+
+A position is keyed by `seq`, the position along the route of the station
+where a bus is. Polls go through the cache of
+`transporter.utils.get_vehicle_positions()`, so pollers of the same route in
+other processes share upstream calls as well.
+"""
+import asyncio
+from queue import Empty, Queue
+import threading
+
+from flask import current_app
+from logbook import Logger
+
+from transporter.serialization import dumps
+from transporter.upstream import UpstreamError
+from transporter.utils import get_vehicle_positions
+
+
+log = Logger(__name__)
+
+
+def diff_positions(previous: dict, current: dict):
+    """
+    :param previous: Positions keyed by `seq`
+    :param current: Positions keyed by `seq`
+    :return: A `(changed, removed)` tuple of a list of positions and a list
+        of `seq`
+    """
+    changed = [p for seq, p in current.items() if previous.get(seq) != p]
+    removed = [seq for seq in previous if seq not in current]
+    return changed, removed
+
+
+def format_event(event) -> bytes:
+    """Formats an event of a `Subscription` as a server-sent event, or as a
+    comment that keeps the connection alive if it is `None`."""
+    if event is None:
+        return b': keep-alive\n\n'
+    name, data = event
+    return b'event: ' + name.encode('ascii') + b'\ndata: ' + dumps(data) + \
+        b'\n\n'
+
+
+class Subscription(object):
+    """The events of a route for a single subscriber. Iterating over it yields
+    `(event, data)` tuples, or `None` when nothing happened for
+    `keep_alive` seconds."""
+
+    def __init__(self, keep_alive: float):
+        self.keep_alive = keep_alive
+        self.queue = Queue()
+        self.feed = None
+        self.closed = False
+
+    def __iter__(self):
+        while not self.closed:
+            try:
+                yield self.queue.get(timeout=self.keep_alive)
+            except Empty:
+                yield None
+
+    def put(self, event):
+        self.queue.put(event)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.feed is not None:
+                self.feed.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """A subscription read from an event loop, through `queue`, an
+    `asyncio.Queue`."""
+
+    def __init__(self, keep_alive: float):
+        super(AsyncSubscription, self).__init__(keep_alive)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def __iter__(self):
+        raise TypeError('Read AsyncSubscription.queue instead')
+
+    def put(self, event):
+        # Called from the thread of the feed
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+        except RuntimeError:
+            # The loop has been closed
+            pass
+
+
+class RouteFeed(object):
+    """Polls the vehicle positions of a route while it has subscribers."""
+
+    def __init__(self, hub, route_id: int):
+        self.hub = hub
+        self.route_id = route_id
+        self.subscribers = set()
+        self.positions = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def subscribe(self, subscription: Subscription):
+        """
+        :return: `False` if the feed has stopped
+        """
+        with self.lock:
+            if self.stopped.is_set():
+                return False
+            subscription.feed = self
+            self.subscribers.add(subscription)
+            # Late subscribers start with the last known positions
+            if self.positions is not None:
+                subscription.put(self.snapshot())
+        return True
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+            if self.subscribers:
+                return
+            self.stopped.set()
+        self.hub.remove(self)
+
+    def snapshot(self):
+        return 'snapshot', {'positions': list(self.positions.values())}
+
+    def publish(self, event):
+        with self.lock:
+            for subscription in self.subscribers:
+                subscription.put(event)
+
+    def poll(self):
+        """Fetches the positions once and publishes what changed."""
+        try:
+            positions = {p['seq']: p for p in self.hub.fetch(self.route_id)}
+        except UpstreamError as e:
+            log.warn('Failed to poll route {}: {}'.format(self.route_id, e))
+            self.publish(('error', {'error': str(e)}))
+            return
+
+        with self.lock:
+            previous, self.positions = self.positions, positions
+        if previous is None:
+            self.publish(self.snapshot())
+            return
+
+        changed, removed = diff_positions(previous, positions)
+        if changed or removed:
+            self.publish(('delta', {'changed': changed, 'removed': removed}))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                # E.g., Redis is unavailable. The feed stays registered with
+                # the hub, so it has to keep polling for its subscribers.
+                log.exception('Failed to poll route {}'.format(
+                    self.route_id))
+                self.publish(('error', {'error': 'Internal error'}))
+            self.stopped.wait(self.hub.interval)
+
+    def start(self, app):
+        def run():
+            with app.app_context():
+                self.run()
+
+        self.thread = threading.Thread(
+            target=run, name='route-feed-{}'.format(self.route_id),
+            daemon=True)
+        self.thread.start()
+
+
+class VehicleHub(object):
+    """The route feeds of a process."""
+
+    def __init__(self, interval: float=10, keep_alive: float=15,
+                 fetch=get_vehicle_positions):
+        """
+        :param interval: Seconds between polls of a route
+        :param keep_alive: Seconds of silence after which subscribers are
+            given a chance to send a keep-alive message
+        :param fetch: Returns the positions of a route given its ID
+        """
+        self.interval = interval
+        self.keep_alive = keep_alive
+        self.fetch = fetch
+        self.feeds = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, route_id: int, subscription: Subscription=None,
+                  app=None):
+        """Subscribes to a route, starting to poll it if needed.
+
+        :param subscription: A `Subscription` by default
+        :param app: The application the poller runs for. Defaults to the
+            current one.
+        """
+        if subscription is None:
+            subscription = Subscription(self.keep_alive)
+
+        with self.lock:
+            feed = self.feeds.get(route_id)
+            # The feed may have lost its last subscriber in the meantime
+            started = feed is not None and feed.subscribe(subscription)
+            if not started:
+                feed = self.feeds[route_id] = RouteFeed(self, route_id)
+                feed.subscribe(subscription)
+
+        if not started:
+            feed.start(app or current_app._get_current_object())
+        return subscription
+
+    def remove(self, feed: RouteFeed):
+        with self.lock:
+            if self.feeds.get(feed.route_id) is feed:
+                del self.feeds[feed.route_id]
+
+
+def get_vehicle_hub(app=None):
+    """Returns the vehicle hub of an application, the current one by
+    default."""
+    app = app or current_app
+    hub = app.extensions.get('vehicle_hub')
+    if hub is None:
+        with _lock:
+            hub = app.extensions.get('vehicle_hub')
+            if hub is None:
+                hub = app.extensions['vehicle_hub'] = VehicleHub(
+                    app.config['VEHICLE_POLL_INTERVAL'])
+    return hub
+
+
+_lock = threading.Lock()